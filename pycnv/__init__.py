@@ -1,5 +1,8 @@
 from .pycnv import *
 from .pycnv_sum_folder import get_all_valid_files, get_stations
+from .pycnv_stations import station_index, get_station_index, station_registry, get_station_registry
+from .pycnv_grid import interp_casts
+from .pycnv_summary import summary_table, create_summary_table
 
 
 with open(version_file) as version_f:
@@ -1,21 +1,21 @@
 import datetime
-from pytz import timezone
 import numpy
 import logging
 import sys
 import argparse
-import pkg_resources
-import yaml
-import pylab as pl
 import os
 import hashlib
 import errno
 import locale
+import itertools
+import time
 
-standard_name_file = pkg_resources.resource_filename('pycnv', 'rules/standard_names.yaml')
+# The data files of the package (naming rules, stations, version)
+package_dir = os.path.dirname(os.path.abspath(__file__))
+standard_name_file = os.path.join(package_dir, 'rules', 'standard_names.yaml')
 
 # Get the version
-version_file = pkg_resources.resource_filename('pycnv','VERSION')
+version_file = os.path.join(package_dir, 'VERSION')
 
 with open(version_file) as version_f:
    version = version_f.read().strip()
@@ -52,7 +52,7 @@ def parse_time(datum):
     loc = locale.getlocale()
     try:
         start_date = datetime.datetime.strptime(datum,'%b %d %Y %H:%M:%S')
-        start_date = start_date.replace(tzinfo=timezone('UTC'))
+        start_date = start_date.replace(tzinfo=datetime.timezone.utc)
     except Exception as e:
         start_date = None
         logger.warning('parse_header() start_time: Could not decode time: ( ' + datum + ' )' + str(e) + ' locale' + str(loc))
@@ -63,7 +63,7 @@ def parse_time(datum):
         locnew = locale.getlocale()
         try:
             start_date = datetime.datetime.strptime(datum,'%b %d %Y %H:%M:%S')
-            start_date = start_date.replace(tzinfo=timezone('UTC'))
+            start_date = start_date.replace(tzinfo=datetime.timezone.utc)
         except Exception as e:
             start_date = None
             logger.warning('parse_header() start_time: Could not decode time: ( ' + datum + ' )' + str(e) + ' locale' + str(locnew))
@@ -73,6 +73,308 @@ def parse_time(datum):
     return start_date                 
 
 
+def get_cache_dir():
+    """
+    Returns the folder used by pycnv to cache data (e.g. the compiled station registry). The folder is $PYCNV_CACHE_DIR, $XDG_CACHE_HOME/pycnv or ~/.cache/pycnv and is created if it does not exist.
+    Returns:
+       cache_dir: The cache folder, None if it cannot be created
+    """
+    cache_dir = os.environ.get('PYCNV_CACHE_DIR')
+    if(cache_dir is None):
+        cache_base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+        cache_dir  = os.path.join(cache_base, 'pycnv')
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except Exception as e:
+        logger.debug('Could not create cache folder ' + cache_dir + ': ' + str(e))
+        return None
+
+    return cache_dir
+
+
+def get_bin_index(x, bin_size, bin_offset = 0.0):
+    """
+    Assigns the samples to bins centered at bin_offset + k * bin_size (as SBE Bin Average), e.g. with bin_size=1 the bin 2 dbar contains the samples from 1.5 to 2.5 dbar
+    Args:
+       x: The bin variable (e.g. pressure)
+       bin_size: Size of the bins
+       bin_offset: Center of the bin k = 0
+    Returns:
+       [ind, center]: ind: bin number of each sample (0 ... nbin-1, -1 for samples with a NaN bin variable), center: The center of the bins (nbin), increasing
+    """
+    x     = numpy.asarray(x, dtype = float)
+    good  = numpy.isfinite(x)
+    k     = numpy.floor((x[good] - bin_offset) / bin_size + 0.5).astype(numpy.int64)
+    kbin, ind_good = numpy.unique(k, return_inverse = True)
+    ind   = numpy.full(len(x), -1, dtype = numpy.int64)
+    ind[good] = ind_good.ravel()
+    return [ind, bin_offset + kbin * bin_size]
+
+
+def bin_mean(values, ind, nbin):
+    """
+    Averages the samples in bins, NaNs are ignored
+    Args:
+       values: Array (nsample) or (nsample, ncolumn)
+       ind: Bin number of each sample, -1 for samples to be ignored, see get_bin_index()
+       nbin: The number of bins
+    Returns:
+       mean: Array (nbin) or (nbin, ncolumn), NaN for bins without valid values
+    """
+    values = numpy.asarray(values, dtype = float)
+    shape  = numpy.shape(values)
+    values = numpy.reshape(values, (shape[0], -1))
+    ncol   = numpy.shape(values)[1]
+    good   = ind >= 0
+    values = values[good]
+    # One bincount for all columns with the combined bin-column index
+    ind_col = (ind[good][:,numpy.newaxis] * ncol + numpy.arange(ncol)).ravel()
+    valid   = numpy.isfinite(values).ravel()
+    vsum    = numpy.bincount(ind_col[valid], weights = values.ravel()[valid], minlength = nbin * ncol)
+    vnum    = numpy.bincount(ind_col[valid], minlength = nbin * ncol)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean = vsum / vnum
+
+    mean[vnum == 0] = numpy.nan
+    return numpy.reshape(mean, (nbin,) + shape[1:])
+
+
+def bin_average(values, x, bin_size, bin_offset = 0.0):
+    """
+    Bin average (as SBE Bin Average) of values with respect to the bin variable x, see get_bin_index()
+    Args:
+       values: Array (nsample) or (nsample, ncolumn)
+       x: The bin variable (nsample), e.g. pressure
+       bin_size: Size of the bins
+       bin_offset: Center of the bin k = 0
+    Returns:
+       [mean, nbin, center]: mean: Array (nbin) or (nbin, ncolumn), nbin: Number of samples in each bin, center: Center of the bins
+    """
+    ind, center = get_bin_index(x, bin_size, bin_offset)
+    nbin        = numpy.bincount(ind[ind >= 0], minlength = len(center))
+    return [bin_mean(values, ind, len(center)), nbin, center]
+
+
+def smooth(x, window):
+    """
+    Centered running mean of x over window samples, the window is shortened at the edges and NaNs are interpolated
+    Args:
+       x: Array
+       window: Length of the window [samples]
+    Returns:
+       xs: Smoothed array
+    """
+    x    = numpy.asarray(x, dtype = float)
+    good = numpy.isfinite(x)
+    if(not(good.all())):
+        if(not(good.any())):
+            return x.copy()
+        ind = numpy.arange(len(x))
+        x   = numpy.interp(ind, ind[good], x[good])
+
+    n     = len(x)
+    w     = max(int(window), 1)
+    csum  = numpy.concatenate(([0.0], numpy.cumsum(x)))
+    ind   = numpy.arange(n)
+    i0    = numpy.maximum(ind - w // 2, 0)
+    i1    = numpy.minimum(ind - w // 2 + w, n)
+    return (csum[i1] - csum[i0]) / (i1 - i0)
+
+
+def get_turning_points(p, window = 25, min_range = 2.0):
+    """
+    Finds the turning points of a (yo-yo) pressure record. The pressure is smoothed (see smooth()), the local extrema of the smoothed pressure are found vectorized and only the extrema are checked with a hysteresis of min_range, i.e. a turning point needs a change of at least min_range afterwards. The turning points are then moved to the extreme of the unsmoothed pressure within the smoothing window.
+    Args:
+       p: Pressure [dbar]
+       window: Smoothing window [samples]
+       min_range: Minimum pressure change between two turning points [dbar]
+    Returns:
+       tp: Indices of the turning points including the first and the last sample
+    """
+    n = len(p)
+    if(n < 2):
+        return numpy.arange(n)
+
+    ps  = smooth(p, window)
+    sgn = numpy.sign(numpy.diff(ps))
+    nz  = numpy.flatnonzero(sgn)
+    if(len(nz) == 0):
+        return numpy.asarray([0, n - 1])
+
+    # Fill constant parts with the previous direction
+    sgn  = sgn[numpy.maximum.accumulate(numpy.where(sgn != 0, numpy.arange(len(sgn)), nz[0]))]
+    cand = numpy.flatnonzero(numpy.diff(sgn) != 0) + 1
+    cand = numpy.concatenate((cand, [n - 1]))
+    tp   = [0]
+    imin = 0
+    imax = 0
+    direction = 0
+    for i in cand:
+        if(direction == 0): # No direction yet, start at the extreme opposite to the first move
+            if(ps[i] <= ps[imin]):
+                imin = i
+            if(ps[i] >= ps[imax]):
+                imax = i
+            if(ps[i] - ps[imin] >= min_range):
+                direction = 1
+                iext      = i
+                if(imin > 0):
+                    tp.append(imin)
+            elif(ps[imax] - ps[i] >= min_range):
+                direction = -1
+                iext      = i
+                if(imax > 0):
+                    tp.append(imax)
+        elif(direction == 1):
+            if(ps[i] >= ps[iext]):
+                iext = i
+            elif(ps[iext] - ps[i] >= min_range):
+                tp.append(iext)
+                direction = -1
+                iext      = i
+        else:
+            if(ps[i] <= ps[iext]):
+                iext = i
+            elif(ps[i] - ps[iext] >= min_range):
+                tp.append(iext)
+                direction = 1
+                iext      = i
+
+    if(tp[-1] != n - 1):
+        tp.append(n - 1)
+
+    # Refine the turning points to the extreme of the unsmoothed pressure
+    p = numpy.asarray(p, dtype = float)
+    for k in range(1, len(tp) - 1):
+        i0  = max(tp[k] - window, tp[k - 1] + 1)
+        i1  = min(tp[k] + window + 1, tp[k + 1])
+        seg = p[i0:i1]
+        if(numpy.isfinite(seg).any()):
+            if(ps[tp[k]] > ps[tp[k - 1]]):
+                tp[k] = i0 + int(numpy.nanargmax(seg))
+            else:
+                tp[k] = i0 + int(numpy.nanargmin(seg))
+
+    return numpy.asarray(tp)
+
+
+def get_segments(p, window = 25, min_range = 2.0):
+    """
+    Splits a pressure record into segments between its turning points (see get_turning_points()). The turning point belongs to both segments.
+    Args:
+       p: Pressure [dbar]
+       window: Smoothing window [samples]
+       min_range: Minimum pressure change between two turning points [dbar]
+    Returns:
+       segments: List of [start, stop, direction] with the segment p[start:stop], direction: 1 for increasing (down), -1 for decreasing pressure (up), 0 for segments with a pressure change smaller than min_range, an empty list if p has no finite values
+    """
+    p = numpy.asarray(p, dtype = float)
+    if(not(numpy.isfinite(p).any())):
+        return []
+
+    tp = get_turning_points(p, window, min_range)
+    if(len(tp) < 2):
+        return []
+
+    ps       = smooth(p, window)
+    segments = []
+    for i0,i1 in zip(tp[:-1], tp[1:]):
+        dp = ps[i1] - ps[i0]
+        if(not(numpy.isfinite(dp)) or abs(dp) < min_range):
+            direction = 0
+        else:
+            direction = int(numpy.sign(dp))
+        segments.append([int(i0), int(i1) + 1, direction])
+
+    return segments
+
+
+def decimate_minmax(x, y, nbuckets):
+    """
+    Decimates a line for plotting, the samples are split into nbuckets buckets of consecutive samples and of each bucket the samples with the minimum and maximum of x and y are kept (min/max decimation), i.e. the extremes stay visible. The first NaN of a bucket is kept as well, gaps in the line are preserved.
+    Args:
+       x: x data
+       y: y data
+       nbuckets: Number of buckets, lines with less than 4 * nbuckets samples are not decimated
+    Returns:
+       Sorted indices of the samples to plot
+    """
+    x = numpy.asarray(x, dtype = float)
+    y = numpy.asarray(y, dtype = float)
+    n = len(x)
+    nbuckets = max(int(nbuckets), 1)
+    if(n <= 4 * nbuckets):
+        return numpy.arange(n)
+
+    size  = -(-n // nbuckets)
+    nfull = -(-n // size)
+    base  = numpy.arange(nfull) * size
+    ind   = [base, numpy.minimum(base + size - 1, n - 1)]
+    for data in (x, y):
+        # Pad to a (bucket, sample) array, NaN and padding never are an extreme
+        nan  = numpy.isnan(data)
+        low  = numpy.full(nfull * size, numpy.inf)
+        high = numpy.full(nfull * size, -numpy.inf)
+        low[:n]  = numpy.where(nan, numpy.inf, data)
+        high[:n] = numpy.where(nan, -numpy.inf, data)
+        ind.append(base + numpy.argmin(low.reshape(nfull, size), axis = 1))
+        ind.append(base + numpy.argmax(high.reshape(nfull, size), axis = 1))
+        if(nan.any()):
+            pad = numpy.zeros(nfull * size, dtype = bool)
+            pad[:n] = nan
+            pad = pad.reshape(nfull, size)
+            has_nan = pad.any(axis = 1)
+            ind.append((base + numpy.argmax(pad, axis = 1))[has_nan])
+
+    return numpy.unique(numpy.concatenate(ind))
+
+
+def get_plot_buckets(ax, oversampling = 2):
+    """
+    Returns the number of buckets for decimate_minmax() for an axes, oversampling times the larger of its width and height in pixels. The samples are ordered by time and not by the plotted coordinates, the oversampling keeps details of unevenly sampled lines (e.g. profiles with a changing descent rate).
+    """
+    bbox = ax.get_window_extent()
+    return int(oversampling * max(bbox.width, bbox.height, 1))
+
+
+def dates_to_us(dates):
+    """
+    Converts datetime objects into int64 microseconds since 1970-01-01 (of the local time of the dates), used to store the dates of cdata compactly
+    Args:
+       dates: List or array of datetime objects with the same timezone
+    Returns:
+       [us,tz]: Array of int64 and the timezone of the dates (None for naive dates)
+    """
+    us = numpy.zeros(len(dates), dtype = numpy.int64)
+    if(len(dates) == 0):
+        return [us,None]
+    tz    = dates[0].tzinfo
+    epoch = datetime.datetime(1970,1,1)
+    step  = datetime.timedelta(microseconds = 1)
+    for i,d in enumerate(dates):
+        us[i] = (d.replace(tzinfo = None) - epoch) // step
+
+    return [us,tz]
+
+
+def us_to_dates(us, tz = None):
+    """
+    Converts int64 microseconds since 1970-01-01 back into datetime objects, see dates_to_us()
+    Args:
+       us: Array of int64
+       tz: Timezone of the dates
+    Returns:
+       Array of datetime objects
+    """
+    us    = numpy.asarray(us, dtype = numpy.int64)
+    dates = (numpy.datetime64('1970-01-01T00:00:00','us') + us.astype('timedelta64[us]')).astype(object)
+    if(tz is not None):
+        dates = numpy.asarray([d.replace(tzinfo = tz) for d in dates])
+
+    return dates
+
+
 def check_baltic(lon,lat):
     """
     Functions checks if position with lon,lat is in the Baltic Sea
@@ -95,10 +397,65 @@ def check_baltic(lon,lat):
     return False
 
 
-try:
-    import gsw
-except:
-    logger.warning('Could not load the Gibbs Seawater toolbox')
+# The heavy dependencies are imported at their first use, to keep the
+# import of pycnv (and the startup of the scripts and worker processes) fast
+def _import_gsw():
+    """ Imports the Gibbs Seawater toolbox, which is only needed to compute the derived data (cdata) and the depth
+    """
+    try:
+        import gsw
+    except ImportError:
+        logger.warning('Could not load the Gibbs Seawater toolbox')
+        raise ImportError('Computing the derived data needs the gsw package (pip install gsw)')
+
+    return gsw
+
+
+def _import_pylab():
+    """ Imports pylab, which is only needed for plotting
+    """
+    try:
+        import pylab
+    except ImportError:
+        raise ImportError('Plotting needs the matplotlib package (pip install matplotlib)')
+
+    return pylab
+
+
+def _import_cm():
+    """ Imports the colormaps of matplotlib without pylab and its interactive backends
+    """
+    try:
+        import matplotlib.cm
+    except ImportError:
+        raise ImportError('Plotting needs the matplotlib package (pip install matplotlib)')
+
+    return matplotlib.cm
+
+
+# The parsed naming rules, each rule file is read only once per process
+_naming_rules = {}
+
+
+def load_naming_rules(naming_rules = standard_name_file):
+    """
+    Returns the parsed naming rules of a yaml file, the rules are cached
+    Args:
+       naming_rules: The yaml file with the rules (see rules/standard_names.yaml)
+    Returns:
+       Dictionary with the rules
+    """
+    try:
+        return _naming_rules[naming_rules]
+    except KeyError:
+        pass
+
+    import yaml
+    with open(naming_rules) as f:
+        rules = yaml.safe_load(f)
+
+    _naming_rules[naming_rules] = rules
+    return rules
 
 
 
@@ -179,7 +536,7 @@ def parse_iow_header(header,pycnv_object=None):
                 zeit_start = line_split[0]
                 try:
                     iow_data['date'] = datetime.datetime.strptime(datum_start + zeit_start,'%Y-%m-%d%H:%M:%S')
-                    iow_data['date'] = iow_data['date'].replace(tzinfo=timezone('UTC'))
+                    iow_data['date'] = iow_data['date'].replace(tzinfo=datetime.timezone.utc)
                 except Exception as e:
                     logger.warning('Startzeit to datetime:' + str(e))
                     logger.warning('Startzeit str:' + line_orig)                    
@@ -329,6 +686,11 @@ def parse_iow_header(header,pycnv_object=None):
     return iow_data
 
 
+# Attributes of pycnv which are the data, views of the data or plotting
+# state, they are rebuilt and not transferred by pycnv._get_meta()
+_meta_exclude = ['raw_data', 'data', 'cdata', 'figures', 'axes', 'parse_custom_header', '_segments', '_shm', 'p', 'C', 'T', 'SP', 'SA', 'CT', 'pt', 'pot_rho', 'oxy']
+
+
 class pycnv(object):
     """
 
@@ -348,15 +710,30 @@ class pycnv(object):
        encoding:
        baltic: Flag if the cast was in the Baltic Sea. None: Automatic check based on parsed lat/lon and the regions definded in pycnv.regions_baltic, True: cast is in Baltic, False: cast is not in Baltic. If cast is in Baltic the gsw equation of state for the Baltic Sea will be used.
        header_parse: Function for parsing custom header information, will be called like so: header_parse(header_str, self), where self is the pycnv object. The function can thus create fields of the pycnv object. See parse_iow_header() as an example
+       bin_size: Bin average the data (as SBE Bin Average) in bins of bin_size of the bin_variable, None: no binning. data, cdata and raw_data contain the averages, cdata['nbin'] the number of samples and cdata['bin_center'] the center of each bin
+       bin_variable: The variable to bin, a channel name or standard name (e.g. 'p', 'timeS') or 'depth' (computed from pressure if not available)
+       bin_offset: Center of the bin with number 0
+       bin_derived: 'after': cdata (gsw) is computed from the binned data, 'before': cdata is computed with the full resolution and then binned
+       bin_cast: The part of the cast which is binned (see get_cast_segments()), 'down' (default, as SBE Bin Average the downcast only), 'up' or None for all samples (e.g. moorings), if the part is not found all samples are binned
+       compute_cdata: Compute the derived data (cdata, e.g. SA, CT and the date), if False cdata is only computed for the parts of the cast requested by downcast(), upcast() or soak()
+
+    The wall time, the bytes and the rows processed by the stages of
+    reading the file ('sha1', 'header', 'standard_names', 'data',
+    'bin', 'compute_date', 'compute_data' and 'total') are stored in
+    the dictionary timings, e.g. cnv.timings['data']['time'], see
+    format_timings().
     
     """
-    def __init__(self,filename, only_metadata = False,verbosity = logging.INFO, naming_rules = standard_name_file,encoding='latin-1',baltic=None, header_parse = parse_iow_header,calc_sha1=True  ):
+    def __init__(self,filename, only_metadata = False,verbosity = logging.INFO, naming_rules = standard_name_file,encoding='latin-1',baltic=None, header_parse = parse_iow_header,calc_sha1=True, bin_size = None, bin_variable = 'p', bin_offset = 0.0, bin_derived = 'after', bin_cast = 'down', compute_cdata = True  ):
         """
         """
+        t_init = time.perf_counter()
         logger.setLevel(verbosity)
         logger.info(' Opening file: ' + filename)
+        self.timings = {}
         self.parse_custom_header = header_parse
         self.filename = filename
+        self.encoding = encoding
         self.file_type = ''
         self.channels = []
         self.data        = None
@@ -374,21 +751,26 @@ class pycnv(object):
         try:
             # Calculate a md5 hash
             if(calc_sha1):
+               t0 = time.perf_counter()
+               nbytes = 0
                BLOCKSIZE = 65536
                hasher = hashlib.sha1()
                with open(self.filename, 'rb') as afile:
                    buf = afile.read(BLOCKSIZE)
                    while len(buf) > 0:
                       hasher.update(buf)
+                      nbytes += len(buf)
                       buf = afile.read(BLOCKSIZE)
 
                self.sha1 = hasher.hexdigest()
                afile.close()               
+               self._add_timing('sha1', t0, nbytes = nbytes)
             else:
                self.sha1 = None
                
             # Opening for reading
             raw = open(self.filename, "r",encoding=encoding)
+            self.file_size = os.fstat(raw.fileno()).st_size
         except Exception as e:
             logger.critical('Could not open file:' + self.filename + ' (Exception: {:s})'.format(str(e)))
             self.valid_cnv = False
@@ -397,8 +779,10 @@ class pycnv(object):
         
         #print('Hallo!',raw)
         # Find the header and store it
-        header = self._get_header(raw)
+        t0 = time.perf_counter()
+        nheader = self._get_header(raw)
         self._parse_header()
+        self._add_timing('header', t0, nbytes = len(self.header), nrows = nheader)
         # Decide which timestamp to use for the date
         #NMEA UTC (Time)
         if(self.nmea_date is not None):
@@ -414,6 +798,7 @@ class pycnv(object):
         if(len(self.channels) == 0):
             logger.critical('Did not find any channels in file: ' + filename + ', exiting (No cnv file?)')
             self.valid_cnv = False
+            self._add_timing('total', t_init, nbytes = self.file_size)
             return
 
         # Check if we have a known data format
@@ -422,6 +807,7 @@ class pycnv(object):
         else:
             logger.critical('Data format in file: ' + filename + ', is ' + str(self.file_type) + ' which I cannot understand (right now).')
             self.valid_cnv = False
+            self._add_timing('total', t_init, nbytes = self.file_size)
             return
 
 
@@ -430,221 +816,375 @@ class pycnv(object):
 
         # Trying to extract standard names (p, C, S, T, oxy ... ) from
         # the channel names
+        t0 = time.perf_counter()
         self._get_standard_channel_names(naming_rules)
+        self._add_timing('standard_names', t0, nrows = len(self.channels))
 
-        self._get_data(raw)
         # Check if we are in the Baltic Sea
         if(baltic == None):
             self.baltic = check_baltic(self.lon,self.lat)
         else:
             self.baltic = baltic
-            
-        nrec           = numpy.shape(self.raw_data)[0]
+
+        self._baltic_arg  = baltic
+        self.bin_size     = bin_size
+        self.bin_variable = bin_variable
+        self.bin_offset   = bin_offset
+        self.bin_derived  = bin_derived
+        self.bin_cast     = bin_cast
+        self._sample_num  = None
+        self._segments    = {}
         self.units     = {}
         self.names     = {}
         self.names_std = {}
         self.units_std = {}  
+        self.cdata     = {}
+        self._cdata_computed = False # cdata contains the derived data of the whole cast
+        self.cunits    = {}
+        self.cnames    = {}
+        for n,c in enumerate(self.channels):
+            self.names[c['name']] = c['long_name']
+            self.units[c['name']] = c['unit']
+            self.names_std[c['name_std']] = c['name']
+            self.units_std[c['name_std']] = c['unit']
+
+        if(only_metadata):
+            raw.close()
+            self.valid_cnv = True
+            self._add_timing('total', t_init, nbytes = self.file_size)
+            return
+
+        t0 = time.perf_counter()
+        self._get_data(raw)
+        raw.close()
+        self._add_timing('data', t0, nbytes = max(self.file_size - len(self.header), 0), nrows = self.ndata)
         # Check if the dimensions are right
         if(numpy.shape(self.raw_data)[0] > 0):
             if( numpy.shape(self.raw_data)[1] == len(self.channels) ):
-                self.data = {}
-                # Make a recarray out of the array
-                names   = []
-                formats = []
-                titles  = []
                 # Name the columns after the channel names
-                for n,c in enumerate(self.channels):
-                    names.append(c['name'])
-                    formats.append('float')
-                    titles.append(c['name_std'])
-                    self.data[c['name']]  = self.raw_data[:,n]
-                    #if(c['name_std'] not in ('i' + str(c['index']))):
-                    #   self.data[c[name_std]]  = self.raw_data[:,n]
-                    if(c['name_std'] != None):
-                        self.data[c['name_std']]  = self.raw_data[:,n]
-                    self.names[c['name']] = c['long_name']
-                    self.units[c['name']] = c['unit']
-                    self.names_std[c['name_std']] = c['name']
-                    self.units_std[c['name_std']] = c['unit']
-
-
-                # Compute absolute salinity and potential density with the gsw toolbox
-                # check if we have enough data to compute
-                self.cdata  = {}
-                self.cunits = {}
-                self.cnames = {}
-                try:
-                    self.data['C0']
-                    self.data['T0']
-                    self.data['p']
-                    FLAG_COMPUTE0 = True # If we have the basic parameter to derive salinity, denisty, N2 ...
-                except:
-                    FLAG_COMPUTE0 = False
+                self.data = self._get_data_dict(self.raw_data)
+                if(bin_size is not None and (bin_derived == 'after' or not(compute_cdata))):
+                    self._bin_data()
+                if(compute_cdata):
+                    self._cdata_computed = True
+                    # Compute the time as a datetime
+                    self._compute_date()
+                    # Compute absolute salinity and potential density with the gsw toolbox
+                    compdata = self._compute_cdata(self.data)
+                    self.cdata.update(compdata[0])
+                    self.cunits.update(compdata[1])
+                    self.cnames.update(compdata[2])
+                if(bin_size is not None and bin_derived == 'before' and compute_cdata):
+                    self._bin_data()
+                    self._compute_date()
+                # Add standard names directly to object
+                self._set_standard_names()
+            else:
+                logger.warning('Different number of columns in data section as defined in header, this is bad ...')
+        else:
+            logger.warning('No data in file')
+            
+            
+        self.valid_cnv = True
+        self._add_timing('total', t_init, nbytes = self.file_size)
 
-                try:
-                    self.data['C1']
-                    self.data['T1']
-                    self.data['p']
-                    FLAG_COMPUTE1 = True
-                except:
-                    FLAG_COMPUTE1 = False
+    def _add_timing(self, stage, t0, nbytes = 0, nrows = 0):
+        """ Adds the wall time since t0 (time.perf_counter()), the bytes and the rows processed to the stage in self.timings, stages called several times (e.g. compute_data for both sensor pairs) are summed up
 
+        Args:
+           stage: Name of the stage, e.g. 'data'
+           t0: Start of the stage (time.perf_counter())
+           nbytes: Number of bytes processed
+           nrows: Number of rows (lines or samples) processed
+        """
+        dt = time.perf_counter() - t0
+        timings = self.__dict__.get('timings')
+        if(timings is None): # Objects restored from old caches
+            timings = self.timings = {}
+        timing = timings.get(stage)
+        if(timing is None):
+            timings[stage] = {'time':dt,'bytes':nbytes,'rows':nrows,'calls':1}
+        else:
+            timing['time']  += dt
+            timing['bytes'] += nbytes
+            timing['rows']  += nrows
+            timing['calls'] += 1
 
-                # Compute the time as a datetime
-                print('Date')
-                self._compute_date()                    
-                if FLAG_COMPUTE0:
-                    if(not((self.lon == numpy.NaN) or (self.lat == numpy.NaN))):
-                        compdata    = self._compute_data(self.data, self.units_std, self.names_std, baltic=baltic,lon=self.lon, lat=self.lat,isen='0')
-                    else:
-                        compdata    = self._compute_data(self.data, self.units_std, self.names_std, baltic=baltic,isen = '0')
+    def _get_data_dict(self,raw_data):
+        """ Returns a dictionary with the columns of raw_data (as views) named after the channel names and the standard names
+        """
+        data = {}
+        for n,c in enumerate(self.channels):
+            data[c['name']]  = raw_data[:,n]
+            if(c['name_std'] != None):
+                data[c['name_std']]  = raw_data[:,n]
 
+        return data
 
-                    self.cdata.update(compdata[0])
+    def _get_depth(self,p):
+        """ Computes the depth [m] from the pressure p [dbar] using the latitude of the cast (0 if unknown)
+        """
+        lat = self.lat
+        if(lat is None or not(numpy.isfinite(lat))):
+            logger.debug('No latitude, computing depth with latitude 0')
+            lat = 0.0
 
-                    self.cunits.update(compdata[1])
-                    self.cnames.update(compdata[2])
-                else:
-                    logger.debug('Not computing data using the gsw toolbox, as we dont have the three standard parameters (C0,T0,p0)')
-                # Compute second sensor pair
-                if FLAG_COMPUTE1:
-                    if(not((self.lon == numpy.NaN) or (self.lat == numpy.NaN))):
-                        compdata    = self._compute_data(self.data, self.units_std, self.names_std, baltic=baltic,lon=self.lon, lat=self.lat,isen='1')
-                    else:
-                        compdata    = self._compute_data(self.data,self.units_std, self.names_std, baltic=baltic,isen = '0')
-                        
-                    self.cdata.update(compdata[0])
-                        
-                    self.cunits.update(compdata[1])
-                    self.cnames.update(compdata[2])
-                else:
-                    logger.debug('Not computing data using the gsw toolbox, as we dont have the three standard parameters (C1,T1,p)')
-                # Add standard names directly to object
-                try:                
-                    self.p = self.data['p']
-                    self.p_unit = self.units_std['p']
-                except:
-                    pass
+        gsw = _import_gsw()
+        return -gsw.z_from_p(numpy.asarray(p, dtype = float), lat)
 
-                try:                                  
-                    self.C = self.data['C0']
-                    self.C_unit = self.units_std['C0']
-                except:
-                    pass
+    def _bin_data(self):
+        """ Bin averages raw_data, data and cdata of the part of the cast self.bin_cast ('down', 'up' or None for all samples) with respect to self.bin_variable (see bin_average()), cdata['nbin'] is the number of samples in each bin and cdata['bin_center'] the center of the bins
+        """
+        if(self.bin_variable in self.data):
+            x    = self.data[self.bin_variable]
+            unit = self.units.get(self.bin_variable, self.units_std.get(self.bin_variable))
+        elif(self.bin_variable == 'depth' and 'p' in self.data):
+            x    = self._get_depth(self.data['p'])
+            unit = 'm'
+        else:
+            logger.warning('Bin variable ' + str(self.bin_variable) + ' not found, data is not binned')
+            return
 
-                try:                                    
-                    self.T = self.data['T0']
-                    self.T_unit = self.units_std['T0']
-                except:
-                    pass
+        t0    = time.perf_counter()
+        nall  = len(self.raw_data)
+        start = 0
+        stop  = nall
+        if(self.bin_cast is not None):
+            segment = self.get_cast_segments()[self.bin_cast]
+            if(segment is None):
+                logger.warning('Did not find the ' + str(self.bin_cast) + 'cast, binning all samples')
+            else:
+                start, stop = segment
+
+        nsample     = stop - start
+        ind, center = get_bin_index(x[start:stop], self.bin_size, self.bin_offset)
+        nbin        = len(center)
+        self.raw_data = bin_mean(self.raw_data[start:stop], ind, nbin)
+        self.data     = self._get_data_dict(self.raw_data)
+        # The segments of the unbinned data are not valid anymore
+        self._segments = {}
+        # The mean sample number of each bin (to compute dates based on the time interval)
+        self._sample_num = bin_mean(numpy.arange(start, stop), ind, nbin)
+        cdata = {}
+        # Variables between two samples (N2) are averaged over the pairs within one bin
+        ind_mid = numpy.where(ind[:-1] == ind[1:], ind[:-1], -1)
+        for key in self.cdata:
+            if(key == 'date'):
+                continue
+            if(len(self.cdata[key]) == nall):
+                cdata[key] = bin_mean(self.cdata[key][start:stop], ind, nbin)
+            elif(len(self.cdata[key]) == nall - 1):
+                cdata[key] = bin_mean(self.cdata[key][start:stop - 1], ind_mid, nbin)
+
+        cdata['nbin']       = numpy.bincount(ind[ind >= 0], minlength = nbin)
+        cdata['bin_center'] = center
+        self.cdata = cdata
+        self.cunits['nbin']       = ''
+        self.cnames['nbin']       = 'Number of samples in bin'
+        self.cunits['bin_center'] = '' if unit is None else unit
+        self.cnames['bin_center'] = 'Center of bin of ' + str(self.bin_variable)
+        logger.debug('Binned ' + str(nsample) + ' samples (' + str(self.bin_cast) + ') into ' + str(nbin) + ' bins of ' + str(self.bin_variable))
+        self._add_timing('bin', t0, nrows = nsample)
+
+    def _compute_cdata(self,data,lon=None,lat=None):
+        """ Computes all derived data of the data dictionary, i.e. the gsw properties of both sensor pairs, a copy of the pressure and oxygen in umol/l
 
-                try:                                    
-                    self.SP = self.cdata['SP00']
-                    self.SP_unit = self.cunits['SP00']
-                except:
-                    pass
+        Args:
+           data: Data dictionary
+           lon, lat: Position used for the gsw functions, None for the position of the cast
+        Returns:
+           list [cdata,cunits,cnames]
+        """
+        cdata  = {}
+        cunits = {}
+        cnames = {}
+        # check if we have enough data to compute
+        try:
+            data['C0']
+            data['T0']
+            data['p']
+            FLAG_COMPUTE0 = True # If we have the basic parameter to derive salinity, denisty, N2 ...
+        except:
+            FLAG_COMPUTE0 = False
 
-                try:                                    
-                    self.SA = self.cdata['SA00']
-                    self.SA_unit = self.cunits['SA00']
-                except:
-                    pass
+        try:
+            data['C1']
+            data['T1']
+            data['p']
+            FLAG_COMPUTE1 = True
+        except:
+            FLAG_COMPUTE1 = False
+
+        baltic = self._baltic_arg
+        if(lon is None):
+            lon = self.lon
+        if(lat is None):
+            lat = self.lat
+        if FLAG_COMPUTE0:
+            if(not((lon == numpy.NaN) or (lat == numpy.NaN))):
+                compdata    = self._compute_data(data, self.units_std, self.names_std, baltic=baltic,lon=lon, lat=lat,isen='0')
+            else:
+                compdata    = self._compute_data(data, self.units_std, self.names_std, baltic=baltic,isen = '0')
 
-                try:                                    
-                    self.CT = self.cdata['CT00']
-                    self.CT_unit = self.cunits['CT00']
-                except:
-                    pass
 
-                try:                                    
-                    self.pt = self.cdata['pt00']
-                    self.pt_unit = self.cunits['pt00']
-                except:
-                    pass                                
+            cdata.update(compdata[0])
 
-                try:                                    
-                    self.pot_rho = self.cdata['pot_rho00']
-                    self.pot_rho_unit = self.cunits['pot_rho00']
-                except:
-                    pass                                                
+            cunits.update(compdata[1])
+            cnames.update(compdata[2])
+        else:
+            logger.debug('Not computing data using the gsw toolbox, as we dont have the three standard parameters (C0,T0,p0)')
+        # Compute second sensor pair
+        if FLAG_COMPUTE1:
+            if(not((lon == numpy.NaN) or (lat == numpy.NaN))):
+                compdata    = self._compute_data(data, self.units_std, self.names_std, baltic=baltic,lon=lon, lat=lat,isen='1')
+            else:
+                compdata    = self._compute_data(data,self.units_std, self.names_std, baltic=baltic,isen = '0')
                 
-                # Add pressure for convenience to cdata
-                try:
-                    self.data['p']
-                    FLAG_HAS_P = True
-                except:
-                    FLAG_HAS_P = False
-
-                if FLAG_HAS_P:
-                    self.cdata['p'] = self.data['p'][:]
-                    self.cunits['p'] = self.units_std['p']
-                    self.cnames['p'] = self.names_std['p']
-                # Add oxygen in umol/l to cdata
-                if True:    
-                    oxyfac    = 1e3  / 22.391
-                    oxy_names = ['oxy0','oxy1']
-                    for noxy,oxy_name in enumerate(oxy_names):
-                        if(oxy_name in self.names_std.keys()):
-                            logger.debug('Found ' + oxy_name + ' channel, checking  unit')
-                            try:
-                                oxyunit = self.units_std[oxy_name].upper()
-                            except:
-                                oxyunit = None
-                            if(oxyunit == 'ML/L'):
-                                logger.debug('Found ' + oxy_name + ' channel, unit is ml/l converting to umol/l')
-                                self.cdata[oxy_name] = self.data[oxy_name][:]  * oxyfac 
-                                self.cunits[oxy_name] = 'umol/l'
-                                self.cnames[oxy_name] = self.names_std[oxy_name]
-                                if(noxy == 0):
-                                    self.oxy = self.cdata[oxy_name]
-                                    self.oxy_unit = self.cunits[oxy_name]
-                            else:
-                                logger.debug('Found ' + str(oxy_name) + ' channel, with unknown unit:' + str(oxyunit))
-                                
+            cdata.update(compdata[0])
                 
-            else:
-                logger.warning('Different number of columns in data section as defined in header, this is bad ...')
+            cunits.update(compdata[1])
+            cnames.update(compdata[2])
         else:
-            logger.warning('No data in file')
-            
-            
-        self.valid_cnv = True
+            logger.debug('Not computing data using the gsw toolbox, as we dont have the three standard parameters (C1,T1,p)')
+
+        # Add pressure for convenience to cdata
+        try:
+            data['p']
+            FLAG_HAS_P = True
+        except:
+            FLAG_HAS_P = False
+
+        if FLAG_HAS_P:
+            cdata['p'] = data['p'][:]
+            cunits['p'] = self.units_std['p']
+            cnames['p'] = self.names_std['p']
+        # Add oxygen in umol/l to cdata
+        if True:    
+            oxyfac    = 1e3  / 22.391
+            oxy_names = ['oxy0','oxy1']
+            for noxy,oxy_name in enumerate(oxy_names):
+                if(oxy_name in self.names_std.keys()):
+                    logger.debug('Found ' + oxy_name + ' channel, checking  unit')
+                    try:
+                        oxyunit = self.units_std[oxy_name].upper()
+                    except:
+                        oxyunit = None
+                    if(oxyunit == 'ML/L'):
+                        logger.debug('Found ' + oxy_name + ' channel, unit is ml/l converting to umol/l')
+                        cdata[oxy_name] = data[oxy_name][:]  * oxyfac 
+                        cunits[oxy_name] = 'umol/l'
+                        cnames[oxy_name] = self.names_std[oxy_name]
+                    else:
+                        logger.debug('Found ' + str(oxy_name) + ' channel, with unknown unit:' + str(oxyunit))
+
+        return [cdata,cunits,cnames]
+
+    def _set_standard_names(self):
+        """ Adds the standard parameters (p, C, T, SP, SA, CT, pt, pot_rho, oxy) directly to the object
+        """
+        try:                
+            self.p = self.data['p']
+            self.p_unit = self.units_std['p']
+        except:
+            pass
+
+        try:                                  
+            self.C = self.data['C0']
+            self.C_unit = self.units_std['C0']
+        except:
+            pass
+
+        try:                                    
+            self.T = self.data['T0']
+            self.T_unit = self.units_std['T0']
+        except:
+            pass
+
+        try:                                    
+            self.SP = self.cdata['SP00']
+            self.SP_unit = self.cunits['SP00']
+        except:
+            pass
+
+        try:                                    
+            self.SA = self.cdata['SA00']
+            self.SA_unit = self.cunits['SA00']
+        except:
+            pass
+
+        try:                                    
+            self.CT = self.cdata['CT00']
+            self.CT_unit = self.cunits['CT00']
+        except:
+            pass
+
+        try:                                    
+            self.pt = self.cdata['pt00']
+            self.pt_unit = self.cunits['pt00']
+        except:
+            pass                                
+
+        try:                                    
+            self.pot_rho = self.cdata['pot_rho00']
+            self.pot_rho_unit = self.cunits['pot_rho00']
+        except:
+            pass                                                
+
+        try:
+            self.oxy = self.cdata['oxy0']
+            self.oxy_unit = self.cunits['oxy0']
+        except:
+            pass
 
     def _compute_date(self):
         """Checks if the data['timeM'] exists and self.date, if yes compute
         the time of each measurement
 
         """
-        print('Computing date')
+        t0   = time.perf_counter()
+        date = self._get_dates(self.data)
+        if(date is not None):
+            self.cdata.update({'date':date})
+        self._add_timing('compute_date', t0, nrows = 0 if date is None else len(date))
+
+    def _get_dates(self,data,offset=0):
+        """Computes the date of each measurement in data based on
+        data['timeM'], data['timeS'] or the start_date and the time interval
+
+        Args:
+           data: Data dictionary
+           offset: Index of the first measurement in data (if data is only a part of the file)
+        Returns:
+           date: Array of datetime objects, None if the date cannot be computed
+        """
+        logger.debug('Computing date')
         # Try first with timeM
         try:
-            self.data['timeM']
+            data['timeM']
             self.date
             date = []
-            for m in self.data['timeM']:
+            for m in data['timeM']:
                 dt = datetime.timedelta(minutes=m)
                 date.append(self.date + dt)
                 
             date = numpy.asarray(date)
-            self.cdata.update({'date':date})
             logger.info('Dates computed based on timeM')            
-            return
+            return date
         except:
             logger.warning('Could not compute datetime dates based on timeM')
 
         # Now try with timeS
         try:
-            self.data['timeS']
+            data['timeS']
             self.date
             date = []
-            for m in self.data['timeS']:
+            for m in data['timeS']:
                 dt = datetime.timedelta(seconds=m)
                 date.append(self.date + dt)
                 
             date = numpy.asarray(date)
-            self.cdata.update({'date':date})
             logger.info('Dates computed based on timeS')
-            return
+            return date
         except:
             logger.warning('Could not compute datetime dates based on timeS')            
             
@@ -652,20 +1192,20 @@ class pycnv(object):
         try:
             date = []
             dt = self.interval_dt
-            for m in range(self.ndata):
+            ndata = len(next(iter(data.values())))
+            if(self._sample_num is None):
+                samples = range(offset, offset + ndata)
+            else: # Binned data
+                samples = self._sample_num[offset:offset + ndata]
+            for m in samples:
                 date.append(self.start_date + m*dt)   
                 
-            self.cdata.update({'date':date})
             logger.info('Dates computed based on start_date and time_interval')
-            return
+            return date
         except:
             logger.warning('Could not compute datetime dates based on start_date and time_interval')
 
-            
-            
-            
-            
-        
+        return None
             
     def _compute_data(self,data, units, names, p_ref = 0, baltic = False, lon=0, lat=0, isen = '0'):
         """ Computes convservative temperature, absolute salinity and potential density from input data, expects a recarray with the following entries data['C']: conductivity in mS/cm, data['T']: in Situ temperature in degree Celsius (ITS-90), data['p']: in situ sea pressure in dbar
@@ -678,6 +1218,8 @@ class pycnv(object):
         Returns:
            list [cdata,cunits,cnames] with cdata: recarray with entries 'SP', 'SA', 'pot_rho', etc., cunits: dictionary with units, cnames: dictionary with names 
         """
+        t0  = time.perf_counter()
+        gsw = _import_gsw()
         sen = isen + isen
         # Check for units and convert them if neccessary
         if(units['C' + isen] == 'S/m'):
@@ -718,6 +1260,7 @@ class pycnv(object):
                             }
        
         cunits = {'SA' + sen:'g/kg','SP' + sen:'PSU','pot_rho' + sen:'kg/m^3' ,'CT' + sen:'deg C','pt' + sen:'deg C','N2' + sen: '1/s^2','pN2' + sen: 'dbar'}
+        self._add_timing('compute_data', t0, nrows = len(SP))
         
         return [cdata,cunits,cnames]
     
@@ -913,8 +1456,7 @@ class pycnv(object):
         """
         Look through a list of rules to try to link names to standard names
         """
-        f = open(naming_rules)
-        rules = yaml.safe_load(f)
+        rules = load_naming_rules(naming_rules)
         for r in rules['names']:
             found = False
             #logger.debug('Looking for rule for ' + r['description'])
@@ -962,7 +1504,160 @@ class pycnv(object):
             
         self.raw_data = numpy.asarray(data)
 
+    def iter_raw_data(self,chunksize=65536):
+        """ Reads the data section of the file in chunks, without keeping the whole file in memory (e.g. for large mooring files opened with only_metadata=True). Lines which cannot be converted or have a different number of columns than channels are skipped.
+
+        Args:
+           chunksize: Number of lines read at once
+        Returns:
+           Generator yielding numpy arrays of shape (nlines,nchannels)
+        """
+        ncols = len(self.channels)
+        with open(self.filename, "r",encoding=self.encoding) as raw:
+            for l in raw:
+                if("*END*" in l):
+                    break
+
+            while True:
+                lines = list(itertools.islice(raw, chunksize))
+                if(len(lines) == 0):
+                    break
+
+                # Fast path, all lines are complete
+                try:
+                    block = numpy.array(' '.join(lines).split(),dtype='float')
+                    if(len(block) == len(lines) * ncols):
+                        yield block.reshape((len(lines),ncols))
+                        continue
+                except ValueError:
+                    pass
+
+                block = []
+                for l in lines:
+                    try:
+                        ldata = numpy.asarray(l.split(),dtype='float')
+                        if(len(ldata) == ncols):
+                            block.append(ldata)
+                    except Exception as e:
+                        logger.warning('Could not convert data to floats in line:' + l)
+
+                if(len(block) > 0):
+                    yield numpy.asarray(block)
+
         
+    def get_cast_segments(self, window = 25, min_range = 2.0):
+        """
+        Finds the soak, the downcast and the upcast of the cast in the pressure (see get_segments()). The downcast is the descending segment with the largest pressure range, the upcast the ascending segment following it and the soak everything before the downcast (e.g. the soak at the surface and the ascent before the cast)
+        Args:
+           window: Smoothing window of the pressure [samples]
+           min_range: Minimum pressure change between two turning points [dbar]
+        Returns:
+           Dictionary with 'soak', 'down' and 'up', each [start, stop] of the samples or None if not existing
+        """
+        key = (window, min_range)
+        if(key in self._segments):
+            return self._segments[key]
+
+        cast_segments = {'soak':None, 'down':None, 'up':None}
+        if(self.data is not None and 'p' in self.data):
+            segments = get_segments(self.data['p'], window, min_range)
+            ps       = smooth(self.data['p'], window)
+            idown    = None
+            for i,seg in enumerate(segments):
+                if(seg[2] == 1 and (idown is None or ps[seg[1] - 1] - ps[seg[0]] > ps[segments[idown][1] - 1] - ps[segments[idown][0]])):
+                    idown = i
+
+            if(idown is not None):
+                cast_segments['down'] = segments[idown][:2]
+                if(segments[idown][0] > 0):
+                    cast_segments['soak'] = [0, segments[idown][0]]
+                if(idown + 1 < len(segments) and segments[idown + 1][2] == -1):
+                    cast_segments['up'] = segments[idown + 1][:2]
+
+        self._segments[key] = cast_segments
+        return cast_segments
+
+    def get_profiles(self, window = 25, min_range = 5.0, min_fraction = 0.25, multi_only = False, multi_fraction = 0.5):
+        """
+        Splits a file with several profiles (e.g. tow-yo sections or profiling moorings) into the individual down- and upcasts (see get_segments()). Segments with a pressure range smaller than min_fraction of the largest range are ignored. Everything before the first downcast with a pressure range of at least multi_fraction of the largest downcast is ignored as well (the soak, e.g. down to 10 m and back to the surface before a 30 m cast, see get_cast_segments()).
+        Args:
+           window: Smoothing window of the pressure [samples]
+           min_range: Minimum pressure change between two turning points [dbar]
+           min_fraction: Minimum pressure range of a profile relative to the largest profile
+           multi_only: Return an empty list if the file is a single cast, i.e. it has less than two downcasts with a pressure range of at least multi_fraction of the largest downcast
+           multi_fraction: Minimum pressure range of a downcast relative to the largest downcast to be counted as a profile (and not e.g. as the soak)
+        Returns:
+           profiles: List of pycnv_view objects with kind 'down' or 'up' and the profile number profile (1 ... number of profiles), the position of each profile is taken from the lat/lon channels if available
+        """
+        key = ('profiles', window, min_range, min_fraction, multi_fraction)
+        if(key not in self._segments):
+            profiles = []
+            ndown    = 0
+            if(self.data is not None and 'p' in self.data):
+                segments = get_segments(self.data['p'], window, min_range)
+                ps       = smooth(self.data['p'], window)
+                prange   = numpy.asarray([abs(ps[seg[1] - 1] - ps[seg[0]]) for seg in segments])
+                down     = [i for i,seg in enumerate(segments) if seg[2] == 1]
+                if(len(down) > 0):
+                    # Only casts comparable to the largest downcast are counted, the segments before the first one are the soak
+                    comparable = [i for i,seg in enumerate(segments) if seg[2] != 0 and prange[i] >= multi_fraction * prange[down].max()]
+                    ndown      = sum([segments[i][2] == 1 for i in comparable])
+                    for seg,r in zip(segments[comparable[0]:], prange[comparable[0]:]):
+                        if(seg[2] != 0 and r >= min_fraction * prange.max()):
+                            profiles.append(seg)
+
+            self._segments[key] = [profiles, ndown]
+
+        profiles, ndown = self._segments[key]
+        if(multi_only and ndown < 2):
+            return []
+
+        views = []
+        for i,seg in enumerate(profiles):
+            view = pycnv_view(self, seg[0], seg[1], 'down' if seg[2] == 1 else 'up')
+            view.profile = i + 1
+            views.append(view)
+
+        return views
+
+    def _get_position(self, i):
+        """ Returns the position [lon, lat] at sample i interpolated from the lat/lon channels, the position of the cast if not available
+        """
+        if(self.data is None or not('lat' in self.data and 'lon' in self.data)):
+            return [self.lon, self.lat]
+
+        pos = []
+        for key in ('lon','lat'):
+            x    = self.data[key]
+            good = numpy.flatnonzero(numpy.isfinite(x))
+            if(len(good) == 0):
+                return [self.lon, self.lat]
+            pos.append(float(numpy.interp(i, good, x[good])))
+
+        return pos
+
+    def _get_segment_view(self, name, window, min_range):
+        segment = self.get_cast_segments(window, min_range)[name]
+        if(segment is None):
+            return None
+
+        return pycnv_view(self, segment[0], segment[1], name)
+
+    def downcast(self, window = 25, min_range = 2.0):
+        """ Returns the downcast as a pycnv_view, None if not found, see get_cast_segments()
+        """
+        return self._get_segment_view('down', window, min_range)
+
+    def upcast(self, window = 25, min_range = 2.0):
+        """ Returns the upcast as a pycnv_view, None if not found, see get_cast_segments()
+        """
+        return self._get_segment_view('up', window, min_range)
+
+    def soak(self, window = 25, min_range = 2.0):
+        """ Returns the samples before the downcast as a pycnv_view, None if not found, see get_cast_segments()
+        """
+        return self._get_segment_view('soak', window, min_range)
+
     def get_info_dict(self):
         """ Returns a dictionary with the essential information
         """
@@ -979,6 +1674,33 @@ class pycnv(object):
         info_dict['type'] = 'CNV'        
         return info_dict
 
+    def get_sample_data(self, variables = None):
+        """
+        Returns the variables defined for each measurement, i.e. the channels with a standard name (data) and the computed data (cdata) of the same length, without the date
+        Args:
+           variables: List of standard names to be returned, None for all
+        Returns:
+           Dictionary with the standard name as key and (values, unit, long_name) as item
+        """
+        sample_data = {}
+        if(self.data is None):
+            return sample_data
+
+        n = len(self.raw_data)
+        for c in self.channels:
+            if(c['name_std'] is not None):
+                sample_data[c['name_std']] = (self.data[c['name_std']], c['unit'], c['long_name'])
+
+        for key in self.cdata:
+            if(key == 'date' or key in sample_data or numpy.shape(self.cdata[key])[0] != n):
+                continue
+            sample_data[key] = (self.cdata[key], self.cunits.get(key), self.cnames.get(key))
+
+        if(variables is not None):
+            sample_data = {key:sample_data[key] for key in variables if key in sample_data}
+
+        return sample_data
+
     def get_summary(self,header=False):
         """
         Returns a summary of the cnv file in a csv format
@@ -1063,7 +1785,7 @@ class pycnv(object):
         rstr += '#Structure:\n'
         rstr += '#Index,name, long_name, unit (as in cnv file):\n'        
         for n,var in enumerate(self.cdata.keys()):
-            rstr += var + ';' + self.cnames[var] + ';' + self.cunits[var] + '\n'
+            rstr += var + ';' + str(self.cnames.get(var, '')) + ';' + str(self.cunits.get(var, '')) + '\n'
 
         return rstr
     
@@ -1072,7 +1794,7 @@ class pycnv(object):
     #
     def plot(self,xaxis=['CT00','SA00','oxy0','pot_rho00'],xlims=None,colors=None,
          yaxis='p',ylim=None,show=False,save=False,figsize=[8.27,11.69],fig_prefix
-             = './',figure=None):
+             = './',figure=None,decimate=True):
     #def plot(self,xaxis=['CT00','pot_rho00'],yaxis='p',show=True,save=True):
         """ Plots the data in the cnv file using matplotlib
         Arguments:
@@ -1086,8 +1808,46 @@ class pycnv(object):
            figsize: The size of the figure plotted
            fig_prefix: The prefix put before the figname (this can be a folder together with a file prefix)
            figure: Matplotlib figure for plotting, if None pl.figure() is called
+           decimate: Plot only the minimum and maximum of buckets of samples, the number of buckets is given by the size of the axes in pixels (see decimate_minmax())
 
         """
+        ax_dict = self._get_plot_data(xaxis,xlims,colors,yaxis,ylim)
+        if ax_dict is None:
+            return
+
+        pl = _import_pylab()
+        # Check if we got a figure a function argument
+        if figure == None:
+            fig = pl.figure()
+        else:
+            fig = figure
+        # Set the size to din A4
+        fig.set_size_inches(figsize)
+        #ax = pl.subplot(1,1,1)
+        ax = fig.add_subplot(1,1,1)
+        self.figures.append(fig)
+        ax_dict['figure'] = fig
+        ax_dict['axes']   = [ax]
+        ax_dict['decimate'] = decimate
+
+        # Bookkeeping of all the settings of the plotting axes
+        self.axes.append(ax_dict)
+        # Drawing the data
+        self._draw_data(ax_dict)
+        
+        if save:
+            fig_name_final = self._get_figure_name(ax_dict['x_axis'],fig_prefix)
+            logger.info('Saving file to file: ' + fig_name_final)
+            fig.savefig(fig_name_final)
+
+        if show:
+            pl.show()
+
+    def _get_plot_data(self,xaxis,xlims=None,colors=None,yaxis='p',ylim=None):
+        """ Collects the data, names, units, colors and limits to plot for plot() and _draw_data()
+        Returns:
+           Dictionary with the settings of the plotting axes (without figure and axes) or None if no data was found
+        """
         # Looking for data for y-axis
         try:
             y_data = self.cdata[yaxis]
@@ -1102,7 +1862,7 @@ class pycnv(object):
                 logger.debug('plot():Found y-axis data (data):' + yaxis)
             except Exception as e:
                 logger.warning('plot():Did not find valid y-axis:' + yaxis)
-                return
+                return None
 
         # Looking for data for x-axis
         x_data       = []
@@ -1161,47 +1921,37 @@ class pycnv(object):
         # Check if we have data to plot
         if len(x_data) == 0:
             logger.warning('plot():Did not find valid x-data:')
-            return
+            return None
 
-        # Check if we got a figure a function argument
-        if figure == None:
-            fig = pl.figure()
-        else:
-            fig = figure
-        # Set the size to din A4
-        fig.set_size_inches(figsize)
-        #ax = pl.subplot(1,1,1)
-        ax = fig.add_subplot(1,1,1)
-        self.figures.append(fig)
-        ax_dict = {'figure':fig,'axes':[ax],'x_data':x_data,'x_names':x_names,'x_units':x_units,'y_data':y_data,'y_names':y_names,'y_units':y_units,'x_colors':x_colors,'x_lims':x_lims,'y_lim':ylim}
+        ax_dict = {'x_data':x_data,'x_names':x_names,'x_units':x_units,'y_data':y_data,'y_names':y_names,'y_units':y_units,'x_colors':x_colors,'x_lims':x_lims,'y_lim':ylim,'x_axis':xaxis_found}
+        return ax_dict
 
-        # Bookkeeping of all the settings of the plotting axes
-        self.axes.append(ax_dict)
-        # Drawing the data
-        self._draw_data(ax_dict)
-        
-        if save:
-            base_name = os.path.basename(self.filename)
-            dstr = self.date.strftime('%Y-%m-%d_%H.%M.%S')        
-            fig_name  = dstr + '_' + base_name
+    def _get_figure_name(self,xaxis,fig_prefix='./',fig_format='pdf'):
+        """ Returns the filename of a saved figure: fig_prefix, date, name of the cnv file, profile number of multi-profile files and the plotted variables
+        """
+        base_name = os.path.basename(self.filename)
+        if self.date is not None:
+            dstr = self.date.strftime('%Y-%m-%d_%H.%M.%S')
+        else:
+            dstr = 'NaT'
+        fig_name  = dstr + '_' + base_name
+        if getattr(self,'profile',0) > 0:
+            fig_name += '_profile' + str(self.profile)
 
-            varstr = ''
-            for dat_plot in xaxis_found:
-                varstr += '_' + dat_plot
+        varstr = ''
+        for dat_plot in xaxis:
+            varstr += '_' + dat_plot
                 
-            #varstr += '_'
-            poststr = '.pdf'
-            fig_name_final = fig_prefix + fig_name + varstr + poststr
-            logger.info('Saving file to file: ' + fig_name_final)
-            pl.savefig(fig_name_final)
-
-        if show:
-            pl.show()
+        #varstr += '_'
+        poststr = '.' + fig_format
+        fig_name_final = fig_prefix + fig_name + varstr + poststr
+        return fig_name_final
 
     def _get_colors(self,names,colors=None):
         """ Function to define a color for the given name
         """
-        cmap = pl.cm.Set1
+        cm = _import_cm()
+        cmap = cm.Set1
         plot_colors = [None]*len(names)
         # The different data types shall have different colors
         data_types  = {'salt':['SA','SP','sal'],'temp':['CT','T','pt'],'dens':['pot_rho','sigma'],'oxy':['sbeox','oxy']}
@@ -1225,14 +1975,14 @@ class pycnv(object):
                             col = data_colors[data_type].pop()
                         else:
                             num_col +=1
-                            col = pl.cm.Set1(num_col)
+                            col = cm.Set1(num_col)
                             
                         plot_colors[n] = col
                         break
 
             if(plot_colors == None):
                 num_col +=1
-                col = pl.cm.Set1(num_col)                
+                col = cm.Set1(num_col)                
                 plot_colors[n] = col
         
 
@@ -1255,6 +2005,7 @@ the spines of the additional axes such that all ticks are visible
         ydata  = data['y_data']
         ylim   = data['y_lim']
         naxes  = len(xdata)
+        data['lines'] = []
 
         # Get the position of the axes
         posx = ax.get_position().get_points()[:,0]
@@ -1333,12 +2084,12 @@ the spines of the additional axes such that all ticks are visible
             axtmp = data['axes'][i]
             if ylim is None:
                 axtmp.invert_yaxis()
-                ind = range(0,len(ydata))
             else:
                 axtmp.set_ylim(ylim)
-                ind = (ydata >= min(ylim)) & (ydata <= max(ylim))
-                
+
+            ind = self._get_plot_indices(data,i,axtmp)
             pltmp = axtmp.plot(xdata[i][ind],ydata[ind],color=xcolors[i])
+            data['lines'].append(pltmp[0])
 
             if xlims[i] is not None:
                 #print('ranges!')
@@ -1354,15 +2105,44 @@ the spines of the additional axes such that all ticks are visible
         # Plotting the title
         
         axtmp = data['axes'][0]
-        fs = axtmp.xaxis.get_major_ticks()[0].label.get_fontsize() # Get the fontsize of the ticks
-        title_str = ''
-        title_str += self.filename + '\n'
-        title_str += self.date.strftime('%Y-%m-%d %H:%M:%S') + '; ' 
-        title_str += "{:6.3f}".format(self.lat) + 'N; ' + "{:6.3f}".format(self.lon) + 'E'
-        axtmp.text(.5,top_space,title_str,ha='center',transform=fig.transFigure,fontsize=fs+2)
+        fs = axtmp.xaxis.get_major_ticks()[0].label1.get_fontsize() # Get the fontsize of the ticks
+        title_str = self._get_plot_title()
+        data['title'] = axtmp.text(.5,top_space,title_str,ha='center',transform=fig.transFigure,fontsize=fs+2)
         #self._update_plot_style(data)
 
 
+    def _get_plot_indices(self,data,i,ax):
+        """ Returns the indices of the samples of x-data i to plot: The samples within ylim, decimated with decimate_minmax() to the resolution of the axes if data['decimate'] is True
+        """
+        ydata = numpy.asarray(data['y_data'])
+        ylim  = data['y_lim']
+        if ylim is None:
+            ind = numpy.arange(len(ydata))
+        else:
+            ind = numpy.flatnonzero((ydata >= min(ylim)) & (ydata <= max(ylim)))
+
+        if data.get('decimate',False):
+            nbuckets = get_plot_buckets(ax)
+            ind_dec  = decimate_minmax(numpy.asarray(data['x_data'][i])[ind],ydata[ind],nbuckets)
+            logger.debug('_get_plot_indices(): Plotting ' + str(len(ind_dec)) + ' of ' + str(len(ind)) + ' samples')
+            ind = ind[ind_dec]
+
+        return ind
+
+    def _get_plot_title(self):
+        """ Returns the title of a plot: filename, date and position
+        """
+        title_str = ''
+        title_str += self.filename + '\n'
+        if self.date is not None:
+            title_str += self.date.strftime('%Y-%m-%d %H:%M:%S') + '; ' 
+        else:
+            title_str += 'NaT; '
+        lat = numpy.nan if self.lat is None else self.lat
+        lon = numpy.nan if self.lon is None else self.lon
+        title_str += "{:6.3f}".format(lat) + 'N; ' + "{:6.3f}".format(lon) + 'E'
+        return title_str
+
     def add_sensor(self,sensor, name, data = None, description=None, unit=None):
         """Adds data from an additional sensor to the object, this is
         e.g. used for external sensor attached to the CTD frame but
@@ -1403,10 +2183,110 @@ the spines of the additional axes such that all ticks are visible
             self.external_sensors[sensor]['units'][name] = 'unknown'
 
 
-    def write_nc(self,filename):
-        """ Writes a netCDF4 file of the current pycnv object
+    def write_nc(self,filename,**kwargs):
+        """ Writes a CF compliant netCDF4 file of the current pycnv object, see pycnv_netcdf.write_nc() for the arguments. Use pycnv_netcdf.write_nc_stream() for files too large for the memory.
+        """
+        from .pycnv_netcdf import write_nc
+        write_nc(self,filename,**kwargs)
+
+    def to_dataframe(self,**kwargs):
+        """ Returns the data as pandas DataFrame without copying the columns, see pycnv_frame.to_dataframe() for the arguments
+        """
+        from .pycnv_frame import to_dataframe
+        return to_dataframe(self,**kwargs)
+
+    def to_xarray(self,**kwargs):
+        """ Returns the data as xarray Dataset without copying the variables, see pycnv_frame.to_xarray() for the arguments
+        """
+        from .pycnv_frame import to_xarray
+        return to_xarray(self,**kwargs)
+
+    def _get_meta(self, header = True):
+        """ Returns a dictionary with all attributes except the data (raw_data, data, cdata and the standard names), the segments and the plotting state, see _set_meta()
+
+        Args:
+           header: Include the header string (an empty string otherwise)
+        """
+        meta = {}
+        for key in self.__dict__:
+            if(key in _meta_exclude):
+                continue
+            meta[key] = self.__dict__[key]
+
+        if(not(header) and 'header' in meta):
+            meta['header'] = ''
+
+        meta['_has_data'] = getattr(self, 'data', None) is not None
+        return meta
+
+    def _set_meta(self, meta, raw_data = None, cdata = None):
+        """ Restores the object from the attributes of _get_meta(), raw_data and cdata, the data dictionary and the standard names are rebuilt as views of raw_data. The custom header parsing function is not restored (set to parse_iow_header)
+
+        Args:
+           meta: Dictionary returned by _get_meta()
+           raw_data: The raw data array (None for objects without data)
+           cdata: The cdata dictionary
+        """
+        meta = dict(meta)
+        has_data = meta.pop('_has_data', False)
+        self.__dict__.update(meta)
+        self.parse_custom_header = parse_iow_header
+        self.figures   = []
+        self.axes      = []
+        self._segments = {}
+        self.data      = None
+        if(raw_data is not None):
+            self.raw_data = raw_data
+        if(cdata is not None):
+            self.cdata = cdata
+        if(has_data and raw_data is not None):
+            self.data = self._get_data_dict(raw_data)
+            self._set_standard_names()
+
+    def __getstate__(self):
+        """ Pickling support, raw_data is pickled once and data, the standard names and cdata entries which are columns of raw_data (e.g. p) are rebuilt as views when unpickled. The dates of cdata are pickled as int64 microseconds. The plotting state, the segments and the custom header parsing function are not pickled.
+        """
+        state    = self._get_meta()
+        raw_data = getattr(self, 'raw_data', None)
+        if(raw_data is not None):
+            raw_data = numpy.ascontiguousarray(raw_data)
+        cdata    = {}
+        columns  = {}
+        for key, value in getattr(self, 'cdata', {}).items():
+            if(key == 'date'):
+                us, tz = dates_to_us(value)
+                cdata[key] = us
+                state['_date_tz'] = tz
+                continue
+            if(raw_data is not None and isinstance(value, numpy.ndarray) and numpy.shares_memory(value, self.raw_data)):
+                for n in range(numpy.shape(self.raw_data)[1]):
+                    column = self.raw_data[:,n]
+                    if(value.__array_interface__ == column.__array_interface__):
+                        columns[key] = n
+                        break
+                if(key in columns):
+                    continue
+            cdata[key] = value
+
+        state['_raw_data']      = raw_data
+        state['_cdata']         = cdata
+        state['_cdata_columns'] = columns
+        return state
+
+    def __setstate__(self, state):
+        """ Restores an object pickled with __getstate__()
         """
-        print('write_nc() not implemented yet! Sorry for that ...',filename)
+        state    = dict(state)
+        raw_data = state.pop('_raw_data', None)
+        cdata    = state.pop('_cdata', {})
+        columns  = state.pop('_cdata_columns', {})
+        tz       = state.pop('_date_tz', None)
+        if('date' in cdata):
+            cdata['date'] = us_to_dates(cdata['date'], tz)
+        for key, n in columns.items():
+            cdata[key] = raw_data[:,n]
+        # Invalid cnv files have no cdata
+        self._set_meta(state, raw_data, cdata if 'cunits' in state else None)
 
         
     def __str__(self):
@@ -1421,9 +2301,245 @@ the spines of the additional axes such that all ticks are visible
         return rstr        
             
           
+class pycnv_view(object):
+    """
+
+    A part of a cast (e.g. the downcast or one profile of a yo-yo) of
+    a pycnv object. raw_data and data are views of the data of the
+    cast, lon/lat is the position and date the date of the first
+    sample (see get_profiles()). The derived data (cdata) is taken
+    from the cast if computed or otherwise computed only for the
+    samples of the view when it is first used. The standard names
+    (p, T, C, SP, SA, CT, pt, pot_rho, oxy) are available as for
+    pycnv.
+
+    Usage:
+       >>>cnv = pycnv(filename, compute_cdata = False)
+       >>>down = cnv.downcast()
+       >>>down.CT
+
+    Args:
+       cnv: The pycnv object
+       start: First sample
+       stop: Last sample + 1
+       kind: Name of the part, e.g. 'down'
+
+    """
+    _std_cdata = ('SP','SA','CT','pt','pot_rho','oxy')
+
+    def __init__(self, cnv, start, stop, kind = ''):
+        self.cnv       = cnv
+        self.start     = start
+        self.stop      = stop
+        self.kind      = kind
+        self.profile   = 0
+        self.valid_cnv = True
+        self.filename  = cnv.filename
+        self.file_type = cnv.file_type
+        self.header    = cnv.header
+        self.sha1      = cnv.sha1
+        self.channels  = cnv.channels
+        self.units     = cnv.units
+        self.names     = cnv.names
+        self.units_std = cnv.units_std
+        self.names_std = cnv.names_std
+        self.baltic    = cnv.baltic
+        self.lon, self.lat = cnv._get_position(start)
+        if(hasattr(cnv, 'iow')):
+            self.iow   = cnv.iow
+        self.raw_data  = cnv.raw_data[start:stop]
+        self.data      = cnv._get_data_dict(self.raw_data)
+        self._cdata    = None
+        self._cunits   = None
+        self._cnames   = None
+        for name, name_std in (('p','p'), ('C','C0'), ('T','T0')):
+            if(name_std in self.data):
+                setattr(self, name, self.data[name_std])
+                setattr(self, name + '_unit', self.units_std[name_std])
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getstate__(self):
+        """ Pickling support, only the cast and the position of the view are pickled, the views and cdata are rebuilt when unpickled
+        """
+        return {'cnv':self.cnv, 'start':self.start, 'stop':self.stop, 'kind':self.kind, 'profile':self.profile, 'lon':self.lon, 'lat':self.lat}
+
+    def __setstate__(self, state):
+        self.__init__(state['cnv'], state['start'], state['stop'], state['kind'])
+        self.profile = state['profile']
+        self.lon     = state['lon']
+        self.lat     = state['lat']
+
+    def _compute(self):
+        """ Slices the cdata of the cast or computes it for the samples of the view if the cast was read with compute_cdata = False, the columns of the cast (e.g. nbin and bin_center of binned data) are sliced in both cases
+        """
+        cnv    = self.cnv
+        n      = len(cnv.raw_data)
+        cdata  = {}
+        cunits = dict(cnv.cunits)
+        cnames = dict(cnv.cnames)
+        for key in cnv.cdata:
+            if(len(cnv.cdata[key]) == n):
+                cdata[key] = cnv.cdata[key][self.start:self.stop]
+            elif(len(cnv.cdata[key]) == n - 1): # Between two samples (N2)
+                cdata[key] = cnv.cdata[key][self.start:self.stop - 1]
+
+        # Objects pickled before _cdata_computed existed
+        if(not(cnv.__dict__.get('_cdata_computed', len(cnv.cdata) > 0))):
+            logger.debug('Computing cdata of samples ' + str(self.start) + ' to ' + str(self.stop))
+            date = cnv._get_dates(self.data, offset = self.start)
+            if(date is not None):
+                cdata['date'] = date
+            compdata = cnv._compute_cdata(self.data, self.lon, self.lat)
+            cdata.update(compdata[0])
+            cunits.update(compdata[1])
+            cnames.update(compdata[2])
+
+        self._cunits = cunits
+        self._cnames = cnames
+        self._cdata  = cdata
+        pycnv._set_standard_names(self)
+
+    @property
+    def cdata(self):
+        if(self._cdata is None):
+            self._compute()
+        return self._cdata
+
+    @property
+    def cunits(self):
+        if(self._cdata is None):
+            self._compute()
+        return self._cunits
+
+    @property
+    def cnames(self):
+        if(self._cdata is None):
+            self._compute()
+        return self._cnames
+
+    @property
+    def date(self):
+        """ The date of the first sample of the view, the date of the cast if not available
+        """
+        if('date' in self.cdata and len(self.cdata['date']) > 0):
+            return self.cdata['date'][0]
+        return self.cnv.date
+
+    get_info_dict     = pycnv.get_info_dict
+    get_summary       = pycnv.get_summary
+    get_sample_data   = pycnv.get_sample_data
+    get_variables     = pycnv.get_variables
+    to_dataframe      = pycnv.to_dataframe
+    to_xarray         = pycnv.to_xarray
+    _get_plot_data    = pycnv._get_plot_data
+    _get_colors       = pycnv._get_colors
+    _draw_data        = pycnv._draw_data
+    _get_plot_title   = pycnv._get_plot_title
+    _get_plot_indices = pycnv._get_plot_indices
+    _get_figure_name  = pycnv._get_figure_name
+
+    def __getattr__(self, name):
+        # The derived standard names are set when cdata is computed
+        if(name.split('_unit')[0] in self._std_cdata and '_cdata' in self.__dict__ and self._cdata is None):
+            self._compute()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def __str__(self):
+        return 'pycnv_view of ' + self.filename + ' (' + self.kind + ', profile ' + str(self.profile) + ', samples ' + str(self.start) + ' to ' + str(self.stop) + ')'
+
+
 def test_pycnv():
     pycnv("/home/holterma/data/redox_drive/iow_data/fahrten.2011/06EZ1108.DTA/vCTD/DATA/cnv/0001_01.cnv")
 
+def expand_filenames(patterns):
+    """
+    Expands a list of filenames and glob patterns (e.g. cruise/*.cnv) into a list of files in a stable order, the matches of a pattern are sorted, files given twice are only listed once. Filenames without a match are kept (to report them as missing).
+    Args:
+       patterns: List of filenames and/or patterns
+    Returns:
+       List of filenames
+    """
+    import glob
+    filenames = []
+    found     = set()
+    for pattern in patterns:
+        if(glob.has_magic(pattern)):
+            matches = sorted(glob.glob(pattern, recursive = True))
+            if(len(matches) == 0):
+                logger.warning('No files found for ' + pattern)
+        else:
+            matches = [pattern]
+        for f in matches:
+            if(f not in found):
+                found.add(f)
+                filenames.append(f)
+
+    return filenames
+
+
+def format_timings(timings, title = None):
+    """
+    Formats stage timings (pycnv.timings or the 'stages' of pycnv_sum_folder.get_timing_statistics()) as a table with the wall time, the fraction of the total time, the bytes and rows processed and the throughput of each stage
+    Args:
+       timings: Dictionary of stages with 'time', 'bytes' and 'rows'
+       title: First line of the table (None for no title)
+    Returns:
+       String
+    """
+    if('total' in timings):
+        total = timings['total']['time']
+    else:
+        total = sum(t['time'] for t in timings.values())
+
+    lines = []
+    if(title is not None):
+        lines.append(title)
+    lines.append('{:>16s} {:>10s} {:>6s} {:>12s} {:>10s} {:>10s} {:>12s}'.format('stage','time [s]','[%]','bytes','MB/s','rows','rows/s'))
+    for stage, t in timings.items():
+        dt   = t['time']
+        frac = 100.0 * dt / total if total > 0 else numpy.NaN
+        mbs  = t['bytes'] / dt / 1e6 if(dt > 0 and t['bytes'] > 0) else numpy.NaN
+        rows = t['rows'] / dt if(dt > 0 and t['rows'] > 0) else numpy.NaN
+        lines.append('{:>16s} {:10.4f} {:6.1f} {:12d} {:10.1f} {:10d} {:12.0f}'.format(stage, dt, frac, int(t['bytes']), mbs, int(t['rows']), rows))
+
+    return '\n'.join(lines)
+
+
+def _process_file(args):
+    """ Parses one file for main() and creates the requested output
+    Returns:
+       [filename, output, error]: The output is a list of (kind, string), error is None if successful and otherwise the error message
+    """
+    filename, kwargs, variables, summary_header, summary, plot, timings = args
+    try:
+        cnv = pycnv(filename, **kwargs)
+        if(not(cnv.valid_cnv)):
+            return [filename, None, 'Not a valid cnv file']
+        output = []
+        if(variables):
+            output.append(('variables', cnv.get_variables()))
+        if(summary_header):
+            output.append(('summary_header', cnv.get_summary(header=True)))
+        if(summary):
+            output.append(('summary', cnv.get_summary()))
+        if(plot is not None):
+            if(plot['save'] and not(plot['show'])):
+                # Figures which are only saved are plotted with the reused figure of this process
+                from .pycnv_plot import get_plotter
+                get_plotter(xaxis = plot['xaxis'], fig_prefix = plot['fig_prefix']).plot(cnv)
+            else:
+                cnv.plot(**plot)
+        if(timings):
+            output.append(('timings', format_timings(cnv.timings, title = 'Timings of ' + filename)))
+    except Exception as e:
+        return [filename, None, str(e)]
+
+    return [filename, output, None]
+
+
 # Main function
 def main():
     sum_help         = 'Gives a csv compatible summary'
@@ -1431,6 +2547,11 @@ def main():
     plot_prefix_help = 'The prefix before the filename, standars is "./", this is usefule to define a path and/or a fie prefix, e.g. --plot_prefix figures/ctd_casts_of_important_cruise__'
     var_help         = 'Lists all the available variables within the file, separated between the orignal data within the file (data) and the computed data (cdata)'        
     sumhead_help     = 'Gives the header to the csv compatible summary'
+    timings_help     = 'Prints the wall time, the bytes and the rows processed by each stage of reading the file (hashing, header parsing, reading the data, computing the date and the gsw data)'
+    bin_help         = 'Bin average the data, e.g. --bin 1 p (1 dbar bins), --bin 0.5 depth or --bin 10 timeS'
+    bin_cast_help    = 'The part of the cast which is bin averaged: down (default, the downcast), up (the upcast) or all (all samples, e.g. for time series --bin 10 timeS --bin_cast all)'
+    jobs_help        = 'Number of worker processes parsing the files, the output is given in the order of the files'
+    file_help        = 'The cnv file(s), glob patterns (e.g. "cruise/**/*.cnv") are expanded'
     parser = argparse.ArgumentParser()
     parser.add_argument('--variables', '-va', action='store_true', help=var_help)    
     parser.add_argument('--summary', '-s', action='store_true', help=sum_help)
@@ -1438,10 +2559,14 @@ def main():
     #https://stackoverflow.com/questions/13346540/argparse-optional-argument-before-positional-argument    
     parser.add_argument('--plot', '-p', nargs='?', help=plot_help)
     parser.add_argument('--plot_prefix', '-pre', nargs='?', help=plot_prefix_help)    
+    parser.add_argument('--bin', '-b', nargs=2, metavar=('bin size','bin variable'), help=bin_help)
+    parser.add_argument('--bin_cast', choices=['down','up','all'], default='down', help=bin_cast_help)
+    parser.add_argument('--jobs', '-j', type=int, default=1, help=jobs_help)
+    parser.add_argument('--timings', action='store_true', help=timings_help)
     parser.add_argument('--verbose', '-v', action='count')
     #parser.add_argument('--version', action='store_true')
     parser.add_argument('--version', action='version', version='%(prog)s ' + version)
-    parser.add_argument('filename')    
+    parser.add_argument('filename', nargs='+', help=file_help)
     args = parser.parse_args()
     
     if(args.verbose == None):
@@ -1457,32 +2582,22 @@ def main():
     logger.setLevel(loglevel)
 
 
-    filename = args.filename
+    filenames = expand_filenames(args.filename)
 
     print_summary = args.summary
     print_summary_header = args.summary_header
     
-    if(filename != None):
-        cnv = pycnv(filename,verbosity=loglevel)
+    if(args.bin != None):
+        bin_size     = float(args.bin[0])
+        bin_variable = args.bin[1]
     else:
-        #logger.critical('Need a filename')
-        print(parser.print_help())
-
-
-    if(args.variables):
-        summary = cnv.get_variables()
-        print(summary)
-
-    if(print_summary_header):
-        summary = cnv.get_summary(header=True)
-        print(summary)
-    if(print_summary):
-        summary = cnv.get_summary()
-        print(summary)
+        bin_size     = None
+        bin_variable = 'p'
 
     #
     # Plot the file
     #
+    plot = None
     if(args.plot != None):
         FLAG_SHOW = False
         FLAG_SAVE = False
@@ -1500,9 +2615,45 @@ def main():
         else:
             plot_prefix = args.plot_prefix
 
-        cnv.plot(xaxis=variables_plot,show=FLAG_SHOW,save=FLAG_SAVE,fig_prefix=plot_prefix)
+        plot = {'xaxis':variables_plot,'show':FLAG_SHOW,'save':FLAG_SAVE,'fig_prefix':plot_prefix}
+        if(FLAG_SHOW and args.jobs > 1):
+            logger.warning('Figures can only be shown without worker processes, using -j 1')
+            args.jobs = 1
+
+    bin_cast = None if args.bin_cast == 'all' else args.bin_cast
+    kwargs = {'verbosity':loglevel,'bin_size':bin_size,'bin_variable':bin_variable,'bin_cast':bin_cast}
+    tasks  = [(f, kwargs, args.variables, print_summary_header, print_summary, plot, args.timings) for f in filenames]
+    nfail  = 0
+    header = False
+    pool  = None
+    if(args.jobs > 1 and len(tasks) > 1):
+        from multiprocessing import Pool
+        pool    = Pool(min(args.jobs, len(tasks)))
+        results = pool.imap(_process_file, tasks)
+    else:
+        results = map(_process_file, tasks)
 
-            
+    try:
+        for filename, output, error in results:
+            if(error is not None):
+                logger.error(filename + ': ' + error)
+                nfail += 1
+                continue
+            for kind, out in output:
+                # The summary header is printed only once
+                if(kind == 'summary_header'):
+                    if(header):
+                        continue
+                    header = True
+                print(out)
+    finally:
+        if(pool is not None):
+            pool.close()
+            pool.join()
+
+    if(nfail > 0):
+        logger.error('Could not process ' + str(nfail) + ' of ' + str(len(tasks)) + ' files')
+        sys.exit(1)
 
 
 #pc = pycnv("/home/holterma/data/redox_drive/iow_data/fahrten.2011/06EZ1108.DTA/vCTD/DATA/cnv/0001_01.cnv")
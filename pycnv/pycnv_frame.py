@@ -0,0 +1,176 @@
+#
+# pandas and xarray accessors of pycnv objects
+#
+import re
+import sys
+import datetime
+import logging
+import numpy
+from .pycnv import dates_to_us
+
+# Setup logging module
+logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+logger = logging.getLogger('pycnv_frame')
+
+
+def _import_pandas():
+    """ Imports pandas, which is only needed for to_dataframe()
+    """
+    try:
+        import pandas
+    except ImportError:
+        raise ImportError('to_dataframe() needs the pandas package (pip install pandas)')
+
+    return pandas
+
+
+def _import_xarray():
+    """ Imports xarray, which is only needed for to_xarray()
+    """
+    try:
+        import xarray
+    except ImportError:
+        raise ImportError('to_xarray() needs the xarray package (pip install xarray)')
+
+    return xarray
+
+
+def get_columns(cnv, std_names = True, cdata = True):
+    """
+    Returns the channels and the derived data of a cast with the same length as the channels (N2 and the date are not included) without copying them
+    Args:
+       cnv: pycnv or pycnv_view object
+       std_names: Name the channels after their standard name if available (e.g. p, T0, C0), otherwise after the channel name
+       cdata: Include the derived data
+    Returns:
+       List of (name, values, unit, long_name)
+    """
+    columns = []
+    if(cnv.data is None):
+        return columns
+
+    used = set()
+    for c in cnv.channels:
+        name = c['name']
+        if(std_names and c['name_std'] is not None):
+            name = c['name_std']
+        if(name in used):
+            continue
+        used.add(name)
+        columns.append((name, cnv.data[c['name']], c['unit'], c['long_name']))
+
+    if(cdata):
+        n = len(cnv.raw_data)
+        for key in cnv.cdata:
+            if(key == 'date' or key in used or numpy.shape(cnv.cdata[key])[0] != n):
+                continue
+            used.add(key)
+            columns.append((key, numpy.asarray(cnv.cdata[key]), cnv.cunits.get(key), cnv.cnames.get(key)))
+
+    return columns
+
+
+def get_time(cnv):
+    """
+    Returns the dates of cdata as datetime64[us] array (UTC) or None if not available
+    """
+    if(cnv.data is None or 'date' not in cnv.cdata):
+        return None
+
+    us, tz = dates_to_us(cnv.cdata['date'])
+    if(tz is not None and len(us) > 0):
+        # Wall time of the timezone to UTC
+        offset = cnv.cdata['date'][0].utcoffset()
+        if(offset is not None):
+            us = us - offset // datetime.timedelta(microseconds = 1)
+
+    return us.astype('datetime64[us]')
+
+
+def get_attributes(cnv, header = False):
+    """
+    Returns the metadata of a cast (file, sha1, date, position and the parsed header information of iow and seabird_meta) as a dictionary of strings and numbers
+    Args:
+       cnv: pycnv or pycnv_view object
+       header: Include the full header string
+    Returns:
+       Dictionary
+    """
+    attrs = {}
+    attrs['cnv_file']      = cnv.filename
+    attrs['cnv_sha1']      = str(cnv.sha1)
+    attrs['cnv_file_type'] = str(cnv.file_type).strip()
+    attrs['baltic']        = int(cnv.baltic)
+    attrs['lon']           = numpy.nan if cnv.lon is None else float(cnv.lon)
+    attrs['lat']           = numpy.nan if cnv.lat is None else float(cnv.lat)
+    attrs['profile']       = int(getattr(cnv, 'profile', 0))
+    if(cnv.date is not None):
+        attrs['cnv_date'] = cnv.date.strftime('%Y-%m-%d %H:%M:%S')
+    for prefix, meta in (('iow_', getattr(cnv, 'iow', {})), ('seabird_', getattr(cnv, 'seabird_meta', {}))):
+        for key in meta:
+            attrs[prefix + re.sub('[^A-Za-z0-9_]', '_', key)] = str(meta[key])
+
+    if(header):
+        attrs['cnv_header'] = cnv.header
+
+    return attrs
+
+
+def to_dataframe(cnv, std_names = True, cdata = True, header = False):
+    """
+    Returns the data of a cast as pandas DataFrame. The columns wrap the arrays of data and cdata without copying them, the index is the time of each measurement (datetime64, UTC) if available, otherwise the sample number. The units and long names are stored in df.attrs['units'] and df.attrs['long_names'], the metadata of the cast (see get_attributes()) in df.attrs.
+    Args:
+       cnv: pycnv or pycnv_view object
+       std_names: Name the channels after their standard name, see get_columns()
+       cdata: Include the derived data
+       header: Include the full header string in attrs
+    Returns:
+       pandas.DataFrame
+    """
+    pandas  = _import_pandas()
+    columns = get_columns(cnv, std_names, cdata)
+    time    = get_time(cnv)
+    if(time is not None):
+        index = pandas.DatetimeIndex(time, name = 'time').tz_localize('UTC')
+    else:
+        n     = 0 if cnv.data is None else len(cnv.raw_data)
+        index = pandas.RangeIndex(n, name = 'sample')
+
+    df = pandas.DataFrame({c[0]:c[1] for c in columns}, index = index, copy = False)
+    df.attrs.update(get_attributes(cnv, header))
+    df.attrs['units']      = {c[0]:c[2] for c in columns}
+    df.attrs['long_names'] = {c[0]:c[3] for c in columns}
+    return df
+
+
+def to_xarray(cnv, std_names = True, cdata = True, header = False):
+    """
+    Returns the data of a cast as xarray Dataset with the dimension time (datetime64, UTC) if available, otherwise sample. The variables wrap the arrays of data and cdata without copying them and have the attributes units and long_name, the metadata of the cast (see get_attributes()) are the attributes of the dataset.
+    Args:
+       cnv: pycnv or pycnv_view object
+       std_names: Name the channels after their standard name, see get_columns()
+       cdata: Include the derived data
+       header: Include the full header string in the attributes
+    Returns:
+       xarray.Dataset
+    """
+    xarray  = _import_xarray()
+    columns = get_columns(cnv, std_names, cdata)
+    time    = get_time(cnv)
+    coords  = {}
+    if(time is not None):
+        dim = 'time'
+        coords['time'] = ('time', time)
+    else:
+        dim = 'sample'
+
+    data_vars = {}
+    for name, values, unit, long_name in columns:
+        attrs = {}
+        if(unit is not None):
+            attrs['units'] = unit
+        if(long_name is not None):
+            attrs['long_name'] = long_name
+        data_vars[name] = xarray.Variable(dim, values, attrs = attrs)
+
+    return xarray.Dataset(data_vars, coords = coords, attrs = get_attributes(cnv, header))
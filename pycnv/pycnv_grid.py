@@ -0,0 +1,187 @@
+#
+# Interpolation of many casts onto a common vertical grid
+#
+import os
+import sys
+import logging
+import numpy
+from multiprocessing.pool import ThreadPool
+from .pycnv_sum_folder import iter_casts
+
+# Setup logging module
+logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+logger = logging.getLogger('pycnv_grid')
+
+
+def _get_variable(cnv, name):
+    """ Returns the data (data or cdata) of the variable name of a cast as float array, depth is computed from pressure if not available, None if not existing
+    """
+    if(cnv.data is None):
+        return None
+    if(name in cnv.data):
+        return numpy.asarray(cnv.data[name], dtype = float)
+    if(name in cnv.cdata and name != 'date'):
+        return numpy.asarray(cnv.cdata[name], dtype = float)
+    if(name == 'depth' and 'p' in cnv.data):
+        return cnv._get_depth(cnv.data['p'])
+
+    return None
+
+
+def interp_sorted(x, offsets, y, grid):
+    """
+    Linear interpolation of many casts at once. The casts are concatenated in x and y, the start of cast i is offsets[i] and its end is offsets[i+1], x needs to be sorted increasing within each cast. The grid points are located in all casts with one lexsort, grid points outside of the range of a cast are NaN.
+    Args:
+       x: Concatenated axis data of all casts (e.g. pressure), sorted within each cast
+       offsets: Array of length ncast + 1 with the start indices of the casts in x
+       y: List of concatenated data to be interpolated, each with the same length as x
+       grid: The grid to interpolate onto (nlevel)
+    Returns:
+       List of arrays with the shape (ncast, nlevel), one for each y
+    """
+    x       = numpy.asarray(x, dtype = float)
+    offsets = numpy.asarray(offsets, dtype = int)
+    grid    = numpy.asarray(grid, dtype = float)
+    ncast   = len(offsets) - 1
+    nlevel  = len(grid)
+    nx      = len(x)
+    out     = [numpy.full((ncast, nlevel), numpy.nan) for i in range(len(y))]
+    if(ncast == 0 or nx == 0 or nlevel == 0):
+        return out
+
+    # Cast number of each sample and of each grid point
+    cast_x = numpy.repeat(numpy.arange(ncast), numpy.diff(offsets))
+    cast_g = numpy.repeat(numpy.arange(ncast), nlevel)
+    grid_g = numpy.tile(grid, ncast)
+    # Sort samples and grid points together by cast and axis, samples
+    # first for equal values, the number of samples before a grid point
+    # gives the last sample <= the grid point
+    key_cast = numpy.concatenate((cast_x, cast_g))
+    key_x    = numpy.concatenate((x, grid_g))
+    key_type = numpy.concatenate((numpy.zeros(nx, dtype = numpy.int8), numpy.ones(len(grid_g), dtype = numpy.int8)))
+    order    = numpy.lexsort((key_type, key_x, key_cast))
+    nbefore  = numpy.cumsum(key_type[order] == 0)
+    ind_g    = numpy.empty(len(grid_g), dtype = int)
+    ind_g[order[key_type[order] == 1] - nx] = nbefore[key_type[order] == 1] - 1
+
+    start = offsets[cast_g]
+    end   = offsets[cast_g + 1]
+    # Grid points within the range of the cast, casts with one sample are
+    # only defined at the sample itself
+    valid = (end > start)
+    valid[valid] = (grid_g[valid] >= x[start[valid]]) & (grid_g[valid] <= x[end[valid] - 1])
+    j0    = numpy.clip(ind_g[valid], start[valid], numpy.maximum(end[valid] - 2, start[valid]))
+    j1    = numpy.minimum(j0 + 1, end[valid] - 1)
+    dx    = x[j1] - x[j0]
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        w = numpy.where(dx > 0, (grid_g[valid] - x[j0]) / dx, 0.0)
+
+    ind_valid = numpy.flatnonzero(valid)
+    for i,yi in enumerate(y):
+        yi = numpy.asarray(yi, dtype = float)
+        out[i].ravel()[ind_valid] = yi[j0] + w * (yi[j1] - yi[j0])
+
+    return out
+
+
+def _interp_chunk(casts, grid, variables, axis, kwargs):
+    """ Interpolates a list of casts, returns the gridded variables and the cast metadata
+    """
+    x_all   = []
+    y_all   = [[] for v in variables]
+    offsets = [0]
+    meta    = []
+    for cnv in iter_casts(casts, **kwargs):
+        x = _get_variable(cnv, axis) if cnv.valid_cnv else None
+        if(x is None):
+            x = numpy.zeros(0)
+            ys = [numpy.zeros(0) for v in variables]
+        else:
+            ys = []
+            for v in variables:
+                yv = _get_variable(cnv, v)
+                ys.append(numpy.full(len(x), numpy.nan) if yv is None else yv)
+            # Remove invalid axis data and sort the cast along the axis
+            good = numpy.flatnonzero(numpy.isfinite(x))
+            ind  = good[numpy.argsort(x[good], kind = 'stable')]
+            x    = x[ind]
+            ys   = [yv[ind] for yv in ys]
+
+        x_all.append(x)
+        for i,yv in enumerate(ys):
+            y_all[i].append(yv)
+        offsets.append(offsets[-1] + len(x))
+        meta.append((cnv.filename, cnv.lon, cnv.lat, cnv.date))
+
+    x_all = numpy.concatenate(x_all) if len(x_all) > 0 else numpy.zeros(0)
+    y_all = [numpy.concatenate(yv) if len(yv) > 0 else numpy.zeros(0) for yv in y_all]
+    return interp_sorted(x_all, offsets, y_all, grid), meta
+
+
+def interp_casts(casts, grid, variables = ['SA00','CT00'], axis = 'p', nthreads = None, chunksize = 64, **kwargs):
+    """
+    Interpolates many casts onto a common vertical grid. For each variable a (ncast, nlevel) array is allocated once and filled chunk by chunk, each chunk of casts is interpolated at once with interp_sorted(). Grid points outside of the range of a cast, as well as variables not existing in a cast, are NaN. The casts are sorted along the axis before the interpolation, up- and downcast are therefore merged. The chunks are processed by a pool of threads, cnv files given as filenames are also read within the threads.
+    Args:
+       casts: The dictionary returned by get_all_valid_files() (see iter_casts()), a list of pycnv objects or a list of cnv filenames
+       grid: The vertical grid (e.g. numpy.arange(0,245,0.25))
+       variables: List of the variables of data or cdata to be interpolated
+       axis: The variable of the vertical axis, e.g. 'p' or 'depth' (computed from p if not existing)
+       nthreads: Number of threads, None for the number of CPUs, 1 for no threads
+       chunksize: Number of casts interpolated at once
+       **kwargs: Passed to pycnv() if files are read, e.g. baltic, naming_rules
+    Returns:
+       Dictionary with the gridded variables (ncast, nlevel), 'grid', and 'files', 'lon', 'lat', 'date' of the casts
+
+    Usage:
+       >>>cnv_data = get_all_valid_files('cruise/', station = [20.0,54.0,5000])
+       >>>gridded = interp_casts(cnv_data, numpy.arange(0,245,0.25), variables = ['SA00','CT00'])
+       >>>gridded['CT00'].shape
+    """
+    if(isinstance(casts, dict)):
+        files    = casts['files']
+        profiles = casts.get('profile', [0] * len(files))
+        ncast    = len(files)
+    else:
+        casts    = list(casts)
+        ncast    = len(casts)
+
+    grid   = numpy.asarray(grid, dtype = float)
+    kwargs.setdefault('verbosity', logging.CRITICAL)
+    if(nthreads is None):
+        nthreads = os.cpu_count() or 1
+
+    gridded = {}
+    for v in variables:
+        gridded[v] = numpy.full((ncast, len(grid)), numpy.nan)
+    gridded['grid'] = grid
+    gridded['files'] = [None] * ncast
+    gridded['lon']   = numpy.full(ncast, numpy.nan)
+    gridded['lat']   = numpy.full(ncast, numpy.nan)
+    gridded['date']  = [None] * ncast
+
+    if(isinstance(casts, dict)):
+        chunks = [(i, {'files':files[i:i + chunksize], 'profile':profiles[i:i + chunksize]}) for i in range(0, ncast, chunksize)]
+    else:
+        chunks = [(i, casts[i:i + chunksize]) for i in range(0, ncast, chunksize)]
+    def work(chunk):
+        i0, chunk_casts = chunk
+        out, meta = _interp_chunk(chunk_casts, grid, variables, axis, kwargs)
+        i1 = i0 + len(meta)
+        for v,o in zip(variables, out):
+            gridded[v][i0:i1] = o
+        for i,(f, lon, lat, date) in enumerate(meta):
+            gridded['files'][i0 + i] = f
+            gridded['lon'][i0 + i]   = numpy.nan if lon is None else lon
+            gridded['lat'][i0 + i]   = numpy.nan if lat is None else lat
+            gridded['date'][i0 + i]  = date
+
+        logger.debug('Interpolated casts ' + str(i0) + ' to ' + str(i1))
+
+    if(nthreads > 1 and len(chunks) > 1):
+        with ThreadPool(min(nthreads, len(chunks))) as pool:
+            pool.map(work, chunks)
+    else:
+        for chunk in chunks:
+            work(chunk)
+
+    return gridded
@@ -0,0 +1,436 @@
+#
+# netCDF output of pycnv objects
+#
+import os
+import re
+import sys
+import datetime
+import logging
+import numpy
+from .pycnv import pycnv, version
+from .pycnv_stations import get_station_index
+from .pycnv_sum_folder import iter_casts
+
+# Setup logging module
+logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+logger = logging.getLogger('pycnv_netcdf')
+
+time_units = 'seconds since 1970-01-01 00:00:00 UTC'
+
+# CF standard names of the pycnv standard names
+cf_standard_names = {'p':'sea_water_pressure',
+                     'T':'sea_water_temperature',
+                     'C':'sea_water_electrical_conductivity',
+                     'SP':'sea_water_practical_salinity',
+                     'SA':'sea_water_absolute_salinity',
+                     'CT':'sea_water_conservative_temperature',
+                     'pt':'sea_water_potential_temperature',
+                     'pot_rho':'sea_water_potential_density',
+                     'N2':'square_of_brunt_vaisala_frequency_in_sea_water',
+                     'oxy':'mole_concentration_of_dissolved_molecular_oxygen_in_sea_water'}
+
+# udunits compatible units of the units used in cnv files and by pycnv
+cf_units = {'db':'dbar','dbar':'dbar','deg c':'degree_Celsius','its-90, deg c':'degree_Celsius',
+            'ipts-68, deg c':'degree_Celsius','ms/cm':'mS cm-1','s/m':'S m-1','psu':'1',
+            'g/kg':'g kg-1','kg/m^3':'kg m-3','umol/l':'umol L-1','ml/l':'mL L-1',
+            '1/s^2':'s-2','seconds':'s','minutes':'min'}
+
+
+def _import_netcdf4():
+    """ Imports netCDF4, which is only needed for the netCDF output
+    """
+    try:
+        import netCDF4
+    except ImportError:
+        raise ImportError('netCDF output needs the netCDF4 package (pip install netCDF4)')
+
+    return netCDF4
+
+
+def _nc_name(name, used):
+    """ Creates a valid and unique netCDF variable name from a cnv channel name (e.g. sbeox0ML/L -> sbeox0ML_L)
+    """
+    ncname = re.sub('[^A-Za-z0-9_]', '_', name)
+    if(len(ncname) == 0 or not(ncname[0].isalpha())):
+        ncname = 'v' + ncname
+
+    ncname_base = ncname
+    i = 1
+    while ncname in used:
+        ncname = ncname_base + '_' + str(i)
+        i += 1
+
+    used.add(ncname)
+    return ncname
+
+
+def _cf_attributes(name_std, unit, long_name):
+    """ Returns the CF attributes (standard_name, units, long_name) of a variable
+    """
+    attrs = {}
+    if(long_name is not None):
+        attrs['long_name'] = long_name
+    if(unit is not None):
+        attrs['units'] = cf_units.get(unit.strip().lower(), unit)
+        if(attrs['units'] != unit):
+            attrs['cnv_unit'] = unit
+    if(name_std is not None):
+        # Remove the sensor numbers (T0, SA00, pot_rho11 ...)
+        name_base = name_std.rstrip('0123456789')
+        if(name_base in cf_standard_names):
+            attrs['standard_name'] = cf_standard_names[name_base]
+
+    return attrs
+
+
+def dates_to_num(dates):
+    """
+    Converts datetime objects into seconds since 1970-01-01 UTC (see time_units), naive datetimes are treated as UTC
+    Args:
+       dates: List or array of datetime objects
+    Returns:
+       Array of floats, NaN for None
+    """
+    tnum  = numpy.full(len(dates), numpy.nan)
+    epoch = datetime.datetime(1970,1,1)
+    for i,d in enumerate(dates):
+        if(d is None):
+            continue
+        if(d.tzinfo is not None):
+            d = d.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        tnum[i] = (d - epoch).total_seconds()
+
+    return tnum
+
+
+def _set_attributes(ncvar, attrs):
+    for key in attrs:
+        ncvar.setncattr(key, attrs[key])
+
+
+def _write_metadata(nc, cnv):
+    """ Writes the header information of the pycnv object as global attributes
+    """
+    nc.Conventions  = 'CF-1.8'
+    nc.title        = 'CTD data of ' + os.path.basename(cnv.filename)
+    nc.source       = 'Seabird cnv file'
+    nc.history      = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S') + ' created with pycnv ' + version
+    nc.cnv_file     = cnv.filename
+    nc.cnv_sha1     = str(cnv.sha1)
+    nc.cnv_file_type = str(cnv.file_type).strip()
+    nc.baltic       = int(cnv.baltic)
+    if(cnv.date is not None):
+        nc.cnv_date = cnv.date.strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        for key in cnv.iow:
+            nc.setncattr('iow_' + re.sub('[^A-Za-z0-9_]', '_', key), str(cnv.iow[key]))
+    except AttributeError:
+        pass
+    try:
+        for key in cnv.seabird_meta:
+            nc.setncattr('seabird_' + re.sub('[^A-Za-z0-9_]', '_', key), str(cnv.seabird_meta[key]))
+    except AttributeError:
+        pass
+
+    nc.cnv_header = cnv.header
+
+
+def _create_variable(nc, name, dim, compression):
+    """ Creates a compressed float variable, the chunksize is limited by the size of the (fixed) dimension
+    """
+    compression = dict(compression)
+    size        = len(nc.dimensions[dim])
+    if(not(nc.dimensions[dim].isunlimited())):
+        if(size == 0):
+            compression.pop('chunksizes')
+        else:
+            compression['chunksizes'] = (min(compression['chunksizes'][0], size),)
+
+    return nc.createVariable(name, 'f8', (dim,), fill_value=numpy.nan, **compression)
+
+
+def _create_variables(nc, cnv, cdata_keys, nobs_mid, compression):
+    """ Creates the variables for the channels of the pycnv object and the computed data with the keys cdata_keys
+
+    Returns:
+       ncvars: Dictionary with (data name, netCDF variable), cdata variables are prefixed by 'cdata:'
+    """
+    used   = set(nc.variables.keys())
+    ncvars = {}
+    for c in cnv.channels:
+        ncname = _nc_name(c['name'], used)
+        ncvar  = _create_variable(nc, ncname, 'obs', compression)
+        attrs  = _cf_attributes(c['name_std'], c['unit'], c['long_name'])
+        attrs['cnv_name'] = c['name']
+        if(c['name_std'] is not None):
+            attrs['pycnv_name_std'] = c['name_std']
+        attrs['coordinates'] = 'time lat lon'
+        _set_attributes(ncvar, attrs)
+        ncvars[c['name']] = ncvar
+
+    for key in cdata_keys:
+        if(key in ('date','p')): # Time is written separately, p is a copy of data['p']
+            continue
+
+        dim    = 'obs_mid' if key in nobs_mid else 'obs'
+        ncname = _nc_name(key, used)
+        ncvar  = _create_variable(nc, ncname, dim, compression)
+        attrs  = _cf_attributes(key, cnv.cunits.get(key), cnv.cnames.get(key))
+        attrs['pycnv_cdata_name'] = key
+        _set_attributes(ncvar, attrs)
+        ncvars['cdata:' + key] = ncvar
+
+    return ncvars
+
+
+def _create_dataset(filename, cnv, nobs, chunksize, complevel):
+    """ Creates the netCDF file with dimensions, coordinates and metadata
+    """
+    netCDF4 = _import_netcdf4()
+    nc = netCDF4.Dataset(filename, 'w', format='NETCDF4')
+    nc.createDimension('obs', nobs)
+    nc.createDimension('obs_mid', None if nobs is None else max(nobs - 1, 0))
+    compression = {'zlib':complevel > 0, 'complevel':complevel, 'shuffle':True, 'chunksizes':(chunksize,)}
+
+    nclon = nc.createVariable('lon', 'f8', ())
+    _set_attributes(nclon, {'standard_name':'longitude', 'long_name':'Longitude of the cast', 'units':'degrees_east'})
+    nclon.assignValue(numpy.nan if cnv.lon is None else cnv.lon)
+    nclat = nc.createVariable('lat', 'f8', ())
+    _set_attributes(nclat, {'standard_name':'latitude', 'long_name':'Latitude of the cast', 'units':'degrees_north'})
+    nclat.assignValue(numpy.nan if cnv.lat is None else cnv.lat)
+    nccast_time = nc.createVariable('cast_time', 'f8', (), fill_value=numpy.nan)
+    _set_attributes(nccast_time, {'long_name':'Time of the cast', 'units':time_units, 'calendar':'standard'})
+    nccast_time.assignValue(dates_to_num([cnv.date])[0])
+    nctime = _create_variable(nc, 'time', 'obs', compression)
+    _set_attributes(nctime, {'standard_name':'time', 'long_name':'Time of the measurement', 'units':time_units, 'calendar':'standard'})
+    _write_metadata(nc, cnv)
+    return nc, compression
+
+
+def write_nc(cnv, filename, chunksize = 65536, complevel = 4):
+    """
+    Writes a CF compliant netCDF4 file of a pycnv object. All channels of the file (data) and the computed data (cdata) are written as chunked and compressed variables along the dimension obs, the time of the measurements (cdata['date']) as seconds since 1970. Variables defined between the measurements (e.g. N2) use the dimension obs_mid. Units, long names and standard names are written as attributes, the header information as global attributes.
+    Args:
+       cnv: pycnv object
+       filename: The netCDF filename
+       chunksize: Chunksize of the variables along obs
+       complevel: zlib compression level (0: no compression)
+    """
+    if(cnv.data is None):
+        nobs = 0
+    else:
+        nobs = len(cnv.raw_data)
+
+    cdata_keys = list(cnv.cdata.keys())
+    nobs_mid   = [key for key in cdata_keys if numpy.shape(cnv.cdata[key])[0] == nobs - 1 and nobs > 0]
+    nc, compression = _create_dataset(filename, cnv, nobs, chunksize, complevel)
+    try:
+        ncvars = _create_variables(nc, cnv, cdata_keys, nobs_mid, compression)
+        if(nobs > 0):
+            for n,c in enumerate(cnv.channels):
+                ncvars[c['name']][:] = cnv.raw_data[:,n]
+
+            for key in cdata_keys:
+                if(('cdata:' + key) in ncvars):
+                    ncvars['cdata:' + key][:] = numpy.asarray(cnv.cdata[key], dtype=float)
+
+            if('date' in cnv.cdata):
+                nc.variables['time'][:] = dates_to_num(cnv.cdata['date'])
+    finally:
+        nc.close()
+
+
+def write_nc_stream(filename_cnv, filename_nc, chunksize = 65536, complevel = 4, **kwargs):
+    """
+    Converts a cnv file into a CF compliant netCDF4 file (see write_nc()) without loading the whole file into memory, e.g. for long mooring records. The data is read, processed and written in chunks of chunksize lines. The computed data is derived for each chunk, N2 between two chunks is computed from the last sample of the previous chunk.
+    Args:
+       filename_cnv: The cnv filename
+       filename_nc: The netCDF filename
+       chunksize: Number of lines processed at once and chunksize of the netCDF variables
+       complevel: zlib compression level (0: no compression)
+       **kwargs: Passed to pycnv(), e.g. encoding, baltic, naming_rules
+    Returns:
+       nobs: Number of written measurements
+    """
+    import gsw
+    cnv = pycnv(filename_cnv, only_metadata = True, **kwargs)
+    if(not cnv.valid_cnv):
+        raise ValueError('Not a valid cnv file: ' + filename_cnv)
+
+    nc, compression = _create_dataset(filename_nc, cnv, None, chunksize, complevel)
+    nobs   = 0
+    ncvars = None
+    last   = None # Last sample of the previous chunk (for N2)
+    try:
+        for raw_data in cnv.iter_raw_data(chunksize):
+            n     = len(raw_data)
+            data  = cnv._get_data_dict(raw_data)
+            dates = cnv._get_dates(data, offset = nobs)
+            cdata, cunits, cnames = cnv._compute_cdata(data)
+            if(ncvars is None):
+                cnv.cunits.update(cunits)
+                cnv.cnames.update(cnames)
+                nobs_mid = [key for key in cdata if numpy.shape(cdata[key])[0] == n - 1]
+                ncvars   = _create_variables(nc, cnv, list(cdata.keys()), nobs_mid, compression)
+
+            for i,c in enumerate(cnv.channels):
+                ncvars[c['name']][nobs:nobs + n] = raw_data[:,i]
+
+            for key in cdata:
+                if(('cdata:' + key) not in ncvars):
+                    continue
+                ncvar = ncvars['cdata:' + key]
+                if(ncvar.dimensions[0] == 'obs_mid'):
+                    # The value between the previous and this chunk
+                    if(last is not None):
+                        sen = key[-2:]
+                        SA  = numpy.asarray([last['SA' + sen], cdata['SA' + sen][0]])
+                        CT  = numpy.asarray([last['CT' + sen], cdata['CT' + sen][0]])
+                        p   = numpy.asarray([last['p'], data['p'][0]])
+                        [N2,pN2] = gsw.Nsquared(SA, CT, p)
+                        ncvar[nobs - 1] = N2[0] if key.startswith('N2') else pN2[0]
+                    ncvar[nobs:nobs + n - 1] = cdata[key]
+                else:
+                    ncvar[nobs:nobs + n] = numpy.asarray(cdata[key], dtype=float)
+
+            if(dates is not None):
+                nc.variables['time'][nobs:nobs + n] = dates_to_num(dates)
+
+            last = {key:cdata[key][-1] for key in cdata if key.startswith(('SA','CT'))}
+            if('p' in data):
+                last['p'] = data['p'][-1]
+            nobs += n
+            logger.debug('Wrote ' + str(nobs) + ' measurements')
+    finally:
+        nc.close()
+
+    return nobs
+
+
+class _profile_writer(object):
+    """ Appends casts to a CF contiguous ragged array file of profiles, the per sample variables are created when they appear first
+    """
+    def __init__(self, filename, variables, chunksize, complevel):
+        netCDF4 = _import_netcdf4()
+        self.variables = variables
+        self.nc        = netCDF4.Dataset(filename, 'w', format='NETCDF4')
+        self.nprofile  = 0
+        self.nobs      = 0
+        self.ncvars    = {}
+        self.used      = set()
+        self.compression = {'zlib':complevel > 0, 'complevel':complevel, 'shuffle':True, 'chunksizes':(chunksize,)}
+        nc = self.nc
+        nc.createDimension('profile', None)
+        nc.createDimension('obs', None)
+        nc.Conventions = 'CF-1.8'
+        nc.featureType = 'profile'
+        nc.title       = 'CTD casts'
+        nc.source      = 'Seabird cnv files'
+        nc.history     = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S') + ' created with pycnv ' + version
+
+        cprofile = dict(self.compression)
+        cprofile['chunksizes'] = (min(chunksize, 1024),)
+        def profile_var(name, dtype, attrs):
+            if(dtype == str):
+                ncvar = nc.createVariable(name, str, ('profile',))
+            else:
+                ncvar = nc.createVariable(name, dtype, ('profile',), fill_value = numpy.nan if dtype == 'f8' else None, **cprofile)
+            _set_attributes(ncvar, attrs)
+            self.used.add(name)
+            return ncvar
+
+        profile_var('profile', str, {'cf_role':'profile_id', 'long_name':'cnv filename (#profile number for multi-profile files)'})
+        profile_var('rowSize', 'i4', {'long_name':'Number of measurements of the profile', 'sample_dimension':'obs'})
+        profile_var('time', 'f8', {'standard_name':'time', 'long_name':'Time of the cast', 'units':time_units, 'calendar':'standard'})
+        profile_var('lon', 'f8', {'standard_name':'longitude', 'long_name':'Longitude of the cast', 'units':'degrees_east'})
+        profile_var('lat', 'f8', {'standard_name':'latitude', 'long_name':'Latitude of the cast', 'units':'degrees_north'})
+        profile_var('station', str, {'long_name':'Station name given in the cnv header'})
+        profile_var('station_nearest', str, {'long_name':'Nearest station of the pycnv station list'})
+        profile_var('station_dist', 'f8', {'long_name':'Distance to the nearest station', 'units':'m'})
+        profile_var('cnv_sha1', str, {'long_name':'SHA1 checksum of the cnv file'})
+        obs_time = _create_variable(nc, 'obs_time', 'obs', self.compression)
+        _set_attributes(obs_time, {'long_name':'Time of the measurement', 'units':time_units, 'calendar':'standard'})
+        self.used.add('obs_time')
+
+    def append(self, cnv, station_nearest = '', station_dist = numpy.nan):
+        """ Appends the cast cnv
+        """
+        nc = self.nc
+        n  = 0 if cnv.data is None else len(cnv.raw_data)
+        i  = self.nprofile
+        i0 = self.nobs
+        if(getattr(cnv, 'profile', 0) > 0): # One profile of a multi-profile file
+            nc['profile'][i] = cnv.filename + '#' + str(cnv.profile)
+        else:
+            nc['profile'][i] = cnv.filename
+        nc['rowSize'][i]  = n
+        nc['time'][i]     = dates_to_num([cnv.date])[0]
+        nc['lon'][i]      = numpy.nan if cnv.lon is None else cnv.lon
+        nc['lat'][i]      = numpy.nan if cnv.lat is None else cnv.lat
+        nc['station'][i]  = str(cnv.get_info_dict()['station'])
+        nc['station_nearest'][i] = station_nearest
+        nc['station_dist'][i]    = station_dist
+        nc['cnv_sha1'][i] = str(cnv.sha1)
+        if(n > 0):
+            if('date' in cnv.cdata):
+                nc['obs_time'][i0:i0 + n] = dates_to_num(cnv.cdata['date'])
+
+            data = cnv.get_sample_data(self.variables)
+            for key in data:
+                values, unit, long_name = data[key]
+                if(key not in self.ncvars):
+                    ncname = _nc_name(key, self.used)
+                    ncvar  = _create_variable(nc, ncname, 'obs', self.compression)
+                    attrs  = _cf_attributes(key, unit, long_name)
+                    attrs['pycnv_name_std'] = key
+                    if(key == 'p'):
+                        attrs['positive'] = 'down'
+                        attrs['axis']     = 'Z'
+                    attrs['coordinates'] = 'obs_time lat lon'
+                    _set_attributes(ncvar, attrs)
+                    self.ncvars[key] = ncvar
+                elif(unit is not None and getattr(self.ncvars[key], 'cnv_unit', getattr(self.ncvars[key], 'units', unit)) != unit):
+                    logger.warning('Unit of ' + key + ' in ' + cnv.filename + ' (' + str(unit) + ') differs from the unit in the netCDF file')
+
+                self.ncvars[key][i0:i0 + n] = numpy.asarray(values, dtype=float)
+
+        self.nprofile += 1
+        self.nobs     += n
+
+    def close(self):
+        self.nc.close()
+
+
+def write_nc_profiles(casts, filename, variables = None, chunksize = 65536, complevel = 4, **kwargs):
+    """
+    Writes many casts into one CF netCDF4 file using the contiguous ragged array representation of profiles (featureType profile). The casts are written one by one, only one cast is held in memory. Each profile has the cnv filename as id, time, lon, lat, the station of the header, the nearest station and the number of measurements (rowSize), the measurements of all casts are appended along the dimension obs.
+    Args:
+       casts: The dictionary returned by get_all_valid_files() (the files are read again in the order of the dictionary), an iterable of pycnv objects (e.g. iter_valid_files()) or an iterable of cnv filenames
+       filename: The netCDF filename
+       variables: List of the standard names of data and cdata to be written (e.g. ['p','T0','SA00','CT00']), None for all variables with the length of the cast
+       chunksize: Chunksize of the variables along obs
+       complevel: zlib compression level (0: no compression)
+       **kwargs: Passed to pycnv() if files are read, e.g. baltic, naming_rules
+    Returns:
+       [nprofile, nobs]: Number of written profiles and measurements
+
+    Usage:
+       >>>cnv_data = get_all_valid_files('cruise/', station = [20.0,54.0,5000])
+       >>>write_nc_profiles(cnv_data, 'cruise.nc', variables = ['p','SA00','CT00'])
+    """
+    kwargs.setdefault('verbosity', logging.CRITICAL)
+    index  = get_station_index()
+    writer = _profile_writer(filename, variables, chunksize, complevel)
+    try:
+        for cnv in iter_casts(casts, **kwargs):
+            if(not(cnv.valid_cnv)):
+                logger.warning('Not a valid cnv file: ' + str(cnv.filename))
+                continue
+
+            names, dist = index.nearest(numpy.nan if cnv.lon is None else cnv.lon, numpy.nan if cnv.lat is None else cnv.lat)
+            writer.append(cnv, names[0], dist[0])
+            logger.debug('Wrote ' + cnv.filename + ' as profile ' + str(writer.nprofile))
+    finally:
+        writer.close()
+
+    return [writer.nprofile, writer.nobs]
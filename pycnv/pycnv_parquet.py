@@ -0,0 +1,203 @@
+#
+# Parquet (Apache Arrow) output of cnv archives
+#
+import os
+import re
+import sys
+import uuid
+import datetime
+import logging
+import collections
+import numpy
+from .pycnv_stations import get_station_index
+from .pycnv_sum_folder import iter_casts
+
+# Setup logging module
+logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+logger = logging.getLogger('pycnv_parquet')
+
+# Name of a partition without a value (e.g. casts without date)
+partition_unknown = 'unknown'
+
+
+def _import_pyarrow():
+    """ Imports pyarrow, which is only needed for the parquet output
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('parquet output needs the pyarrow package (pip install pyarrow)')
+
+    return pyarrow
+
+
+def _partition_value(value):
+    """ Creates a directory name of a partition value
+    """
+    if(value is None):
+        return partition_unknown
+    value = re.sub('[^A-Za-z0-9_.-]', '_', str(value).strip())
+    if(len(value) == 0):
+        return partition_unknown
+
+    return value
+
+
+def get_partition(cnv, station_nearest = '', partition_by = ('year','cruise','station')):
+    """
+    Returns the partition of a cast as a list of (key, value) pairs
+    Args:
+       cnv: pycnv object
+       station_nearest: The nearest station of the cast, used if the header has no station
+       partition_by: The partition keys, subset of 'year', 'cruise' (IOW ReiseNr) and 'station' (header station or nearest station)
+    Returns:
+       List of (key, value)
+    """
+    iow = getattr(cnv, 'iow', {})
+    partition = []
+    for key in partition_by:
+        if(key == 'year'):
+            value = None if cnv.date is None else cnv.date.year
+        elif(key == 'cruise'):
+            value = iow.get('reise')
+        elif(key == 'station'):
+            value = iow.get('station')
+            if(value is None or len(str(value).strip()) == 0):
+                value = station_nearest
+        else:
+            raise ValueError('Unknown partition key ' + str(key))
+        partition.append((key, _partition_value(value)))
+
+    return partition
+
+
+def cast_table(cnv, station_nearest = '', station_dist = numpy.nan, variables = None):
+    """
+    Creates an Arrow table of a cast. Each row is one measurement with the cast metadata (file, sha1, cast date, lon, lat, baltic, nearest station, profile number), the time of the measurement and the variables of cnv.get_sample_data() as columns.
+    Args:
+       cnv: pycnv object
+       station_nearest: Name of the nearest station
+       station_dist: Distance to the nearest station [m]
+       variables: List of standard names to be written, None for all
+    Returns:
+       pyarrow.Table
+    """
+    pa     = _import_pyarrow()
+    data   = cnv.get_sample_data(variables)
+    n      = 0 if cnv.data is None else len(cnv.raw_data)
+    tstamp = pa.timestamp('us', tz = 'UTC')
+    date   = cnv.date
+    if(date is not None and date.tzinfo is None):
+        date = date.replace(tzinfo = datetime.timezone.utc)
+
+    columns = collections.OrderedDict()
+    columns['file']            = pa.array([cnv.filename] * n, pa.string())
+    columns['sha1']            = pa.array([str(cnv.sha1)] * n, pa.string())
+    columns['date']            = pa.array([date] * n, tstamp)
+    columns['lon']             = pa.array(numpy.full(n, numpy.nan if cnv.lon is None else cnv.lon))
+    columns['lat']             = pa.array(numpy.full(n, numpy.nan if cnv.lat is None else cnv.lat))
+    columns['baltic']          = pa.array(numpy.full(n, bool(cnv.baltic)))
+    columns['station_nearest'] = pa.array([station_nearest] * n, pa.string())
+    columns['station_dist']    = pa.array(numpy.full(n, station_dist, dtype = float))
+    columns['profile']         = pa.array(numpy.full(n, getattr(cnv, 'profile', 0), dtype = numpy.int32))
+    if('date' in cnv.cdata and n > 0):
+        columns['time'] = pa.array(list(cnv.cdata['date']), tstamp)
+    else:
+        columns['time'] = pa.nulls(n, tstamp)
+
+    fields = []
+    arrays = []
+    for key in columns:
+        fields.append(pa.field(key, columns[key].type))
+        arrays.append(columns[key])
+
+    for key in data:
+        values, unit, long_name = data[key]
+        metadata = {'unit':'' if unit is None else str(unit), 'long_name':'' if long_name is None else str(long_name)}
+        fields.append(pa.field(key, pa.float64(), metadata = metadata))
+        arrays.append(pa.array(numpy.asarray(values, dtype = float)))
+
+    return pa.Table.from_arrays(arrays, schema = pa.schema(fields))
+
+
+class _writer_pool(object):
+    """ Keeps at most max_open parquet writers open, one for each partition and schema, the least recently used writer is closed if needed
+    """
+    def __init__(self, root, max_open, compression):
+        self.root        = root
+        self.max_open    = max_open
+        self.compression = compression
+        self.writers     = collections.OrderedDict()
+        self.files       = []
+        self.token       = uuid.uuid4().hex[:8]
+
+    def write(self, partition, table):
+        pq  = _import_pyarrow().parquet
+        key = (tuple(partition), table.schema)
+        try:
+            writer = self.writers.pop(key)
+        except KeyError:
+            if(len(self.writers) >= self.max_open):
+                key_old, writer_old = self.writers.popitem(last = False)
+                writer_old.close()
+
+            path = os.path.join(self.root, *[k + '=' + v for k,v in partition])
+            os.makedirs(path, exist_ok = True)
+            filename = os.path.join(path, 'part-' + self.token + '-' + '{:05d}'.format(len(self.files)) + '.parquet')
+            writer   = pq.ParquetWriter(filename, table.schema, compression = self.compression)
+            self.files.append(filename)
+            logger.debug('Opened ' + filename)
+
+        # Each cast is one row group
+        writer.write_table(table, row_group_size = max(table.num_rows, 1))
+        self.writers[key] = writer
+
+    def close(self):
+        while(len(self.writers) > 0):
+            key, writer = self.writers.popitem()
+            writer.close()
+
+
+def write_parquet(casts, root, variables = None, partition_by = ('year','cruise','station'), max_open = 64, compression = 'zstd', **kwargs):
+    """
+    Writes casts into a hive partitioned parquet dataset (e.g. root/year=2019/cruise=EMB210/station=TF0271/part-....parquet). The casts are read and written one by one, each cast is written as one row group (see cast_table() for the columns). Casts of the same partition and with the same columns are appended to the same file, at most max_open files are open at once.
+    Args:
+       casts: The dictionary returned by get_all_valid_files() (the files are read again in the order of the dictionary), an iterable of pycnv objects (e.g. iter_valid_files()) or an iterable of cnv filenames
+       root: The folder of the dataset
+       variables: List of standard names to be written (e.g. ['p','T0','SA00','CT00']), None for all variables of cnv.get_sample_data()
+       partition_by: The partition keys, see get_partition()
+       max_open: Maximum number of open files
+       compression: Parquet compression codec
+       **kwargs: Passed to pycnv() if files are read, e.g. baltic, naming_rules
+    Returns:
+       files: List of the written parquet files
+
+    Usage:
+       >>>cnv_data = get_all_valid_files('cruises/')
+       >>>write_parquet(cnv_data, 'cruises_parquet')
+       >>>pyarrow.dataset.dataset('cruises_parquet', partitioning='hive').to_table(columns=['p','CT00'], filter=pyarrow.dataset.field('station') == 'TF0271')
+    """
+    kwargs.setdefault('verbosity', logging.CRITICAL)
+    index = get_station_index()
+    pool  = _writer_pool(root, max_open, compression)
+    ncast = 0
+    try:
+        for cnv in iter_casts(casts, **kwargs):
+            if(not(cnv.valid_cnv)):
+                logger.warning('Not a valid cnv file: ' + str(cnv.filename))
+                continue
+
+            names, dist = index.nearest(numpy.nan if cnv.lon is None else cnv.lon, numpy.nan if cnv.lat is None else cnv.lat)
+            table = cast_table(cnv, names[0], dist[0], variables)
+            if(table.num_rows == 0):
+                logger.debug('No data in ' + cnv.filename)
+                continue
+
+            pool.write(get_partition(cnv, names[0], partition_by), table)
+            ncast += 1
+    finally:
+        pool.close()
+
+    logger.info('Wrote ' + str(ncast) + ' casts into ' + str(len(pool.files)) + ' files')
+    return pool.files
@@ -0,0 +1,454 @@
+#
+# Batch plotting of many casts on the headless Agg backend
+#
+import os
+import sys
+import logging
+import argparse
+import numpy
+from .pycnv import pycnv, version, expand_filenames, decimate_minmax, get_plot_buckets
+from .pycnv_sum_folder import iter_casts
+from .pycnv_grid import interp_casts, _get_variable
+from .pycnv_stations import get_distance
+
+# Setup logging module
+logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+logger = logging.getLogger('pycnv_plot')
+
+# The default variables plotted, the same as pycnv.plot()
+default_xaxis = ['CT00','SA00','oxy0','pot_rho00']
+
+
+def _import_agg():
+    """ Imports the matplotlib Figure and the Agg canvas, pylab and its interactive state are not used
+    """
+    try:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+    except ImportError:
+        raise ImportError('Plotting needs the matplotlib package (pip install matplotlib)')
+
+    return Figure, FigureCanvasAgg
+
+
+def _get_axes(ax = None, figsize = [8.27,11.69]):
+    """ Returns the given axes or the axes of a new figure on the Agg canvas
+    """
+    if(ax is None):
+        Figure, FigureCanvasAgg = _import_agg()
+        fig = Figure(figsize = figsize)
+        FigureCanvasAgg(fig)
+        ax  = fig.add_subplot(1,1,1)
+
+    return ax
+
+
+def _set_date_colorbar(cbar):
+    """ Labels a colorbar of matplotlib dates with dates
+    """
+    import matplotlib.dates
+    locator = matplotlib.dates.AutoDateLocator()
+    cbar.locator   = locator
+    cbar.formatter = matplotlib.dates.ConciseDateFormatter(locator)
+    cbar.update_ticks()
+
+
+class cast_plotter(object):
+    """
+
+    Plots casts into files with one figure, which is reused for all
+    casts. The axes are created by the first cast (see pycnv.plot()), the
+    following casts only replace the data of the lines, the labels and
+    the title. New axes are only created if a cast has a different set
+    of the plotted variables. The figure is not registered with pylab,
+    the memory needed stays the same for any number of casts.
+
+    Args:
+       xaxis: The variables to plot (see pycnv.plot())
+       yaxis: The variable of the y-axis
+       xlims: The xlimits for the data to plot (see pycnv.plot())
+       ylim: The ylimit of the plot, None results in autoscaling
+       colors: The colors (see pycnv.plot())
+       figsize: The size of the figure
+       fig_prefix: The prefix put before the figname (this can be a folder together with a file prefix)
+       fig_format: The format of the figures, e.g. pdf or png
+       dpi: The resolution of raster formats, None for the matplotlib default
+       decimate: Plot only the minimum and maximum of buckets of samples (see pycnv.plot())
+
+    Usage:
+       >>>plotter = cast_plotter(['CT00','SA00'], fig_prefix = 'figures/', fig_format = 'png')
+       >>>for f in glob.glob('cruise/*.cnv'):
+       >>>    plotter.plot(pycnv(f))
+       >>>plotter.close()
+
+    """
+    def __init__(self, xaxis = default_xaxis, yaxis = 'p', xlims = None, ylim = None, colors = None, figsize = [8.27,11.69], fig_prefix = './', fig_format = 'pdf', dpi = None, decimate = True):
+        self.xaxis      = list(xaxis)
+        self.yaxis      = yaxis
+        self.xlims      = xlims
+        self.ylim       = ylim
+        self.colors     = colors
+        self.figsize    = figsize
+        self.fig_prefix = fig_prefix
+        self.fig_format = fig_format
+        self.dpi        = dpi
+        self.decimate   = decimate
+        self.figure     = None
+        self.layout     = None # The axes, lines and title of the figure
+        self.nplot      = 0
+
+    def _get_figure(self):
+        if(self.figure is None):
+            Figure, FigureCanvasAgg = _import_agg()
+            self.figure = Figure(figsize = self.figsize, dpi = self.dpi)
+            FigureCanvasAgg(self.figure)
+
+        return self.figure
+
+    def _update(self, cnv, data):
+        """ Replaces the data of the lines, the labels and the title of the figure by the ones of data
+        """
+        layout = self.layout
+        ydata  = data['y_data']
+        layout['axes'][0].set_ylabel(data['y_names'])
+        for i,ax in enumerate(layout['axes']):
+            ind = cnv._get_plot_indices(data, i, ax)
+            layout['lines'][i].set_data(data['x_data'][i][ind],ydata[ind])
+            ax.relim()
+            ax.autoscale_view()
+            ax.set_xlabel(data['x_names'][i] + ' [' + data['x_units'][i] + ']')
+
+        layout['title'].set_text(cnv._get_plot_title())
+
+    def plot(self, cnv):
+        """
+        Plots a cast and saves the figure
+        Args:
+           cnv: pycnv or pycnv_view object
+        Returns:
+           The filename of the figure or None if the variables were not found
+        """
+        data = cnv._get_plot_data(self.xaxis, self.xlims, self.colors, self.yaxis, self.ylim)
+        if(data is None):
+            return None
+
+        data['decimate'] = self.decimate
+        fig = self._get_figure()
+        if(self.layout is not None and self.layout['x_axis'] == data['x_axis']):
+            self._update(cnv, data)
+        else:
+            logger.debug('Creating the axes for ' + ','.join(data['x_axis']))
+            fig.clear()
+            data['figure'] = fig
+            data['axes']   = [fig.add_subplot(1,1,1)]
+            cnv._draw_data(data)
+            # Only the artists are kept, not the data of the cast
+            self.layout = {'x_axis':data['x_axis'], 'axes':data['axes'], 'lines':data['lines'], 'title':data['title']}
+
+        fig_name = cnv._get_figure_name(data['x_axis'], self.fig_prefix, self.fig_format)
+        logger.debug('Saving file to file: ' + fig_name)
+        fig.savefig(fig_name, dpi = self.dpi)
+        self.nplot += 1
+        return fig_name
+
+    def close(self):
+        """ Releases the figure
+        """
+        if(self.figure is not None):
+            self.figure.clear()
+        self.figure = None
+        self.layout = None
+
+
+# The plotter of this process and its settings, see get_plotter()
+_plotter = None
+
+def get_plotter(**settings):
+    """
+    Returns the cast_plotter of this process, a new one is created if the settings changed
+    Args:
+       **settings: Passed to cast_plotter()
+    Returns:
+       cast_plotter
+    """
+    global _plotter
+    if(_plotter is None or _plotter[0] != settings):
+        if(_plotter is not None):
+            _plotter[1].close()
+        _plotter = (settings, cast_plotter(**settings))
+
+    return _plotter[1]
+
+
+def _init_worker(settings):
+    get_plotter(**settings)
+
+
+def _plot_worker(args):
+    """ Plots a file in a worker process
+    Returns:
+       [filename, figure names, error]: error is None if successful and otherwise the error message
+    """
+    filename, profiles, kwargs = args
+    try:
+        cnv = pycnv(filename, **kwargs)
+        if(not(cnv.valid_cnv)):
+            return [filename, [], 'Not a valid cnv file']
+        casts = []
+        if(profiles):
+            casts = cnv.get_profiles(multi_only = True)
+        if(len(casts) == 0):
+            casts = [cnv]
+        fig_names = []
+        plotter   = _plotter[1]
+        for cast in casts:
+            fig_name = plotter.plot(cast)
+            if(fig_name is not None):
+                fig_names.append(fig_name)
+    except Exception as e:
+        return [filename, [], str(e)]
+
+    return [filename, fig_names, None]
+
+
+def plot_casts(filenames, processes = None, profiles = False, xaxis = default_xaxis, yaxis = 'p', xlims = None, ylim = None, colors = None, figsize = [8.27,11.69], fig_prefix = './', fig_format = 'pdf', dpi = None, decimate = True, **kwargs):
+    """
+    Plots cnv files into figures with a pool of processes, each worker parses the files and plots them with its own cast_plotter, i.e. with one reused figure
+    Args:
+       filenames: List of cnv files
+       processes: Number of worker processes, None for the number of CPUs, 1 plots in this process
+       profiles: Plot each profile of multi-profile files (yo-yo) into an own figure (see pycnv.get_profiles())
+       xaxis, yaxis, xlims, ylim, colors, figsize, fig_prefix, fig_format, dpi, decimate: See cast_plotter
+       **kwargs: Passed to pycnv(), e.g. baltic, naming_rules, bin_size
+    Returns:
+       List of [filename, list of figure names, error] in the order of filenames, error is None if successful and otherwise the error message
+
+    Usage:
+       >>>results = plot_casts(glob.glob('cruise/*.cnv'), processes = 4, fig_prefix = 'figures/')
+    """
+    kwargs.setdefault('verbosity', logging.CRITICAL)
+    if(processes is None):
+        processes = os.cpu_count() or 1
+
+    settings = {'xaxis':xaxis, 'yaxis':yaxis, 'xlims':xlims, 'ylim':ylim, 'colors':colors, 'figsize':figsize, 'fig_prefix':fig_prefix, 'fig_format':fig_format, 'dpi':dpi, 'decimate':decimate}
+    args     = [(f, profiles, kwargs) for f in filenames]
+    processes = min(processes, len(args))
+    if(processes <= 1):
+        _init_worker(settings)
+        results = [_plot_worker(a) for a in args]
+    else:
+        from multiprocessing import Pool
+        with Pool(processes, initializer = _init_worker, initargs = (settings,)) as pool:
+            results = list(pool.imap(_plot_worker, args))
+
+    return results
+
+
+def plot_overlay(casts, variable = 'CT00', yaxis = 'p', ax = None, color_by = 'date', cmap = 'viridis', color = 'k', linewidth = 0.8, decimate = True, colorbar = True, figsize = [8.27,11.69], **kwargs):
+    """
+    Plots a variable of many casts into one axes as a single LineCollection, the lines are colored by the date or the number of the cast. Each cast is decimated to the resolution of the axes (see pycnv.decimate_minmax()).
+    Args:
+       casts: The dictionary returned by get_all_valid_files(), pycnv objects or cnv filenames (see iter_casts())
+       variable: The variable of the x-axis
+       yaxis: The variable of the y-axis, e.g. 'p' or 'depth'
+       ax: The matplotlib axes, None for a new figure on the Agg canvas
+       color_by: 'date', 'cast' (number of the cast) or None for one color
+       cmap: The colormap for color_by
+       color: The color of the lines if color_by is None
+       linewidth: The width of the lines
+       decimate: Plot only the minimum and maximum of buckets of samples
+       colorbar: Add a colorbar for color_by
+       figsize: The size of a new figure
+       **kwargs: Passed to pycnv() if files are read
+    Returns:
+       [figure, axes, LineCollection]
+
+    Usage:
+       >>>fig, ax, lines = plot_overlay(get_all_valid_files('cruise/'), 'SA00')
+       >>>fig.savefig('cruise_SA.png')
+    """
+    from matplotlib.collections import LineCollection
+    import matplotlib.dates
+    kwargs.setdefault('verbosity', logging.CRITICAL)
+    ax       = _get_axes(ax, figsize)
+    fig      = ax.figure
+    nbuckets = get_plot_buckets(ax)
+    segments = []
+    values   = []
+    labels   = None
+    for i,cnv in enumerate(iter_casts(casts, **kwargs)):
+        if(not(cnv.valid_cnv)):
+            continue
+        x = _get_variable(cnv, variable)
+        y = _get_variable(cnv, yaxis)
+        if(x is None or y is None or len(x) != len(y)):
+            logger.debug('No ' + variable + ' or ' + yaxis + ' in ' + cnv.filename)
+            continue
+        if(labels is None):
+            data = cnv._get_plot_data([variable], yaxis = yaxis)
+            if(data is not None):
+                labels = [data['x_names'][0] + ' [' + data['x_units'][0] + ']', data['y_names']]
+        if(decimate):
+            ind = decimate_minmax(x, y, nbuckets)
+            x   = x[ind]
+            y   = y[ind]
+        segments.append(numpy.column_stack((x, y)))
+        if(color_by == 'date'):
+            values.append(numpy.nan if cnv.date is None else matplotlib.dates.date2num(cnv.date))
+        else:
+            values.append(i)
+
+    if(len(segments) == 0):
+        logger.warning('plot_overlay(): No casts with ' + variable + ' and ' + yaxis)
+    lines = LineCollection(segments, linewidths = linewidth)
+    if(color_by is None):
+        lines.set_color(color)
+    else:
+        lines.set_array(numpy.asarray(values, dtype = float))
+        lines.set_cmap(cmap)
+    ax.add_collection(lines)
+    ax.autoscale_view()
+    if(not(ax.yaxis_inverted())):
+        ax.invert_yaxis()
+    if(labels is None):
+        labels = [variable, yaxis]
+    ax.set_xlabel(labels[0])
+    ax.set_ylabel(labels[1])
+    if(colorbar and color_by is not None and len(segments) > 0):
+        cbar = fig.colorbar(lines, ax = ax)
+        if(color_by == 'date'):
+            _set_date_colorbar(cbar)
+        else:
+            cbar.set_label('Cast')
+
+    return [fig, ax, lines]
+
+
+def plot_section(casts, variable = 'CT00', xaxis = 'distance', grid = None, yaxis = 'p', ax = None, cmap = 'viridis', vmin = None, vmax = None, colorbar = True, figsize = [11.69,8.27], **kwargs):
+    """
+    Plots a section of a variable (distance, time or cast number vs. pressure or depth) with pcolormesh of casts interpolated onto a common grid (see interp_casts())
+    Args:
+       casts: The dictionary returned by interp_casts() or casts for interp_casts() (the dictionary of get_all_valid_files(), pycnv objects or filenames), then grid is needed
+       variable: The variable to plot
+       xaxis: 'distance' (along the casts in the given order [km]), 'time' (casts are sorted by date) or 'cast' (number of the cast)
+       grid: The vertical grid if casts are interpolated, e.g. numpy.arange(0,245,0.5)
+       yaxis: The vertical axis of the interpolation, e.g. 'p' or 'depth'
+       ax: The matplotlib axes, None for a new figure on the Agg canvas
+       cmap: The colormap
+       vmin: Minimum of the colormap, None for the minimum of the data
+       vmax: Maximum of the colormap, None for the maximum of the data
+       colorbar: Add a colorbar
+       figsize: The size of a new figure
+       **kwargs: Passed to interp_casts(), e.g. nthreads, baltic
+    Returns:
+       [figure, axes, QuadMesh]
+
+    Usage:
+       >>>gridded = interp_casts(get_all_valid_files('cruise/'), numpy.arange(0,245,0.5), ['CT00','SA00'])
+       >>>fig, ax, mesh = plot_section(gridded, 'CT00', xaxis = 'time')
+    """
+    import matplotlib.dates
+    if(isinstance(casts, dict) and 'grid' in casts):
+        gridded = casts
+    else:
+        if(grid is None):
+            raise ValueError('plot_section() needs a grid to interpolate the casts')
+        gridded = interp_casts(casts, grid, [variable], axis = yaxis, **kwargs)
+    if(variable not in gridded):
+        raise ValueError('Variable ' + variable + ' was not interpolated')
+
+    values = gridded[variable]
+    ncast  = len(values)
+    if(xaxis == 'distance'):
+        dist = get_distance(gridded['lon'][1:], gridded['lat'][1:], gridded['lon'][:-1], gridded['lat'][:-1])
+        x    = numpy.concatenate(([0], numpy.cumsum(numpy.nan_to_num(dist)))) / 1000
+        xlabel = 'Distance [km]'
+    elif(xaxis == 'time'):
+        x = numpy.asarray([numpy.nan if d is None else matplotlib.dates.date2num(d) for d in gridded['date']], dtype = float)
+        xlabel = 'Date'
+    elif(xaxis == 'cast'):
+        x = numpy.arange(ncast, dtype = float)
+        xlabel = 'Cast'
+    else:
+        raise ValueError('Unknown xaxis ' + str(xaxis) + ', use distance, time or cast')
+
+    ind = numpy.flatnonzero(numpy.isfinite(x))
+    ind = ind[numpy.argsort(x[ind], kind = 'stable')]
+    ax  = _get_axes(ax, figsize)
+    fig = ax.figure
+    mesh = ax.pcolormesh(x[ind], gridded['grid'], numpy.ma.masked_invalid(values[ind].T), shading = 'nearest', cmap = cmap, vmin = vmin, vmax = vmax)
+    # Positions of the casts
+    ax.plot(x[ind], numpy.full(len(ind), gridded['grid'][0]), 'k|', markersize = 4, clip_on = False)
+    ax.set_ylim(gridded['grid'].max(), gridded['grid'].min())
+    if(xaxis == 'time'):
+        ax.xaxis_date()
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(yaxis)
+    if(colorbar):
+        cbar = fig.colorbar(mesh, ax = ax)
+        cbar.set_label(variable)
+
+    return [fig, ax, mesh]
+
+
+def main():
+    desc      = 'Plots cnv files into figure files with a pool of worker processes, each worker reuses one figure on the headless Agg backend'
+    file_help = 'The cnv file(s), glob patterns (e.g. "cruise/**/*.cnv") are expanded'
+    parser    = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--variables', '-va', default=','.join(default_xaxis), help='The variables to plot in a comma separated list, e.g. CT00,SA00')
+    parser.add_argument('--yaxis', '-y', default='p', help='The variable of the y-axis')
+    parser.add_argument('--plot_prefix', '-pre', default='./', help='The prefix before the filename, this can be a folder and/or a file prefix, e.g. figures/cruise_')
+    parser.add_argument('--format', '-f', default='pdf', help='The format of the figures, e.g. pdf or png')
+    parser.add_argument('--dpi', type=float, help='The resolution of raster formats')
+    parser.add_argument('--no_decimate', action='store_true', help='Plot all samples, otherwise only the minimum and maximum of buckets of samples sized to the resolution of the figure are plotted')
+    parser.add_argument('--profiles', action='store_true', help='Plot each profile of multi-profile files (yo-yo) into an own figure')
+    parser.add_argument('--jobs', '-j', type=int, help='Number of worker processes, standard is the number of CPUs')
+    parser.add_argument('--overlay', action='store_true', help='Plot the variables of all casts into one figure per variable (overlay), colored by date')
+    parser.add_argument('--section', choices=['distance','time','cast'], help='Plot a section of each variable of all casts into one figure, along the distance, the time or the number of the casts')
+    parser.add_argument('--grid', type=float, default=1.0, help='The vertical resolution of sections')
+    parser.add_argument('--verbose', '-v', action='count')
+    parser.add_argument('--version', action='version', version='%(prog)s ' + version)
+    parser.add_argument('filename', nargs='+', help=file_help)
+    args = parser.parse_args()
+
+    if(args.verbose == None):
+        loglevel = logging.WARNING
+    elif(args.verbose == 1):
+        loglevel = logging.INFO
+    else:
+        loglevel = logging.DEBUG
+
+    logger.setLevel(loglevel)
+    filenames = expand_filenames(args.filename)
+    variables = args.variables.split(',')
+    if(args.overlay or args.section is not None):
+        casts = [cnv for cnv in iter_casts(filenames, verbosity = logging.CRITICAL) if cnv.valid_cnv]
+        for variable in variables:
+            if(args.overlay):
+                fig, ax, lines = plot_overlay(casts, variable, args.yaxis, decimate = not(args.no_decimate))
+                fig_name = args.plot_prefix + 'overlay_' + variable + '.' + args.format
+            else:
+                pmax = numpy.nanmax([numpy.nanmax(_get_variable(cnv, args.yaxis)) for cnv in casts])
+                grid = numpy.arange(0, pmax + args.grid, args.grid)
+                fig, ax, mesh = plot_section(casts, variable, args.section, grid, args.yaxis, nthreads = args.jobs)
+                fig_name = args.plot_prefix + 'section_' + args.section + '_' + variable + '.' + args.format
+            fig.savefig(fig_name, dpi = args.dpi)
+            print(fig_name)
+        return
+
+    results   = plot_casts(filenames, args.jobs, args.profiles, xaxis = variables, yaxis = args.yaxis, fig_prefix = args.plot_prefix, fig_format = args.format, dpi = args.dpi, decimate = not(args.no_decimate))
+    nfail     = 0
+    for filename, fig_names, error in results:
+        if(error is not None):
+            logger.error(filename + ': ' + error)
+            nfail += 1
+        for fig_name in fig_names:
+            print(fig_name)
+
+    if(nfail > 0):
+        logger.error('Could not plot ' + str(nfail) + ' of ' + str(len(results)) + ' files')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,353 @@
+#
+# Multi-resolution min/max/mean pyramids of cnv files for quick-looks of long records
+#
+import os
+import sys
+import json
+import shutil
+import hashlib
+import threading
+import datetime
+import logging
+import argparse
+import numpy
+from .pycnv import pycnv, version, get_cache_dir, expand_filenames
+from .pycnv_frame import get_columns, get_time
+
+# Setup logging module
+logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+logger = logging.getLogger('pycnv_pyramid')
+
+# Version of the layout of the pyramid folders, older pyramids are rebuilt
+pyramid_format = 1
+
+
+def get_pyramid_folder(filename, cache = None):
+    """
+    Returns the folder of the pyramid of a cnv file, the pyramid is stored next to the file (FILE.pyramid) or in the cache folder (see pycnv.get_cache_dir())
+    Args:
+       filename: The cnv file
+       cache: True for the cache folder, False for the folder of the file, None for the folder of the file if it is writable, otherwise the cache folder
+    Returns:
+       The folder name, None if the cache folder is requested but not available
+    """
+    filename = os.path.abspath(filename)
+    sidecar  = filename + '.pyramid'
+    if(cache is None):
+        if(os.path.isdir(sidecar) or os.access(os.path.dirname(filename), os.W_OK)):
+            return sidecar
+        cache = True
+    if(not(cache)):
+        return sidecar
+
+    cache_dir = get_cache_dir()
+    if(cache_dir is None):
+        return None
+    name = hashlib.sha1(filename.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'pyramid', name)
+
+
+def _reduce(vmin, vmax, vsum, count, size):
+    """ Combines size consecutive buckets (rows) into one, the last bucket may be incomplete
+    """
+    nb  = -(-len(vmin) // size)
+    pad = nb * size - len(vmin)
+    if(pad > 0):
+        nans  = numpy.full((pad, vmin.shape[1]), numpy.nan)
+        zeros = numpy.zeros((pad, vmin.shape[1]))
+        vmin  = numpy.concatenate((vmin, nans))
+        vmax  = numpy.concatenate((vmax, nans))
+        vsum  = numpy.concatenate((vsum, zeros))
+        count = numpy.concatenate((count, zeros))
+
+    shape = (nb, size, vmin.shape[1])
+    # fmin/fmax ignore NaN, a bucket is NaN only if all its samples are NaN
+    return [numpy.fmin.reduce(vmin.reshape(shape), axis = 1), numpy.fmax.reduce(vmax.reshape(shape), axis = 1), vsum.reshape(shape).sum(axis = 1), count.reshape(shape).sum(axis = 1)]
+
+
+def build_pyramid(cnv, folder = None, bucket_size = 16, factor = 4, min_buckets = 256, cdata = True):
+    """
+    Builds the min/max/mean pyramid of all channels of a cast and stores it in a folder. Level 0 combines bucket_size samples into one bucket, each next level combines factor buckets of the previous one, the last level has at most min_buckets buckets. Minimum, maximum and mean of each bucket are stored as float32 in levels.npy (bucket, [min,max,mean], variable), the time (datetime64[us], UTC) or the first sample of each bucket in time.npy, the variables and levels in meta.json.
+    Args:
+       cnv: pycnv object
+       folder: The folder of the pyramid, None for get_pyramid_folder(cnv.filename)
+       bucket_size: Number of samples of the buckets of level 0, windows with less than bucket_size * width samples are better read from the cnv file
+       factor: Number of buckets combined into one bucket of the next level
+       min_buckets: Number of buckets of the coarsest level
+       cdata: Include the derived data (e.g. SA, CT)
+    Returns:
+       The folder of the pyramid
+    """
+    if(folder is None):
+        folder = get_pyramid_folder(cnv.filename)
+    if(folder is None):
+        raise ValueError('No folder available for the pyramid of ' + cnv.filename)
+    factor      = max(int(factor), 2)
+    bucket_size = max(int(bucket_size), 1)
+    columns     = [c for c in get_columns(cnv, std_names = True, cdata = cdata) if numpy.asarray(c[1]).dtype.kind in 'biuf']
+    if(len(columns) == 0):
+        raise ValueError('No data to build a pyramid of ' + cnv.filename)
+
+    values   = numpy.column_stack([numpy.asarray(c[1], dtype = float) for c in columns])
+    nsamples = len(values)
+    time     = get_time(cnv)
+    nan      = numpy.isnan(values)
+    levels   = [_reduce(values, values, numpy.where(nan, 0, values), (~nan).astype(float), bucket_size)]
+    sizes    = [bucket_size]
+    while(len(levels[-1][0]) > min_buckets):
+        levels.append(_reduce(*levels[-1], factor))
+        sizes.append(sizes[-1] * factor)
+
+    nbuckets = [len(l[0]) for l in levels]
+    data     = numpy.empty((sum(nbuckets), 3, len(columns)), dtype = numpy.float32)
+    axis     = numpy.empty(sum(nbuckets), dtype = numpy.int64)
+    offset   = 0
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        for (vmin, vmax, vsum, count), size, nb in zip(levels, sizes, nbuckets):
+            data[offset:offset + nb, 0] = vmin
+            data[offset:offset + nb, 1] = vmax
+            data[offset:offset + nb, 2] = vsum / count
+            if(time is not None):
+                axis[offset:offset + nb] = time[::size].view(numpy.int64)
+            else:
+                axis[offset:offset + nb] = numpy.arange(nb) * size
+            offset += nb
+
+    stat = os.stat(cnv.filename)
+    meta = {'format':pyramid_format, 'version':version, 'file':os.path.abspath(cnv.filename), 'source_size':stat.st_size, 'source_mtime_ns':stat.st_mtime_ns, 'sha1':str(cnv.sha1), 'nsamples':nsamples, 'factor':factor, 'bucket_sizes':sizes, 'nbuckets':nbuckets, 'has_time':time is not None, 'names':[c[0] for c in columns], 'units':[c[2] for c in columns], 'long_names':[c[3] for c in columns]}
+
+    # Written into a temporary folder first, readers never see a partial pyramid
+    tmp = folder + '.tmp' + str(os.getpid()) + '_' + str(threading.get_ident())
+    os.makedirs(tmp, exist_ok = True)
+    numpy.save(os.path.join(tmp, 'levels.npy'), data)
+    numpy.save(os.path.join(tmp, 'time.npy'), axis)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as fmeta:
+        json.dump(meta, fmeta)
+    if(os.path.isdir(folder)):
+        shutil.rmtree(folder, ignore_errors = True)
+    try:
+        os.rename(tmp, folder)
+    except OSError: # Written by another process or thread in the meantime
+        shutil.rmtree(tmp, ignore_errors = True)
+    logger.info('Wrote pyramid of ' + cnv.filename + ' with ' + str(len(sizes)) + ' levels to ' + folder)
+    return folder
+
+
+def _to_datetime64(date):
+    """ Converts a datetime (naive dates are UTC) into numpy datetime64[us] (UTC)
+    """
+    if(isinstance(date, datetime.datetime)):
+        if(date.tzinfo is not None):
+            date = date.astimezone(datetime.timezone.utc).replace(tzinfo = None)
+    return numpy.datetime64(date, 'us')
+
+
+class pyramid(object):
+    """
+
+    The min/max/mean pyramid of a cnv file (see build_pyramid()), the
+    levels are memory mapped, a query only reads the buckets of the
+    requested time window.
+
+    Usage:
+       >>>pyr = open_pyramid('mooring.cnv')
+       >>>ql = pyr.get(['T0','SA00'], start = datetime.datetime(2019,5,1), stop = datetime.datetime(2019,6,1), width = 800)
+       >>>pl.fill_between(ql['time'], ql['min']['T0'], ql['max']['T0'])
+
+    Args:
+       folder: The folder of the pyramid
+
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, 'meta.json')) as fmeta:
+            self.meta = json.load(fmeta)
+        self.names  = self.meta['names']
+        self.units  = dict(zip(self.names, self.meta['units']))
+        self.long_names   = dict(zip(self.names, self.meta['long_names']))
+        self.bucket_sizes = self.meta['bucket_sizes']
+        self.has_time     = self.meta['has_time']
+        self.data   = numpy.load(os.path.join(folder, 'levels.npy'), mmap_mode = 'r')
+        self.axis   = numpy.load(os.path.join(folder, 'time.npy'), mmap_mode = 'r')
+        self.offsets = numpy.concatenate(([0], numpy.cumsum(self.meta['nbuckets'])))
+
+    def is_valid(self, filename = None):
+        """ Checks if the pyramid is up to date with the cnv file (size and modification time)
+        """
+        if(filename is None):
+            filename = self.meta['file']
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+        return self.meta['format'] == pyramid_format and self.meta['source_size'] == stat.st_size and self.meta['source_mtime_ns'] == stat.st_mtime_ns
+
+    def get_axis(self, level):
+        """ Returns the time (datetime64[us], UTC) or the first sample number of the buckets of a level
+        """
+        axis = self.axis[self.offsets[level]:self.offsets[level + 1]]
+        if(self.has_time):
+            return axis.view('datetime64[us]')
+        return axis
+
+    def _get_position(self, value):
+        if(self.has_time):
+            return _to_datetime64(value).astype(numpy.int64)
+        return int(value) # Pyramids without time use sample numbers
+
+    def get_range(self, level, start = None, stop = None):
+        """
+        Returns the first and the last + 1 bucket of a level within the window start to stop (see get())
+        """
+        size = self.bucket_sizes[level]
+        axis = self.axis[self.offsets[level]:self.offsets[level + 1]]
+        i0   = 0
+        i1   = len(axis)
+        if(start is not None):
+            if(isinstance(start, (int, numpy.integer))): # Sample number
+                i0 = start // size
+            else:
+                i0 = numpy.searchsorted(axis, self._get_position(start), 'right') - 1
+        if(stop is not None):
+            if(isinstance(stop, (int, numpy.integer))):
+                i1 = -(-stop // size)
+            else:
+                i1 = numpy.searchsorted(axis, self._get_position(stop), 'left')
+
+        i0 = min(max(int(i0), 0), len(axis))
+        i1 = min(max(int(i1), i0), len(axis))
+        return [i0, i1]
+
+    def get_level(self, start = None, stop = None, width = 1000):
+        """
+        Returns the coarsest level with at least width buckets within the window start to stop, level 0 if none has enough buckets
+        """
+        i0, i1   = self.get_range(0, start, stop)
+        nsamples = (i1 - i0) * self.bucket_sizes[0]
+        level = 0
+        for k,size in enumerate(self.bucket_sizes):
+            if(nsamples / size >= width):
+                level = k
+
+        return level
+
+    def get(self, variables = None, start = None, stop = None, width = 1000, level = None):
+        """
+        Returns the minimum, maximum and mean of the variables in the window start to stop with at least width buckets (if available)
+        Args:
+           variables: List of variables, None for all
+           start: Start of the window, datetime (naive dates are UTC) or numpy.datetime64 for pyramids with time, or the sample number (int), None for the start of the record
+           stop: End of the window, see start, None for the end of the record
+           width: Width of the plot in pixels, i.e. the minimum number of buckets
+           level: The level to use, None to choose it with get_level()
+        Returns:
+           Dictionary with level, bucket_size, time (datetime64[us], UTC, or the first sample of the buckets), min, max, mean (dictionaries of the variables), units and long_names
+        """
+        if(variables is None):
+            variables = self.names
+        missing = [v for v in variables if v not in self.names]
+        if(len(missing) > 0):
+            raise ValueError('Unknown variables: ' + ','.join(missing))
+        if(level is None):
+            level = self.get_level(start, stop, width)
+
+        i0, i1 = self.get_range(level, start, stop)
+        ind  = [self.names.index(v) for v in variables]
+        data = numpy.array(self.data[self.offsets[level] + i0:self.offsets[level] + i1])
+        quicklook = {'level':level, 'bucket_size':self.bucket_sizes[level], 'time':numpy.array(self.get_axis(level)[i0:i1])}
+        for j,stat in enumerate(('min','max','mean')):
+            quicklook[stat] = {v:data[:,j,i] for v,i in zip(variables, ind)}
+        quicklook['units']      = {v:self.units[v] for v in variables}
+        quicklook['long_names'] = {v:self.long_names[v] for v in variables}
+        return quicklook
+
+
+def open_pyramid(filename, build = True, cache = None, cnv = None, **kwargs):
+    """
+    Opens the pyramid of a cnv file, a missing or outdated pyramid is built
+    Args:
+       filename: The cnv file
+       build: Build the pyramid if it is missing or outdated, otherwise a ValueError is raised
+       cache: Location of the pyramid, see get_pyramid_folder()
+       cnv: The parsed file, if already available
+       **kwargs: Passed to build_pyramid() (bucket_size, factor, min_buckets, cdata) and pycnv()
+    Returns:
+       pyramid
+    """
+    folders = [get_pyramid_folder(filename, cache)]
+    if(cache is None):
+        folders.append(get_pyramid_folder(filename, True))
+    for folder in folders:
+        if(folder is not None and os.path.isfile(os.path.join(folder, 'meta.json'))):
+            pyr = pyramid(folder)
+            if(pyr.is_valid(filename)):
+                return pyr
+            logger.debug('Pyramid ' + folder + ' is outdated')
+
+    if(not(build)):
+        raise ValueError('No valid pyramid of ' + filename)
+    build_args = {key:kwargs.pop(key) for key in ('bucket_size', 'factor', 'min_buckets', 'cdata') if key in kwargs}
+    if(cnv is None):
+        kwargs.setdefault('verbosity', logging.CRITICAL)
+        cnv = pycnv(filename, **kwargs)
+    if(not(cnv.valid_cnv)):
+        raise ValueError('Not a valid cnv file: ' + filename)
+
+    return pyramid(build_pyramid(cnv, folders[0], **build_args))
+
+
+def quicklook(filename, variables = None, start = None, stop = None, width = 1000, **kwargs):
+    """
+    Returns the minimum, maximum and mean of variables of a cnv file for a time window and a plot width from its pyramid (built if needed), see open_pyramid() and pyramid.get()
+
+    Usage:
+       >>>ql = quicklook('mooring.cnv', ['T0'], width = 1000)
+    """
+    return open_pyramid(filename, **kwargs).get(variables, start, stop, width)
+
+
+def main():
+    desc      = 'Builds the min/max/mean pyramids of cnv files for quick-looks of long records, the pyramids are stored next to the files (FILE.pyramid) or in the cache folder'
+    file_help = 'The cnv file(s), glob patterns (e.g. "moorings/**/*.cnv") are expanded'
+    parser    = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--bucket_size', type=int, default=16, help='Number of samples of the buckets of the finest level')
+    parser.add_argument('--factor', type=int, default=4, help='Number of buckets combined into one bucket of the next level')
+    parser.add_argument('--cache', action='store_true', help='Store the pyramids in the cache folder')
+    parser.add_argument('--force', action='store_true', help='Rebuild existing pyramids')
+    parser.add_argument('--verbose', '-v', action='count')
+    parser.add_argument('--version', action='version', version='%(prog)s ' + version)
+    parser.add_argument('filename', nargs='+', help=file_help)
+    args = parser.parse_args()
+
+    if(args.verbose == None):
+        loglevel = logging.WARNING
+    elif(args.verbose == 1):
+        loglevel = logging.INFO
+    else:
+        loglevel = logging.DEBUG
+
+    logger.setLevel(loglevel)
+    cache = True if args.cache else None
+    nfail = 0
+    filenames = expand_filenames(args.filename)
+    for filename in filenames:
+        try:
+            if(args.force):
+                cnv = pycnv(filename, verbosity = logging.CRITICAL)
+                if(not(cnv.valid_cnv)):
+                    raise ValueError('Not a valid cnv file')
+                folder = build_pyramid(cnv, get_pyramid_folder(filename, cache), args.bucket_size, args.factor)
+            else:
+                folder = open_pyramid(filename, cache = cache, bucket_size = args.bucket_size, factor = args.factor).folder
+            print(folder)
+        except Exception as e:
+            logger.error(filename + ': ' + str(e))
+            nfail += 1
+
+    if(nfail > 0):
+        logger.error('Could not build ' + str(nfail) + ' of ' + str(len(filenames)) + ' pyramids')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,388 @@
+#
+# A local HTTP service answering requests for cnv files with warm caches
+#
+import os
+import io
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import collections
+import numpy
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .pycnv import pycnv, version, load_naming_rules, standard_name_file, _import_gsw
+from .pycnv_stations import get_station_registry, get_station_index
+from .pycnv_summary import get_summary_record
+from .pycnv_pyramid import open_pyramid, get_pyramid_folder
+
+# Setup logging module
+logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+logger = logging.getLogger('pycnv_service')
+
+
+class cast_cache(object):
+    """
+
+    A thread safe LRU cache of parsed cnv files. A file is parsed again
+    if its modification time or size changed. The files are parsed
+    outside of the lock, a file requested by several threads at the same
+    time may therefore be parsed more than once.
+
+    Args:
+       max_casts: Maximum number of cached files
+       **kwargs: Passed to pycnv(), e.g. baltic, naming_rules
+
+    """
+    def __init__(self, max_casts = 32, **kwargs):
+        self.max_casts = max_casts
+        self.kwargs    = kwargs
+        self.kwargs.setdefault('verbosity', logging.CRITICAL)
+        self.casts     = collections.OrderedDict()
+        self.lock      = threading.Lock()
+        self.hits      = 0
+        self.misses    = 0
+
+    def get(self, filename):
+        """
+        Returns the pycnv object of a file, parses the file if it is not cached
+        """
+        filename = os.path.abspath(filename)
+        stat     = os.stat(filename)
+        key      = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.casts.get(filename)
+            if(entry is not None and entry[0] == key):
+                self.casts.move_to_end(filename)
+                self.hits += 1
+                return entry[1]
+
+        cnv = pycnv(filename, **self.kwargs)
+        with self.lock:
+            self.misses += 1
+            self.casts[filename] = (key, cnv)
+            self.casts.move_to_end(filename)
+            while(len(self.casts) > self.max_casts):
+                self.casts.popitem(last = False)
+
+        return cnv
+
+    def get_status(self):
+        with self.lock:
+            return {'casts':len(self.casts), 'max_casts':self.max_casts, 'hits':self.hits, 'misses':self.misses}
+
+
+def _json_value(value):
+    """ Converts a value into a JSON compatible value, NaN is null and dates are ISO strings
+    """
+    if(value is None or isinstance(value, (str, bool))):
+        return value
+    if(hasattr(value, 'isoformat')):
+        return value.isoformat()
+    if(isinstance(value, (numpy.datetime64,))):
+        return None if numpy.isnat(value) else str(value)
+    if(isinstance(value, (float, numpy.floating))):
+        return float(value) if numpy.isfinite(value) else None
+    if(isinstance(value, (int, numpy.integer))):
+        return int(value)
+    if(isinstance(value, numpy.bool_)):
+        return bool(value)
+
+    return str(value)
+
+
+def _json_array(values):
+    """ Converts an array into a list for JSON, NaN is null
+    """
+    values = numpy.asarray(values)
+    if(values.dtype.kind == 'f'):
+        values = numpy.where(numpy.isfinite(values), values, None)
+    elif(values.dtype.kind == 'O'):
+        return [_json_value(v) for v in values]
+
+    return values.tolist()
+
+
+class service(object):
+    """
+
+    The requests of the pycnv service, independent of the HTTP server.
+    All requests take the cnv file as parameter file (relative to root),
+    multi-profile files (yo-yo) take the profile number as parameter
+    profile (see pycnv.get_profiles()).
+
+    Requests:
+       /summary?file=...: The summary of the cast (JSON)
+       /variables?file=...: The variables with units and long names (JSON)
+       /data?file=...&variables=p,CT00&format=json|npy: The variables of each measurement, npy is a float64 array (nsamples, nvariables) in the numpy .npy format, the variables are in the header X-Variables
+       /quicklook?file=...&variables=T0&start=2019-05-01&stop=2019-06-01&width=800: Minimum, maximum and mean of the variables in the time window (ISO dates, sample numbers for files without time) with at least width buckets, from the pyramid of the file (JSON), missing pyramids are built in the cache folder (see pycnv.get_cache_dir()), nothing is written into root
+       /stations: The known stations (JSON)
+       /status: The state of the caches (JSON)
+
+    Args:
+       root: Only files within this folder are served
+       max_casts: Size of the cache of parsed files
+       **kwargs: Passed to pycnv()
+
+    """
+    def __init__(self, root = '.', max_casts = 32, **kwargs):
+        self.root    = os.path.realpath(root)
+        self.cache   = cast_cache(max_casts, **kwargs)
+        self.started = time.time()
+
+    def warm(self):
+        """ Loads the naming rules, the stations and the gsw toolbox before the first request
+        """
+        load_naming_rules(self.cache.kwargs.get('naming_rules', standard_name_file))
+        get_station_registry()
+        get_station_index()
+        try:
+            _import_gsw()
+        except ImportError as e:
+            logger.warning(str(e))
+
+    def get_filename(self, query):
+        """ Returns the file requested by the parameter file, it has to be within the root folder
+        """
+        if('file' not in query):
+            raise ValueError('Parameter file is missing')
+        filename = os.path.realpath(os.path.join(self.root, query['file'][0]))
+        if(os.path.commonpath([self.root, filename]) != self.root):
+            raise PermissionError('File is not within the root folder: ' + query['file'][0])
+
+        return filename
+
+    def get_cast(self, query):
+        """ Returns the cast requested by the parameters file and profile
+        """
+        filename = self.get_filename(query)
+        cnv = self.cache.get(filename)
+        if(not(cnv.valid_cnv)):
+            raise ValueError('Not a valid cnv file: ' + query['file'][0])
+        profile = int(query.get('profile', ['0'])[0])
+        if(profile > 0):
+            profiles = cnv.get_profiles(multi_only = True)
+            if(profile > len(profiles)):
+                raise ValueError('Profile ' + str(profile) + ' does not exist, the file has ' + str(len(profiles)) + ' profiles')
+            cnv = profiles[profile - 1]
+
+        return cnv
+
+    def summary(self, query):
+        cnv     = self.get_cast(query)
+        summary = {key:_json_value(value) for key,value in get_summary_record(cnv).items()}
+        # Number of profiles of multi-profile files (0 for one cast)
+        if(isinstance(cnv, pycnv) and cnv.data is not None):
+            summary['nprofiles'] = len(cnv.get_profiles(multi_only = True))
+        return summary
+
+    def variables(self, query):
+        cnv  = self.get_cast(query)
+        data = []
+        for c in cnv.channels:
+            data.append({'name':c['name'], 'name_std':c['name_std'], 'long_name':c['long_name'], 'unit':c['unit']})
+        cdata = []
+        for key in cnv.cdata:
+            cdata.append({'name':key, 'long_name':cnv.cnames.get(key), 'unit':cnv.cunits.get(key)})
+
+        return {'data':data, 'cdata':cdata}
+
+    def data(self, query):
+        """ Returns the variables of each measurement as [content_type, body, headers]
+        """
+        cnv    = self.get_cast(query)
+        sample = cnv.get_sample_data()
+        if('variables' in query):
+            names = ','.join(query['variables']).split(',')
+        else:
+            names = list(sample.keys())
+        missing = [name for name in names if name not in sample]
+        if(len(missing) > 0):
+            raise ValueError('Unknown variables: ' + ','.join(missing))
+
+        fmt = query.get('format', ['json'])[0]
+        if(fmt == 'npy'):
+            n      = 0 if cnv.data is None else len(cnv.raw_data)
+            values = numpy.empty((n, len(names)))
+            for i,name in enumerate(names):
+                values[:,i] = sample[name][0]
+            fnpy = io.BytesIO()
+            numpy.save(fnpy, values)
+            return ['application/octet-stream', fnpy.getvalue(), {'X-Variables':','.join(names)}]
+        elif(fmt == 'json'):
+            body = {}
+            for name in names:
+                values, unit, long_name = sample[name]
+                body[name] = {'unit':unit, 'long_name':long_name, 'values':_json_array(values)}
+            if('date' in cnv.cdata):
+                body['date'] = _json_array(cnv.cdata['date'])
+            return ['application/json', json.dumps(body).encode('utf-8'), {}]
+        else:
+            raise ValueError('Unknown format ' + str(fmt) + ', use json or npy')
+
+    def quicklook(self, query):
+        """ Returns the minimum, maximum and mean of the variables in a time window from the pyramid of the file (see pycnv_pyramid), existing pyramids next to the file or in the cache folder are used, missing ones are built in the cache folder only (the served folder is not written to)
+        """
+        filename = self.get_filename(query)
+        if(not(os.path.isfile(filename))):
+            raise FileNotFoundError(query['file'][0])
+        try:
+            pyr = open_pyramid(filename, build = False)
+        except ValueError:
+            if(get_pyramid_folder(filename, cache = True) is None):
+                raise RuntimeError('No cache folder to build the pyramid of ' + query['file'][0] + ' (see PYCNV_CACHE_DIR)')
+            cnv = self.cache.get(filename)
+            if(not(cnv.valid_cnv)):
+                raise ValueError('Not a valid cnv file: ' + query['file'][0])
+            pyr = open_pyramid(filename, cache = True, cnv = cnv)
+
+        variables = None
+        if('variables' in query):
+            variables = ','.join(query['variables']).split(',')
+        window = []
+        for key in ('start', 'stop'):
+            value = query.get(key, [None])[0]
+            if(value is not None):
+                value = numpy.datetime64(value, 'us') if pyr.has_time else int(value)
+            window.append(value)
+        width = int(query.get('width', ['1000'])[0])
+        ql    = pyr.get(variables, window[0], window[1], width)
+        if(pyr.has_time):
+            time = numpy.datetime_as_string(ql['time'], unit = 'us').tolist()
+        else:
+            time = _json_array(ql['time'])
+        body = {'level':ql['level'], 'bucket_size':ql['bucket_size'], 'time':time}
+        for name in ql['min']:
+            body[name] = {'unit':ql['units'][name], 'long_name':ql['long_names'][name]}
+            for stat in ('min', 'max', 'mean'):
+                body[name][stat] = _json_array(ql[stat][name])
+
+        return body
+
+    def stations(self, query):
+        registry = get_station_registry()
+        return [{'name':s['name'], 'longitude':s['longitude'], 'latitude':s['latitude']} for s in registry.stations]
+
+    def status(self, query):
+        status = self.cache.get_status()
+        status['version'] = version
+        status['root']    = self.root
+        status['uptime']  = time.time() - self.started
+        return status
+
+    def handle(self, path, query):
+        """
+        Answers a request
+        Args:
+           path: The path of the request, e.g. /summary
+           query: Dictionary with the parameters (lists of strings, see urllib.parse.parse_qs())
+        Returns:
+           [status, content_type, body, headers]
+        """
+        requests = {'/summary':self.summary, '/variables':self.variables, '/quicklook':self.quicklook, '/stations':self.stations, '/status':self.status}
+        try:
+            if(path == '/data'):
+                content_type, body, headers = self.data(query)
+                return [200, content_type, body, headers]
+            elif(path in requests):
+                body = json.dumps(requests[path](query)).encode('utf-8')
+                return [200, 'application/json', body, {}]
+            else:
+                return _error(404, 'Unknown request ' + path + ', known requests: /data ' + ' '.join(requests))
+        except (FileNotFoundError, IsADirectoryError) as e:
+            return _error(404, 'File not found: ' + str(e))
+        except PermissionError as e:
+            return _error(403, str(e))
+        except ValueError as e:
+            return _error(400, str(e))
+        except Exception as e:
+            logger.exception('Error answering ' + path)
+            return _error(500, str(e))
+
+
+def _error(status, message):
+    return [status, 'application/json', json.dumps({'error':message}).encode('utf-8'), {}]
+
+
+class _request_handler(BaseHTTPRequestHandler):
+    """ Passes GET requests to the service of the server
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        t1  = time.time()
+        status, content_type, body, headers = self.server.service.handle(url.path.rstrip('/') or '/', parse_qs(url.query))
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key in headers:
+            self.send_header(key, headers[key])
+        self.end_headers()
+        self.wfile.write(body)
+        logger.debug(self.path + ' ' + str(status) + ' ({:.1f} ms)'.format((time.time() - t1) * 1000))
+
+    def log_message(self, format, *args):
+        logger.info(self.address_string() + ' ' + (format % args))
+
+
+def create_server(host = '127.0.0.1', port = 8080, root = '.', max_casts = 32, warm = True, **kwargs):
+    """
+    Creates the HTTP server of the pycnv service (see service for the requests), the server is started with serve_forever()
+    Args:
+       host: The address to listen on, the default only accepts local connections
+       port: The port, 0 for a free port (see server.server_address)
+       root: Only files within this folder are served
+       max_casts: Size of the cache of parsed files
+       warm: Load the naming rules, stations and gsw before the first request
+       **kwargs: Passed to pycnv()
+    Returns:
+       http.server.ThreadingHTTPServer
+
+    Usage:
+       >>>server = create_server(root = 'cruises/', port = 8080)
+       >>>server.serve_forever()
+       $ curl "http://127.0.0.1:8080/summary?file=EMB210/0001_01.cnv"
+    """
+    server = ThreadingHTTPServer((host, port), _request_handler)
+    server.daemon_threads = True
+    server.service = service(root, max_casts, **kwargs)
+    if(warm):
+        server.service.warm()
+
+    return server
+
+
+def main():
+    desc      = 'A local HTTP service answering requests for the summary, the variables and the data of cnv files, parsed files are kept in a cache. Requests: /summary?file=FILE, /variables?file=FILE, /data?file=FILE&variables=p,CT00&format=json|npy, /quicklook?file=FILE&variables=T0&start=DATE&stop=DATE&width=800, /stations, /status'
+    parser    = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--root', '-r', default='.', help='Only files within this folder are served, file parameters are relative to it')
+    parser.add_argument('--host', default='127.0.0.1', help='The address to listen on')
+    parser.add_argument('--port', '-p', type=int, default=8080, help='The port to listen on')
+    parser.add_argument('--max_casts', '-n', type=int, default=32, help='Number of parsed files kept in the cache')
+    parser.add_argument('--verbose', '-v', action='count')
+    parser.add_argument('--version', action='version', version='%(prog)s ' + version)
+    args = parser.parse_args()
+
+    if(args.verbose == None):
+        loglevel = logging.WARNING
+    elif(args.verbose == 1):
+        loglevel = logging.INFO
+    else:
+        loglevel = logging.DEBUG
+
+    logger.setLevel(loglevel)
+    server = create_server(args.host, args.port, args.root, args.max_casts)
+    logger.warning('Serving ' + server.service.root + ' on http://' + str(server.server_address[0]) + ':' + str(server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,227 @@
+#
+# Transfer of parsed casts between processes with shared memory
+#
+import os
+import sys
+import logging
+import weakref
+import numpy
+from multiprocessing import Pool
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+from .pycnv import pycnv, dates_to_us, us_to_dates
+
+# Setup logging module
+logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+logger = logging.getLogger('pycnv_shm')
+
+# Alignment of the arrays within a shared memory block [bytes]
+alignment = 64
+
+
+def _align(nbytes):
+    return (nbytes + alignment - 1) // alignment * alignment
+
+
+class _shared_block(object):
+    """
+    Owner of an attached shared memory block, the base of all arrays of the
+    block (see from_shared()). The mapping is closed when the owner and
+    thereby the last array of the block is deleted.
+    """
+    def __init__(self, shm):
+        self.shm  = shm
+        address   = numpy.ndarray((shm.size,), dtype = numpy.uint8, buffer = shm.buf).__array_interface__['data'][0]
+        self.__array_interface__ = {'shape':(shm.size,), 'typestr':'|u1', 'data':(address, False), 'version':3}
+        weakref.finalize(self, shm.close)
+
+    def unlink(self):
+        """ Removes the name of the block, the memory is freed when it is not mapped anymore
+        """
+        self.shm.unlink()
+
+    def get_array(self, dtype, shape, offset):
+        """ Returns the array at offset of the block, its base is the owner
+        """
+        dtype  = numpy.dtype(dtype)
+        nbytes = int(numpy.prod(shape, dtype = numpy.int64)) * dtype.itemsize
+        return numpy.asarray(self)[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+def to_shared(cnv, header = True):
+    """
+    Copies raw_data and cdata of a pycnv object into one shared memory block and returns a small, picklable descriptor with the name and layout of the block and the remaining attributes of the object (see pycnv._get_meta()). The dates of cdata are stored as int64 microseconds. The calling process does not own the block, it has to be attached with from_shared() (or removed with unlink_shared()), otherwise it stays in memory.
+    Args:
+       cnv: pycnv object
+       header: Include the header string in the descriptor
+    Returns:
+       descriptor: Dictionary with 'name', 'size', 'layout', 'tz' and 'meta'
+    """
+    arrays   = []
+    tz       = None
+    raw_data = getattr(cnv, 'raw_data', None)
+    if(raw_data is not None):
+        arrays.append(('raw_data', None, numpy.ascontiguousarray(raw_data)))
+    for key, value in getattr(cnv, 'cdata', {}).items():
+        if(key == 'date'):
+            value, tz = dates_to_us(value)
+        value = numpy.ascontiguousarray(value)
+        if(value.dtype.hasobject):
+            logger.warning('cdata[' + str(key) + '] of ' + str(cnv.filename) + ' is not numeric, not transferred')
+            continue
+        arrays.append(('cdata', key, value))
+
+    layout = []
+    size   = 0
+    for group, key, value in arrays:
+        layout.append((group, key, value.dtype.str, value.shape, size))
+        size += _align(value.nbytes)
+
+    shm = shared_memory.SharedMemory(create = True, size = max(size, 1))
+    # The block is owned by the attaching process, the resource tracker of
+    # this process must not remove it when this process exits
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    for (group, key, dtype, shape, offset), (g, k, value) in zip(layout, arrays):
+        numpy.ndarray(shape, dtype = dtype, buffer = shm.buf, offset = offset)[...] = value
+
+    descriptor = {'name':shm.name, 'size':size, 'layout':layout, 'tz':tz, 'meta':cnv._get_meta(header)}
+    shm.close()
+    return descriptor
+
+
+def from_shared(descriptor):
+    """
+    Attaches a shared memory block created by to_shared() and returns a pycnv object with raw_data, data and cdata as views of the block (no copy, except the dates). The calling process owns the block and has to release it with release() when the object is not needed anymore. The block stays mapped as long as an array of it exists, also after release().
+    Args:
+       descriptor: The descriptor returned by to_shared()
+    Returns:
+       pycnv object
+    """
+    block    = _shared_block(shared_memory.SharedMemory(name = descriptor['name']))
+    raw_data = None
+    cdata    = {}
+    for group, key, dtype, shape, offset in descriptor['layout']:
+        value = block.get_array(dtype, tuple(shape), offset)
+        if(group == 'raw_data'):
+            raw_data = value
+        elif(key == 'date'):
+            cdata[key] = us_to_dates(value, descriptor['tz'])
+        else:
+            cdata[key] = value
+
+    cnv = pycnv.__new__(pycnv)
+    cnv._set_meta(descriptor['meta'], raw_data, cdata)
+    cnv._shm = block
+    return cnv
+
+
+def unlink_shared(descriptor):
+    """
+    Removes the shared memory block of a descriptor which was not attached with from_shared()
+    """
+    shm = shared_memory.SharedMemory(name = descriptor['name'])
+    shm.close()
+    shm.unlink()
+
+
+def release(cnv):
+    """
+    Releases the shared memory block of a pycnv object created by from_shared(), the data of the object is removed and the block is unlinked (its name is removed). Arrays of the object still referenced elsewhere (e.g. cnv.SA or the data of a downcast()) stay valid, the memory is unmapped and freed when the last of them is deleted.
+    Args:
+       cnv: pycnv object
+    """
+    block = cnv.__dict__.pop('_shm', None)
+    if(block is None):
+        return
+    for key in ['raw_data', 'p', 'C', 'T', 'SP', 'SA', 'CT', 'pt', 'pot_rho', 'oxy']:
+        cnv.__dict__.pop(key, None)
+    cnv.data  = None
+    cnv.cdata = {}
+    cnv._segments = {}
+    # The mapping is closed by the owner when the last array is deleted
+    block.unlink()
+
+
+class shared_casts(object):
+    """
+    A list of pycnv objects in shared memory (see load_shared()), the shared memory is released with close() or at the end of a with statement
+
+    Usage:
+       >>>with load_shared(files) as casts:
+       >>>    for cnv in casts:
+       >>>        print(cnv.filename, cnv.SA.mean())
+    """
+    def __init__(self, casts = None):
+        self.casts = [] if casts is None else list(casts)
+
+    def append(self, cnv):
+        self.casts.append(cnv)
+
+    def close(self):
+        """ Releases the shared memory of all casts
+        """
+        for cnv in self.casts:
+            release(cnv)
+        self.casts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.casts)
+
+    def __len__(self):
+        return len(self.casts)
+
+    def __getitem__(self, i):
+        return self.casts[i]
+
+
+def _load_worker(args):
+    """ Reads a cnv file in a worker process and returns its shared memory descriptor, None if the file could not be read
+    """
+    filename, header, kwargs = args
+    try:
+        cnv = pycnv(filename, **kwargs)
+    except Exception as e:
+        logger.warning('Could not read ' + str(filename) + ' (' + str(e) + ')')
+        return None
+
+    return to_shared(cnv, header)
+
+
+def load_shared(filenames, processes = None, header = False, **kwargs):
+    """
+    Reads cnv files with a pool of processes, each worker parses a file and hands raw_data and cdata back in shared memory, only the descriptors are pickled. The casts are attached in the order of filenames as soon as they are ready.
+    Args:
+       filenames: List of cnv files
+       processes: Number of worker processes, None for the number of CPUs
+       header: Transfer also the header string of the files
+       **kwargs: Passed to pycnv(), e.g. baltic, naming_rules, bin_size
+    Returns:
+       shared_casts: The pycnv objects (files which could not be read are missing), release them with close() or use it in a with statement
+
+    Usage:
+       >>>with load_shared(glob.glob('cruise/*.cnv'), processes = 4) as casts:
+       >>>    sa = [cnv.SA for cnv in casts]
+    """
+    kwargs.setdefault('verbosity', logging.CRITICAL)
+    if(processes is None):
+        processes = os.cpu_count() or 1
+
+    casts = shared_casts()
+    args  = [(f, header, kwargs) for f in filenames]
+    try:
+        with Pool(processes) as pool:
+            for descriptor in pool.imap(_load_worker, args):
+                if(descriptor is not None):
+                    casts.append(from_shared(descriptor))
+    except BaseException:
+        casts.close()
+        raise
+
+    logger.info('Loaded ' + str(len(casts)) + ' casts into shared memory')
+    return casts
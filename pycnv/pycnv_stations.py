@@ -0,0 +1,339 @@
+#
+# Stations and positional functions of the pycnv package
+#
+import os
+import sys
+import numpy
+import logging
+import json
+import hashlib
+import tempfile
+import importlib.util
+from .pycnv import get_cache_dir, package_dir
+
+# pyproj and scipy are optional and imported at their first use
+FLAG_PYPROJ = importlib.util.find_spec('pyproj') is not None
+FLAG_SCIPY  = importlib.util.find_spec('scipy') is not None
+_geod       = None
+
+# Setup logging module
+logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+logger = logging.getLogger('pycnv_stations')
+
+# Mean earth radius [m]
+earth_radius = 6371008.8
+
+
+stations_file = os.path.join(package_dir, 'stations', 'iow_stations.yaml')
+
+
+def _get_geod():
+    """ Returns the WGS84 pyproj.Geod object, None if pyproj cannot be imported
+    """
+    global _geod, FLAG_PYPROJ
+    if(_geod is None and FLAG_PYPROJ):
+        try:
+            from pyproj import Geod
+            _geod = Geod(ellps='WGS84')
+        except Exception:
+            FLAG_PYPROJ = False
+
+    return _geod
+
+
+def _get_kdtree(xyz):
+    """ Returns a scipy cKDTree of the points xyz, None if scipy cannot be imported
+    """
+    global FLAG_SCIPY
+    if(FLAG_SCIPY):
+        try:
+            from scipy.spatial import cKDTree
+            return cKDTree(xyz)
+        except ImportError:
+            FLAG_SCIPY = False
+
+    return None
+
+
+class station_registry(object):
+    """
+
+    Registry of the stations in a station yaml file. The yaml file is
+    parsed once and stored in a compiled form (json) in the cache
+    folder (see pycnv.get_cache_dir()), which is used as long as the
+    yaml file is unchanged. Names and alternative names are resolved
+    with a dictionary, the positions are stored in the arrays lon and
+    lat. Use get_station_registry() to get a registry shared within
+    the process.
+
+    Usage:
+       >>>registry = get_station_registry()
+       >>>station = registry.get('TF0271')
+       >>>ind = registry.lookup(['TF0271','BY15'])
+
+    Args:
+       filename: The station yaml file, None for the stations distributed with pycnv
+       cache: Use and write the compiled registry in the cache folder
+
+    """
+    def __init__(self, filename = None, cache = True):
+        if(filename is None):
+            filename = stations_file
+
+        self.filename = os.path.abspath(filename)
+        self._index   = None
+        stat          = os.stat(self.filename)
+        source        = [self.filename, stat.st_mtime_ns, stat.st_size]
+        cache_file    = None
+        if(cache):
+            cache_dir = get_cache_dir()
+            if(cache_dir is not None):
+                fhash      = hashlib.sha1(self.filename.encode('utf-8')).hexdigest()
+                cache_file = os.path.join(cache_dir, 'stations_' + fhash + '.json')
+
+        compiled = None
+        if(cache_file is not None and os.path.isfile(cache_file)):
+            try:
+                with open(cache_file, 'r') as fcache:
+                    compiled = json.load(fcache)
+                if(compiled['source'] != source):
+                    compiled = None
+            except Exception as e:
+                logger.debug('Could not read compiled stations ' + cache_file + ': ' + str(e))
+                compiled = None
+
+        if(compiled is None):
+            compiled = self._compile(source)
+            # Names which are not strings would not be restored by json
+            if(cache_file is not None and all(isinstance(name, str) for name in compiled['index'])):
+                try:
+                    cache_str = json.dumps(compiled)
+                    ftmp, ftmp_name = tempfile.mkstemp(dir = os.path.dirname(cache_file))
+                    with os.fdopen(ftmp, 'w') as fcache:
+                        fcache.write(cache_str)
+                    os.replace(ftmp_name, cache_file)
+                except Exception as e:
+                    logger.debug('Could not write compiled stations ' + cache_file + ': ' + str(e))
+
+        self.stations = compiled['stations']
+        self.names    = numpy.asarray([s['name'] for s in self.stations], dtype = object)
+        self.lon      = numpy.asarray(compiled['lon'], dtype = float)
+        self.lat      = numpy.asarray(compiled['lat'], dtype = float)
+        self.index    = compiled['index']
+
+    def _compile(self, source):
+        """ Parses the yaml file and creates the positions and the name index, the result contains only json types (no pickle is needed to read the cache)
+        """
+        logger.debug('Parsing station file ' + self.filename)
+        import yaml
+        with open(self.filename) as f_stations:
+            # use safe_load instead load
+            stations_yaml = yaml.safe_load(f_stations)
+
+        stations = stations_yaml['stations']
+        index    = {}
+        for i,station in enumerate(stations):
+            names = [station['name']]
+            names.extend(station.get('alternative_names', []))
+            for name in names:
+                if(name in index):
+                    logger.warning('Station name ' + str(name) + ' is defined twice, using the first one')
+                else:
+                    index[name] = i
+
+        compiled = {}
+        compiled['source']   = source
+        compiled['stations'] = stations
+        compiled['lon']      = [float(s['longitude']) for s in stations]
+        compiled['lat']      = [float(s['latitude']) for s in stations]
+        compiled['index']    = index
+        return compiled
+
+    def __len__(self):
+        return len(self.stations)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get(self, name):
+        """
+        Returns the station dictionary of the station with the name or alternative name, None if not found
+        """
+        i = self.index.get(name)
+        if(i is None):
+            return None
+        else:
+            return self.stations[i]
+
+    def lookup(self, names):
+        """
+        Resolves many names or alternative names at once
+        Args:
+           names: List of station names
+        Returns:
+           ind: Array of station indices (for stations, names, lon, lat), -1 if not found
+        """
+        index = self.index
+        return numpy.asarray([index.get(name, -1) for name in names], dtype = int)
+
+    def get_station_index(self):
+        """ Returns a station_index of the stations, the index is created only once
+        """
+        if(self._index is None):
+            self._index = station_index(self)
+
+        return self._index
+
+
+_station_registries = {}
+def get_station_registry(filename = None):
+    """
+    Returns the station_registry of the station file, the registry is loaded only once per process
+    Args:
+       filename: The station yaml file, None for the stations distributed with pycnv
+    """
+    if(filename is None):
+        filename = stations_file
+
+    filename = os.path.abspath(filename)
+    try:
+        return _station_registries[filename]
+    except KeyError:
+        registry = station_registry(filename)
+        _station_registries[filename] = registry
+        return registry
+
+
+def get_stations():
+    """ Returns a list of all stations as dictionaries with name, longitude, latitude and optional alternative_names
+    """
+    return list(get_station_registry().stations)
+
+
+def get_distance(lon, lat, lon0, lat0):
+    """
+    Distance between the positions lon, lat and lon0, lat0, all arguments can be arrays. Uses the WGS84 ellipsoid if pyproj is available, otherwise the haversine formula with a mean earth radius
+    Args:
+       lon: Longitude(s) [decdeg]
+       lat: Latitude(s) [decdeg]
+       lon0: Longitude(s) of the reference position(s) [decdeg]
+       lat0: Latitude(s) of the reference position(s) [decdeg]
+    Returns:
+       dist: Distance(s) [m]
+    """
+    lon  = numpy.asarray(lon, dtype = float)
+    lat  = numpy.asarray(lat, dtype = float)
+    lon0 = numpy.broadcast_to(numpy.asarray(lon0, dtype = float), numpy.shape(lon))
+    lat0 = numpy.broadcast_to(numpy.asarray(lat0, dtype = float), numpy.shape(lat))
+    g = _get_geod()
+    if(g is not None):
+        az12,az21,dist = g.inv(lon, lat, numpy.array(lon0), numpy.array(lat0))
+        return numpy.asarray(dist)
+    else:
+        lonr  = numpy.radians(lon)
+        latr  = numpy.radians(lat)
+        lon0r = numpy.radians(lon0)
+        lat0r = numpy.radians(lat0)
+        a = numpy.sin((latr - lat0r)/2)**2 + numpy.cos(latr) * numpy.cos(lat0r) * numpy.sin((lonr - lon0r)/2)**2
+        return 2 * earth_radius * numpy.arcsin(numpy.sqrt(a))
+
+
+def _lonlat_to_xyz(lon, lat):
+    """ Converts positions into unit vectors, the euclidean distance of the vectors (chord) increases monotonically with the great circle distance
+    """
+    lonr = numpy.radians(numpy.asarray(lon, dtype = float))
+    latr = numpy.radians(numpy.asarray(lat, dtype = float))
+    coslat = numpy.cos(latr)
+    return numpy.column_stack((coslat * numpy.cos(lonr), coslat * numpy.sin(lonr), numpy.sin(latr)))
+
+
+class station_index(object):
+    """
+
+    A spatial index of stations to find the nearest station for many
+    positions at once. The stations are converted into unit vectors
+    and put into a KD-tree (scipy), without scipy a vectorized search
+    over all stations is used.
+
+    Usage:
+       >>>index = station_index()
+       >>>names, dist = index.nearest(lon, lat)
+
+    Args:
+       stations: A station_registry or a list of station dictionaries with 'name', 'longitude' and 'latitude' as returned by get_stations(), None: get_station_registry() is used
+
+    """
+    def __init__(self, stations = None):
+        if(stations is None):
+            stations = get_station_registry()
+
+        if(isinstance(stations, station_registry)):
+            self.names = stations.names
+            self.lon   = stations.lon
+            self.lat   = stations.lat
+        else:
+            self.names = numpy.asarray([s['name'] for s in stations], dtype = object)
+            self.lon   = numpy.asarray([s['longitude'] for s in stations], dtype = float)
+            self.lat   = numpy.asarray([s['latitude'] for s in stations], dtype = float)
+
+        self.xyz   = _lonlat_to_xyz(self.lon, self.lat)
+        if(len(self.names) > 0):
+            self.tree = _get_kdtree(self.xyz)
+        else:
+            self.tree = None
+
+    def nearest(self, lon, lat, max_distance = None, chunksize = 100000, ncandidates = 4):
+        """
+        Finds the nearest station for each position. The ncandidates nearest stations on a sphere are searched in the index, of these the station with the smallest distance on the WGS84 ellipsoid is taken.
+        Args:
+           lon: Longitude(s) [decdeg]
+           lat: Latitude(s) [decdeg]
+           max_distance: Stations further away than max_distance [m] are not assigned, None for no limit
+           chunksize: Number of positions compared at once with all stations (without scipy only)
+           ncandidates: Number of candidate stations per position
+        Returns:
+           names: Array of station names, '' for positions with NaN or without station within max_distance
+           dist: Array of distances [m] to the station, NaN if no station was assigned
+        """
+        lon   = numpy.atleast_1d(numpy.asarray(lon, dtype = float))
+        lat   = numpy.atleast_1d(numpy.asarray(lat, dtype = float))
+        names = numpy.full(numpy.shape(lon), '', dtype = object)
+        dist  = numpy.full(numpy.shape(lon), numpy.nan)
+        valid = numpy.flatnonzero(numpy.isfinite(lon) & numpy.isfinite(lat))
+        if(len(valid) == 0 or len(self.names) == 0):
+            return names, dist
+
+        xyz = _lonlat_to_xyz(lon[valid], lat[valid])
+        k   = min(ncandidates, len(self.names))
+        if(self.tree is not None):
+            chord, ind = self.tree.query(xyz, k = k)
+            ind = numpy.reshape(ind, (len(valid), k))
+        else:
+            ind = numpy.zeros((len(valid), k), dtype = int)
+            for i in range(0, len(valid), chunksize):
+                dot = xyz[i:i+chunksize] @ self.xyz.T
+                ind[i:i+chunksize] = numpy.argpartition(-dot, k - 1, axis = 1)[:,:k]
+
+        # Exact distances of the candidates
+        lonv = numpy.repeat(lon[valid], k)
+        latv = numpy.repeat(lat[valid], k)
+        dist_cand  = get_distance(lonv, latv, self.lon[ind.ravel()], self.lat[ind.ravel()])
+        dist_cand  = numpy.reshape(dist_cand, (len(valid), k))
+        imin       = numpy.argmin(dist_cand, axis = 1)
+        ind        = ind[numpy.arange(len(valid)), imin]
+        dist_valid = dist_cand[numpy.arange(len(valid)), imin]
+        if(max_distance is not None):
+            good       = dist_valid <= max_distance
+            valid      = valid[good]
+            ind        = ind[good]
+            dist_valid = dist_valid[good]
+
+        names[valid] = self.names[ind]
+        dist[valid]  = dist_valid
+        return names, dist
+
+
+def get_station_index():
+    """ Returns the station_index of the stations of get_station_registry(), the index is created only once
+    """
+    return get_station_registry().get_station_index()
@@ -2,196 +2,568 @@
 #import pycnv
 from . import pycnv as pycnv
 import glob
-import fnmatch
 import os
 import sys
 import numpy
 import argparse
 import logging
-import pkg_resources
-import yaml
-from pytz import timezone
 import datetime
-
-
-# Get the version
-version_file = pkg_resources.resource_filename('pycnv','VERSION')
-
-with open(version_file) as version_f:
-   version = version_f.read().strip()
-
-try:
-    from pyproj import Geod
-    FLAG_PYPROJ=True
-    g = Geod(ellps='WGS84')
-except:
-    FLAG_PYPROJ=False
+import threading
+import queue
+import tempfile
+import heapq
+import json
+import time
+from .pycnv import version, format_timings
+from .pycnv_stations import get_stations, get_distance, get_station_index, get_station_registry, FLAG_PYPROJ
+from .pycnv_summary import get_summary_record, create_summary_table
 
 # Setup logging module
 logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
 logger = logging.getLogger('pycnv_sum_folder')
 
 
-def get_stations():
-    stations_file = pkg_resources.resource_filename('pycnv', 'stations/iow_stations.yaml')
-    f_stations = open(stations_file)
-    # use safe_load instead load
-    stations_yaml = yaml.safe_load(f_stations)
-    return stations_yaml['stations']
-    
-def get_all_valid_files(DATA_FOLDER, loglevel = logging.INFO, station = None, save_summary = False, status_function = None, start_time = None, stop_time = None):
+def _scan_dir(path, extensions):
+    """ Scans one directory with os.scandir
+    Args:
+       path: The directory to scan
+       extensions: Tuple of lowercase file extensions, e.g. ('.cnv',)
+    Returns:
+       files: List of files in path with one of the extensions
+       dirs: List of subdirectories (symbolic links are not followed)
+    """
+    files = []
+    dirs  = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            dirs.append(entry.path)
+                    elif entry.name.lower().endswith(extensions):
+                        files.append(entry.path)
+                except OSError as e:
+                    logger.debug('Could not check entry ' + entry.path + ': ' + str(e))
+    except OSError as e:
+        logger.debug('Could not scan folder ' + str(path) + ': ' + str(e))
+
+    return files, dirs
+
+
+def find_cnv_files(DATA_FOLDER, extensions = ('.cnv',), nthreads = 8):
     """
+    Recursively searches the given folder(s) for files with the given extensions. The folders are scanned concurrently by nthreads threads using os.scandir and the extensions are compared case insensitive (i.e. .cnv, .CNV, .Cnv). The found files are yielded as soon as they are found, such that the search and the processing of the files overlap.
     Args:
        DATA_FOLDER: Either list of data_folder or string of one data_folder
-       station: CTD cast has to lie within radius around position, given as a list with longitude [decdeg], latitude [decdeg], radius [m], e.g. [20.0,54.0,5000], if station has 4 arguments it is treated as a rectangle with [lon0,lat0,lon1,lat1] and the cast has to be within lon0 and lon1 as well as lat0 and lat1
-       status_function: A function that is called during reading, the function is called with the current filenumber i, the total number of files nf and the filename f, e.g. function(i,nf,f) 
-       start_time: Casts date need to be after start time [datetime]
-       stop_time: Casts date need to be before stop time [datetime]
+       extensions: Tuple of file extensions
+       nthreads: Number of threads scanning the folders in parallel
     Returns:
-        Dictionary with data
+       Generator yielding the filenames, the order is not defined
     """
-
     if(isinstance(DATA_FOLDER, str)):
         DATA_FOLDER = [DATA_FOLDER]
-    if station == None:
-        FLAG_DIST = False
-    else:
+    if(isinstance(extensions, str)):
+        extensions = (extensions,)
+
+    extensions = tuple(e.lower() for e in extensions)
+    nthreads   = max(1,int(nthreads))
+    dirs       = queue.Queue()
+    results    = queue.Queue()
+    stop       = threading.Event()
+    lock       = threading.Lock()
+    pending    = [len(DATA_FOLDER)] # Number of folders not yet scanned
+    if(pending[0] == 0):
+        return
+
+    def walker():
+        while True:
+            path = dirs.get()
+            if(path is None or stop.is_set()):
+                break
+
+            files, subdirs = _scan_dir(path, extensions)
+            with lock:
+                pending[0] += len(subdirs)
+
+            for d in subdirs:
+                dirs.put(d)
+
+            results.put(files)
+            with lock:
+                pending[0] -= 1
+                FLAG_DONE = pending[0] == 0
+
+            if FLAG_DONE:
+                results.put(None)
+
+    for DATA_P in DATA_FOLDER:
+        dirs.put(DATA_P)
+
+    threads = []
+    for i in range(nthreads):
+        t = threading.Thread(target=walker, daemon=True)
+        t.start()
+        threads.append(t)
+
+    try:
+        while True:
+            files = results.get()
+            if(files is None):
+                break
+
+            for f in sorted(files):
+                yield f
+    finally:
+        # Stop the walkers, also if the generator was not consumed completely
+        stop.set()
+        for t in threads:
+            dirs.put(None)
+
+
+def filter_position(lon, lat, station):
+    """
+    Vectorized check which positions are within a radius around a position or within a rectangle. For a radius a bounding box prefilter is applied first and the distance is only computed for the remaining positions, all in one call.
+    Args:
+       lon: Longitude(s) [decdeg]
+       lat: Latitude(s) [decdeg]
+       station: List with longitude [decdeg], latitude [decdeg], radius [m], e.g. [20.0,54.0,5000], or a rectangle [lon0,lat0,lon1,lat1] (see get_all_valid_files())
+    Returns:
+       ind: Boolean array, True if the position is within the radius/rectangle, positions with NaN are False
+    """
+    lon = numpy.asarray(lon, dtype = float)
+    lat = numpy.asarray(lat, dtype = float)
+    ind = numpy.zeros(numpy.shape(lon), dtype = bool)
+    with numpy.errstate(invalid = 'ignore'):
         if(len(station) == 3): # Sphere with radius
-            londist   = station[0]
-            latdist   = station[1]
-            distdist  = station[2]
-            FLAG_DIST = True            
+            lon0, lat0, dist = float(station[0]), float(station[1]), float(station[2])
+            # Bounding box, one degree latitude is more than 110 km
+            dlat   = dist / 110000.
+            latmax = abs(lat0) + dlat
+            cand   = numpy.abs(lat - lat0) <= dlat
+            if(latmax < 89.):
+                dlon = dlat / numpy.cos(numpy.radians(latmax))
+                cand &= numpy.abs((lon - lon0 + 180.) % 360. - 180.) <= dlon
+
+            cand &= numpy.isfinite(lon)
+            if(cand.any()):
+                ind[cand] = get_distance(lon[cand], lat[cand], lon0, lat0) < dist
         elif(len(station) == 4): # Rectangle
-            londist   = station[0]
-            latdist   = station[1]
-            londist2   = station[2]
-            latdist2   = station[3]            
-            distdist  = -9999
-            FLAG_DIST = True
+            ind = (lon >= station[0]) & (lon <= station[2]) & (lat >= station[1]) & (lat <= station[3])
         else:
             logger.info('Defined position threshold with wrong parameters')
-            FLAG_DIST = False            
+            ind[:] = True
+
+    return ind
 
 
+def iter_valid_files(DATA_FOLDER, loglevel = logging.INFO, station = None, status_function = None, start_time = None, stop_time = None, search_threads = 8, split_profiles = True, timings = None, search_first = None):
+    """
+    Generator searching recursively for cnv files and yielding the parsed pycnv objects fulfilling the constraints. The files are yielded in the order they are found, see get_all_valid_files() for a date sorted list. Files with several profiles (yo-yo) are yielded as the individual profiles (pycnv_view objects with the profile number profile, see pycnv.get_profiles()).
+    Args:
+       DATA_FOLDER: Either list of data_folder or string of one data_folder
+       station: CTD cast has to lie within radius around position, given as a list with longitude [decdeg], latitude [decdeg], radius [m], e.g. [20.0,54.0,5000], if station has 4 arguments it is treated as a rectangle with [lon0,lat0,lon1,lat1] and the cast has to be within lon0 and lon1 as well as lat0 and lat1
+       status_function: A function that is called during reading, the function is called with the current filenumber i, the total number of files nf and the filename f, e.g. function(i,nf,f), nf is None if the total is not known (search_first is False)
+       start_time: Casts date need to be after start time [datetime]
+       stop_time: Casts date need to be before stop time [datetime]
+       search_threads: Number of threads searching the folders for cnv files (see find_cnv_files())
+       split_profiles: Split files with several profiles into the profiles
+       search_first: True: the search for the files is finished before the files are parsed (the total number of files is known), False: the files are parsed while the search is still running, None: True if a status_function is given
+       timings: A list to which (filename, pycnv.timings) of every parsed file is appended (also of invalid files and files outside the constraints), see get_timing_statistics()
+    Returns:
+        Generator yielding pycnv objects or pycnv_view objects (profiles)
+    """
+
+    if(isinstance(DATA_FOLDER, str)):
+        DATA_FOLDER = [DATA_FOLDER]
     if (type(start_time) == datetime.datetime) or (type(stop_time) == datetime.datetime):
         FLAG_TIME = True
         # Check if one of the two is not a datetime
         if(type(start_time) is not datetime.datetime):
-            start_time = datetime.datetime(1,1,1, tzinfo=timezone('UTC'))
+            start_time = datetime.datetime(1,1,1, tzinfo=datetime.timezone.utc)
         if(type(stop_time) is not datetime.datetime):
-            stop_time = datetime.datetime(3000,1,1, tzinfo=timezone('UTC'))            
+            stop_time = datetime.datetime(3000,1,1, tzinfo=datetime.timezone.utc)            
     else:
         FLAG_TIME = False        
         
     #
-    # Loop through all subfolders
+    # Loop through all subfolders, without search_first the files are
+    # parsed while the search is still running and the total number of
+    # files is not known
     #
-    matches = []
-    for DATA_P in DATA_FOLDER:
-        for root, dirnames, fnames in os.walk(DATA_P):
-            #print(root,dirnames,fnames)
-            for fname in fnmatch.filter(fnames, '*.cnv'):
-                matches.append(os.path.join(root, fname))
-                #print(matches[-1])
-                if(numpy.mod(len(matches),100) == 0):
-                    logger.info('Found ' + str(len(matches)) + ' files')
-
-            for fname in fnmatch.filter(fnames, '*.CNV'):
-                matches.append(os.path.join(root, fname))
-                if(numpy.mod(len(matches),100) == 0):
-                    logger.info('Found ' + str(len(matches)) + ' files')
-                #print(matches[-1])        
-
-
-    logger.info('Found ' + str(len(matches)) + ' cnv files in folder(s):' + str(DATA_FOLDER))
-    if(len(matches) == 0):
+    if(search_first is None):
+        search_first = status_function is not None
+
+    files = find_cnv_files(DATA_FOLDER, nthreads = search_threads)
+    ntotal = None
+    if(search_first):
+        files  = list(files)
+        ntotal = len(files)
+        logger.info('Found ' + str(ntotal) + ' cnv files')
+
+    nf = 0
+    for f in files:
+        i   = nf
+        nf += 1
+        if(ntotal is None):
+            if(nf % 100 == 0):
+                logger.info('Found ' + str(nf) + ' files')
+            logger.info('Parsing file ' + str(i) + ': ' + str(f))
+        else:
+            logger.info('Parsing file ' + str(i) +'/' + str(ntotal) + ': ' + str(f))
         if(status_function is not None):
-            print('Status function nothing found')
-            status_function(0,0,'Nothing found')        
-        return {'files':[],'dates':[],'lon':[],'lat':[],'info_dict':[]}
-    save_file       = []
-    files_date      = []
-    file_names_save = []
-    files_lon_save  = []
-    files_lat_save  = []        
-    files_date_save = []
-    files_summary   = []
-    files_info_dict = []    
-    if(len(matches) > 0):
-        # Write the header of the file
-        #print('Hallo',matches[0])
-        cnv = pycnv(matches[0],verbosity=logging.CRITICAL)
-
-        # Loop through all files and make summary
-        nf = len(matches)
-        for i,f in enumerate(matches):
-            logger.info('Parsing file ' + str(i) +'/' + str(nf) + ': ' + str(f))
-            if(status_function is not None):
-                #print('Status function')
-                status_function(i,nf,f)
-            cnv = pycnv(f,verbosity=loglevel)
-            if(cnv.valid_cnv):
-                files_date.append(cnv.date)
-                summary = cnv.get_summary()
+            #print('Status function')
+            status_function(i,ntotal,f)
+        cnv_file = pycnv(f,verbosity=loglevel)
+        if(timings is not None):
+            timings.append((f, cnv_file.timings))
+        if(cnv_file.valid_cnv):
+            casts = []
+            if(split_profiles):
+                casts = cnv_file.get_profiles(multi_only = True)
+                if(len(casts) > 0):
+                    logger.info('Found ' + str(len(casts)) + ' profiles in file: ' + str(f))
+            if(len(casts) == 0):
+                casts = [cnv_file]
+
+            for cnv in casts:
                 FLAG_GOOD_DIST = False
                 FLAG_GOOD_TIME = False
-                # Check if we are within a distance
-                lon = cnv.lon
-                lat = cnv.lat
                 if(FLAG_TIME):
                     if((cnv.date > start_time) and (cnv.date < stop_time)):
                         FLAG_GOOD_TIME = True
                 else:
                     FLAG_GOOD_TIME = True
-                    
-                if(FLAG_DIST):
-                    if(not(numpy.isnan(lon)) and not(numpy.isnan(lat))):
-                        print('Distance')
-                        if(distdist > 0): # Radius defined
-                            az12,az21,dist = g.inv(lon,lat,londist,latdist)
-                            print('Radius, distance:' + str(dist) + ' m')
-                            if(dist < distdist):
-                                print('Radius good')
-                                FLAG_GOOD_DIST = True
-                            else:
-                                print('Too far away')
-                        else: # Rectangle defined
-                            print('Rectangle')
-                            if((lon >= londist) and (lon <= londist2) and (lat >= latdist) and (lat <= latdist2)):
-                                print('Rectangle good')
-                                FLAG_GOOD_DIST = True
 
+                # Check if we are within a distance
+                if(station != None):
+                    FLAG_GOOD_DIST = filter_position([cnv.lon], [cnv.lat], station)[0]
                 else:
                     FLAG_GOOD_DIST = True
 
                 if(FLAG_GOOD_DIST and FLAG_GOOD_TIME):
-                    save_file.append(True)
-                    file_names_save.append(f)
-                    files_date_save.append(cnv.date)
-                    files_lon_save.append(lon)
-                    files_lat_save.append(lat)
-                    files_summary.append(summary)
-                    files_info_dict.append(cnv.get_info_dict()) # This will be the standard for future development
-                else:
-                    save_file.append(False)
+                    yield cnv
 
-        # Save the with respect to date sorted file
-        logger.info('Sorting all files')
-        # Replace invalid dates with an obviously wrong date to be able to sort them
-        for i in range(len(files_date_save)):
-            if(files_date_save[i] == None):
-                files_date_save[i] = datetime.datetime(1,1,1).replace(tzinfo=timezone('UTC'))
+    logger.info('Found ' + str(nf) + ' cnv files in folder(s):' + str(DATA_FOLDER))
+    if(nf == 0):
+        if(status_function is not None):
+            print('Status function nothing found')
+            status_function(0,0,'Nothing found')        
 
-        ind_sort = numpy.argsort(files_date_save)                
-        file_names_save_sort = list(numpy.asarray(file_names_save)[ind_sort])
-        retdata  = {'files':file_names_save_sort,'dates':list(numpy.asarray(files_date_save)[ind_sort]),'lon':list(numpy.asarray(files_lon_save)[ind_sort]),'lat':list(numpy.asarray(files_lat_save)[ind_sort]),'info_dict':list(numpy.asarray(files_info_dict)[ind_sort])}
 
+def _sort_date(date):
+    """ Replaces invalid dates with an obviously wrong date to be able to sort them
+    """
+    if(date == None):
+        return datetime.datetime(1,1,1).replace(tzinfo=datetime.timezone.utc)
+    else:
+        return date
+
+
+def get_timing_statistics(timings, elapsed = None, nslowest = 10):
+    """
+    Aggregates the stage timings of parsed files (see pycnv.timings and iter_valid_files()) into throughput statistics
+    Args:
+       timings: List of (filename, pycnv.timings)
+       elapsed: Wall time of the whole scan [s] (including the search for the files), None for the sum of the total time of the files
+       nslowest: Number of slowest files listed
+    Returns:
+       Dictionary with 'nfiles', 'bytes' (sum of the file sizes), 'elapsed', 'files_per_s', 'MB_per_s', 'stages' (the summed timings of each stage, see pycnv.format_timings()) and 'slowest' (list of (filename, total time [s]) of the slowest files)
+    """
+    stages = {}
+    totals = []
+    for f, timing in timings:
+        for stage, t in timing.items():
+            if(stage not in stages):
+                stages[stage] = {'time':0.0,'bytes':0,'rows':0,'calls':0}
+            for key in stages[stage]:
+                stages[stage][key] += t[key]
+        if('total' in timing):
+            totals.append((timing['total']['time'], f))
+
+    # The total time last
+    if('total' in stages):
+        stages['total'] = stages.pop('total')
+    nbytes = stages['total']['bytes'] if 'total' in stages else 0
+    if(elapsed is None):
+        elapsed = stages['total']['time'] if 'total' in stages else 0.0
+
+    stats = {'nfiles':len(timings),'bytes':nbytes,'elapsed':elapsed,'stages':stages}
+    stats['files_per_s'] = len(timings) / elapsed if elapsed > 0 else numpy.NaN
+    stats['MB_per_s']    = nbytes / elapsed / 1e6 if elapsed > 0 else numpy.NaN
+    stats['slowest']     = [(f, dt) for dt, f in heapq.nlargest(nslowest, totals)]
+    return stats
+
+
+def format_timing_statistics(stats):
+    """
+    Formats the statistics of get_timing_statistics() as a string
+    """
+    title  = 'Parsed {:d} files ({:.1f} MB) in {:.2f} s: {:.1f} files/s, {:.1f} MB/s'.format(stats['nfiles'], stats['bytes'] / 1e6, stats['elapsed'], stats['files_per_s'], stats['MB_per_s'])
+    rstr   = format_timings(stats['stages'], title = title)
+    if(len(stats['slowest']) > 0):
+        rstr += '\nSlowest files:'
+        for f, dt in stats['slowest']:
+            rstr += '\n{:10.4f} s {:s}'.format(dt, f)
+
+    return rstr
+
+
+def get_all_valid_files(DATA_FOLDER, loglevel = logging.INFO, station = None, save_summary = False, status_function = None, start_time = None, stop_time = None, search_threads = 8, split_profiles = True, search_first = None):
+    """
+    Args:
+       DATA_FOLDER: Either list of data_folder or string of one data_folder
+       station: CTD cast has to lie within radius around position, given as a list with longitude [decdeg], latitude [decdeg], radius [m], e.g. [20.0,54.0,5000], if station has 4 arguments it is treated as a rectangle with [lon0,lat0,lon1,lat1] and the cast has to be within lon0 and lon1 as well as lat0 and lat1
+       status_function: A function that is called during reading, the function is called with the current filenumber i, the total number of files nf and the filename f, e.g. function(i,nf,f), nf is None if the total is not known (search_first is False)
+       start_time: Casts date need to be after start time [datetime]
+       stop_time: Casts date need to be before stop time [datetime]
+       search_threads: Number of threads searching the folders for cnv files (see find_cnv_files())
+       split_profiles: Files with several profiles (yo-yo) are listed as the individual profiles, the number of the profile is given in 'profile' (0 for files with one cast)
+       search_first: Finish the search for the files before parsing them, None: if a status_function is given (see iter_valid_files())
+    Returns:
+        Dictionary with data, 'table' is the summary of all casts as summary_table (see pycnv_summary), 'summary' (if save_summary) the summary of each cast as string, 'timings' the throughput statistics of parsing the files (see get_timing_statistics())
+    """
+
+    file_names_save = []
+    files_lon_save  = []
+    files_lat_save  = []        
+    files_date_save = []
+    files_records   = []
+    files_info_dict = []    
+    files_profile   = []
+    timings         = []
+    t0              = time.perf_counter()
+    # The position constraint is applied to all casts at once after parsing
+    for cnv in iter_valid_files(DATA_FOLDER, loglevel = loglevel, status_function = status_function, start_time = start_time, stop_time = stop_time, search_threads = search_threads, split_profiles = split_profiles, timings = timings, search_first = search_first):
+        file_names_save.append(cnv.filename)
+        files_profile.append(getattr(cnv, 'profile', 0))
+        files_date_save.append(_sort_date(cnv.date))
+        files_lon_save.append(cnv.lon)
+        files_lat_save.append(cnv.lat)
+        files_records.append(get_summary_record(cnv))
+        files_info_dict.append(cnv.get_info_dict()) # This will be the standard for future development
+
+    timing_stats = get_timing_statistics(timings, time.perf_counter() - t0)
+
+    if(station != None and len(file_names_save) > 0):
+        ind_pos = filter_position(files_lon_save, files_lat_save, station)
+        ind_pos = numpy.flatnonzero(ind_pos)
+        file_names_save = [file_names_save[i] for i in ind_pos]
+        files_lon_save  = [files_lon_save[i] for i in ind_pos]
+        files_lat_save  = [files_lat_save[i] for i in ind_pos]
+        files_date_save = [files_date_save[i] for i in ind_pos]
+        files_info_dict = [files_info_dict[i] for i in ind_pos]
+        files_profile   = [files_profile[i] for i in ind_pos]
+        files_records   = [files_records[i] for i in ind_pos]
+
+    if(len(file_names_save) == 0):
+        retdata = {'files':[],'dates':[],'lon':[],'lat':[],'info_dict':[],'profile':[],'table':create_summary_table([]),'timings':timing_stats}
         if save_summary:
-            summary_array = numpy.asarray(files_summary)[ind_sort]
-            retdata['summary'] = summary_array
-        
+            retdata['summary'] = numpy.zeros(0, dtype = str)
         return retdata
 
+    # Label each cast with its nearest station
+    station_nearest, station_dist = get_station_index().nearest(files_lon_save, files_lat_save)
+    for i,info_dict in enumerate(files_info_dict):
+        info_dict['station_nearest'] = station_nearest[i]
+        info_dict['station_dist']    = station_dist[i]
+        info_dict['profile']         = files_profile[i]
+        files_records[i]['station_nearest'] = station_nearest[i]
+        files_records[i]['station_dist']    = station_dist[i]
+
+    # Save the with respect to date sorted file
+    logger.info('Sorting all files')
+    # The search order is not defined, sort equal dates by filename
+    ind_sort = sorted(range(len(files_date_save)), key = lambda i: (files_date_save[i], file_names_save[i], files_profile[i]))
+    file_names_save_sort = list(numpy.asarray(file_names_save)[ind_sort])
+    retdata  = {'files':file_names_save_sort,'dates':list(numpy.asarray(files_date_save)[ind_sort]),'lon':list(numpy.asarray(files_lon_save)[ind_sort]),'lat':list(numpy.asarray(files_lat_save)[ind_sort]),'info_dict':list(numpy.asarray(files_info_dict)[ind_sort])}
+    retdata['station_nearest'] = list(station_nearest[ind_sort])
+    retdata['station_dist']    = list(station_dist[ind_sort])
+    retdata['profile']         = [files_profile[i] for i in ind_sort]
+    retdata['table']           = create_summary_table([files_records[i] for i in ind_sort])
+    retdata['timings']         = timing_stats
+
+    if save_summary:
+        retdata['summary'] = retdata['table'].get_summary()
+    
+    return retdata
+
+
+def iter_casts(casts, **kwargs):
+    """
+    Iterates over casts given as the dictionary of get_all_valid_files(), as pycnv objects or as filenames. The files of the dictionary are read again and profiles of multi-profile files are selected by the profile number.
+    Args:
+       casts: The dictionary returned by get_all_valid_files(), an iterable of pycnv objects (e.g. iter_valid_files()) or an iterable of cnv filenames
+       **kwargs: Passed to pycnv() if files are read
+    Returns:
+       Generator yielding pycnv or pycnv_view objects
+    """
+    if(isinstance(casts, dict)):
+        profiles = casts.get('profile', [0] * len(casts['files']))
+        cnv      = None
+        for f,profile in zip(casts['files'], profiles):
+            # Profiles of one file are read only once if they are consecutive
+            if(cnv is None or cnv.filename != f):
+                cnv = pycnv(f, **kwargs)
+            if(profile == 0 or not(cnv.valid_cnv)):
+                yield cnv
+            else:
+                yield cnv.get_profiles(multi_only = True)[profile - 1]
+    else:
+        for cnv in casts:
+            if(isinstance(cnv, str)):
+                cnv = pycnv(cnv, **kwargs)
+            yield cnv
+
+
+class _double_counter(object):
+    """ Numbers casts with the same date and position, i.e. files with
+    the same origin but probably different postprocessing of the
+    seabird software. The casts have to be given sorted by date,
+    otherwise (date_sorted=False) all positions are kept in memory.
+    """
+    def __init__(self, date_sorted = True):
+        self.date_sorted = date_sorted
+        self.num         = 0
+        self.date        = None
+        self.positions   = {}
+
+    def __call__(self, date, lon, lat):
+        if(self.date_sorted and date != self.date):
+            self.date      = date
+            self.positions = {}
+
+        # Casts without a valid position are not numbered
+        if(numpy.isnan(lon) or numpy.isnan(lat)):
+            return 0
+
+        key = (date, lon, lat)
+        if key not in self.positions:
+            self.num += 1
+            self.positions[key] = self.num
+
+        return self.positions[key]
+
+
+def _profile_summary(profile, header = False):
+    """ Returns the profile number (0 for files with one cast) in the csv format of the summary, the column is appended to the summary of the cast
+    """
+    sep = ','
+    if(header):
+        return sep + 'profile'
+    else:
+        return sep + '{:4d}'.format(profile)
+
+
+def _station_summary(name, dist, header = False):
+    """ Returns the nearest station and its distance in the csv format of the summary, the columns are appended to the summary of the cast
+    """
+    sep = ','
+    if(header):
+        return sep + 'station nearest' + sep + 'station dist'
+    else:
+        return sep + '{:>8s}'.format(name) + sep + '{: 9.0f}'.format(dist)
+
+
+def _write_summary_run(run):
+    """ Sorts a list of summary records and writes it into a temporary file, one json encoded record per line
+    """
+    run.sort()
+    frun = tempfile.TemporaryFile(mode = 'w+')
+    for rec in run:
+        frun.write(json.dumps(rec))
+        frun.write('\n')
+
+    frun.seek(0)
+    return frun
+
+
+def write_summary(DATA_FOLDER, filename = None, print_summary = False, sort = True, run_size = 10000, **kwargs):
+    """
+    Searches for cnv files and writes the summary of each valid file while the files are parsed. The memory usage is independent of the number of files. If sort is True the summaries are sorted by date with an external merge sort: runs of run_size summaries are sorted in memory, written into temporary files and merged at the end. If sort is False each summary is written as soon as the file is parsed.
+    Args:
+       DATA_FOLDER: Either list of data_folder or string of one data_folder
+       filename: The file the summary is written to (None for no file)
+       print_summary: Prints the summary to stdout
+       sort: Sort the summary by date
+       run_size: Number of summaries sorted in memory
+       **kwargs: Passed to iter_valid_files(), e.g. station, start_time, stop_time
+    Returns:
+       num_wr: Number of written summaries
+    """
+    sep = ','
+    if(filename != None):
+        fi = open(filename, 'w', buffering = 2**20)
+    else:
+        fi = None
+
+    def write_line(line):
+        if(print_summary):
+            print(line)
+        if(fi != None):
+            fi.write(line)
+            fi.write('\n')
+
+    num_d  = _double_counter(date_sorted = sort)
+    num_wr = 0
+    runs   = []
+    run    = []
+    try:
+        for cnv in iter_valid_files(DATA_FOLDER, **kwargs):
+            if(num_wr == 0 and len(run) == 0 and len(runs) == 0):
+                write_line('num file' + sep + 'num double' + sep + cnv.get_summary(header=True) + _station_summary(None, None, header=True) + _profile_summary(None, header=True))
+
+            date = _sort_date(cnv.date)
+            station_nearest, station_dist = get_station_index().nearest(cnv.lon, cnv.lat)
+            summary = cnv.get_summary() + _station_summary(station_nearest[0], station_dist[0]) + _profile_summary(getattr(cnv, 'profile', 0))
+            if(sort):
+                run.append((date.timestamp(), cnv.filename, cnv.lon, cnv.lat, summary))
+                if(len(run) >= run_size):
+                    runs.append(_write_summary_run(run))
+                    run = []
+            else:
+                write_line('{:5d}'.format(num_wr) + sep + '{:5d}'.format(num_d(date, cnv.lon, cnv.lat)) + sep + summary)
+                num_wr += 1
+
+        if(sort):
+            if(len(runs) == 0): # Everything fits into memory
+                run.sort()
+                merged = run
+            else:
+                if(len(run) > 0):
+                    runs.append(_write_summary_run(run))
+                run    = []
+                merged = heapq.merge(*[map(json.loads, frun) for frun in runs])
+
+            for rec in merged:
+                date = datetime.datetime.fromtimestamp(rec[0], tz = datetime.timezone.utc)
+                write_line('{:5d}'.format(num_wr) + sep + '{:5d}'.format(num_d(date, rec[2], rec[3])) + sep + rec[4])
+                num_wr += 1
+    finally:
+        for frun in runs:
+            frun.close()
+        if(fi != None):
+            fi.close()
+
+    logger.info('Wrote ' + str(num_wr) + ' summaries (' + str(num_d.num) + ' with unique datasets)')
+    return num_wr
+
+
+def _write_netcdf(casts, filename):
+    """ Writes the casts into one netCDF file, see pycnv_netcdf.write_nc_profiles()
+    """
+    from .pycnv_netcdf import write_nc_profiles
+    nprofile, nobs = write_nc_profiles(casts, filename)
+    logger.info('Wrote ' + str(nprofile) + ' profiles with ' + str(nobs) + ' measurements into file:' + filename)
+
+
+def _write_parquet(casts, root):
+    """ Writes the casts into a parquet dataset, see pycnv_parquet.write_parquet()
+    """
+    from .pycnv_parquet import write_parquet
+    files = write_parquet(casts, root)
+    logger.info('Wrote ' + str(len(files)) + ' parquet files into folder:' + root)
+
 
 def main():
 
@@ -206,6 +578,11 @@ def main():
     station_help     = 'Only take files which are within a distance to station'
     stationlist_help = 'Lists all known stations with their names and positions'
     print_help       = 'Prints for each line the summary to stdout'
+    stream_help      = 'Writes the summary while the files are parsed with a constant memory usage, the summary is sorted by date with an external merge sort'
+    unsorted_help    = 'Writes the summary of each file immediately after parsing in the order the files are found (implies --stream)'
+    netcdf_help      = 'Writes all found casts into one netCDF file (CF contiguous ragged array of profiles)'
+    parquet_help     = 'Writes all found casts into a parquet dataset in the given folder, partitioned by year, cruise and station'
+    timings_help     = 'Prints the throughput (files/s, MB/s), the time spent in each stage of parsing the files and the slowest files to stderr'
     verb_help        = 'Add -v to increase verbosity of command'
     parser           = argparse.ArgumentParser(description=desc)
 
@@ -217,6 +594,11 @@ def main():
     parser.add_argument('--list_stations'    , '-ls', action='store_true', help=stationlist_help)
     parser.add_argument('--verbose', '-v'    , action='count',help=verb_help)
     parser.add_argument('--print_summary'    , '-p', action='store_true', help=print_help)
+    parser.add_argument('--stream'           , action='store_true', help=stream_help)
+    parser.add_argument('--unsorted'         , action='store_true', help=unsorted_help)
+    parser.add_argument('--netcdf'           , default = None, help=netcdf_help)
+    parser.add_argument('--parquet'          , default = None, help=parquet_help)
+    parser.add_argument('--timings'          , action='store_true', help=timings_help)
     parser.add_argument('--version', action='version', version='%(prog)s ' + str(version))
 
     args = parser.parse_args()
@@ -266,8 +648,7 @@ def main():
         constraint_station[2]  = distdist                            
         logger.info('Will search for profiles within a ' + str(distdist) + ' m radius around station with longitude ' + str(londist) + ' and latitude ' + str(latdist))
         if(FLAG_PYPROJ == False):
-            logger.critical('pyproj is not installed, cannot compute distance, exiting')
-            exit()
+            logger.warning('pyproj is not installed, computing the distance with the haversine formula')
     else:
         FLAG_DIST=False
 
@@ -284,46 +665,32 @@ def main():
             sname_tmp = args.station[0]
         else:
             sname_tmp = None
-        stations_file = pkg_resources.resource_filename('pycnv', 'stations/iow_stations.yaml')
-        print('Stations file:',stations_file)
-        f_stations = open(stations_file)
-        # use safe_load instead load
-        stations_yaml = yaml.safe_load(f_stations)
-        f_stations.close()
-
-        for i,station in enumerate(stations_yaml['stations']):
-            namestation = [station['name']]
-            lonstation  = station['longitude']
-            latstation  = station['latitude']
-            try:
-                anames = station['alternative_names']
-            except:
-                anames = []
-
-                
-            namestation.extend(anames)
-            for sname in namestation:
-                if(sname == sname_tmp):
-                    FLAG_DIST=True
-                    logger.info('Found station')
-                    londist  = lonstation
-                    latdist  = latstation
-                    distdist = float(args.station[1])
-                    # Creating a dictionary for the get_valid_files function
-                    constraint_station = [None,None,None]
-                    constraint_station[0]  = londist
-                    constraint_station[1]  = latdist
-                    constraint_station[2]  = distdist                    
-                    logger.info('Will search for profiles within a ' + str(distdist) +\
-                                 ' m radius around station ' + str(sname) + ' with longitude '\
-                                  + str(londist) + ' and latitude ' + str(latdist))
-                    if(FLAG_PYPROJ == False):
-                        logger.critical('pyproj is not installed, cannot compute distance, exiting')
-                        sys.exit(1)
-
-
-            if(args.list_stations == True):
-                print(namestation,lonstation,latstation)
+        registry = get_station_registry()
+        print('Stations file:',registry.filename)
+        if(sname_tmp != None):
+            station = registry.get(sname_tmp)
+            if(station != None):
+                FLAG_DIST=True
+                logger.info('Found station')
+                londist  = station['longitude']
+                latdist  = station['latitude']
+                distdist = float(args.station[1])
+                # Creating a dictionary for the get_valid_files function
+                constraint_station = [None,None,None]
+                constraint_station[0]  = londist
+                constraint_station[1]  = latdist
+                constraint_station[2]  = distdist                    
+                logger.info('Will search for profiles within a ' + str(distdist) +\
+                             ' m radius around station ' + str(sname_tmp) + ' with longitude '\
+                              + str(londist) + ' and latitude ' + str(latdist))
+                if(FLAG_PYPROJ == False):
+                    logger.warning('pyproj is not installed, computing the distance with the haversine formula')
+
+        if(args.list_stations == True):
+            for station in registry.stations:
+                namestation = [station['name']]
+                namestation.extend(station.get('alternative_names', []))
+                print(namestation,station['longitude'],station['latitude'])
 
         if(FLAG_DIST == False and sname_tmp != None):
             logger.critical('Could not find a station with name ' + args.station[0] +  ' in station file, exiting.')
@@ -342,75 +709,59 @@ def main():
         logger.critical('Specify a data path to search for cnv files ... exiting')
         sys.exit(0)
 
+    #
+    # Streaming mode, the summary is written while the files are parsed
+    #
+    if(args.stream or args.unsorted):
+        if(filename != None):
+            fi.close()
+        timings = [] if args.timings else None
+        t0      = time.perf_counter()
+        num_wr  = write_summary(DATA_FOLDER, filename = filename, print_summary = print_summary, sort = not(args.unsorted), loglevel = loglevel, station = constraint_station, timings = timings)
+        if(args.timings):
+            print(format_timing_statistics(get_timing_statistics(timings, time.perf_counter() - t0)), file = sys.stderr)
+        if(filename != None):
+            logger.info('Wrote ' +str(num_wr) + ' datasets into file:' + filename)
+        if(args.netcdf != None):
+            casts = iter_valid_files(DATA_FOLDER, loglevel = loglevel, station = constraint_station)
+            _write_netcdf(casts, args.netcdf)
+        if(args.parquet != None):
+            casts = iter_valid_files(DATA_FOLDER, loglevel = loglevel, station = constraint_station)
+            _write_parquet(casts, args.parquet)
+        return
+
     # Read in all potential cnv files, this "double" reading is (probably)
     # necessary for sorting them without saving all the data into RAM
     # TODO, if more speed is needed more data can be saved into cnv_data
     logger.info('Checking for double datasets')
-    cnv_data = get_all_valid_files(DATA_FOLDER, loglevel = loglevel, station = constraint_station, save_summary = True)
-    # Searching for files with the same origin (but probably different postprocessing of the seabird software)
-    lon_d      = numpy.asarray(cnv_data['lon'])
-    lat_d      = numpy.asarray(cnv_data['lat'])
-    date_d     = numpy.asarray(cnv_data['dates'])
-    checked_d  = numpy.zeros(len(lon_d),dtype=int)
-    num_d      = numpy.zeros(len(lon_d),dtype=int)
-
-                    
-    for i in range(len(lon_d)):
-        if(checked_d[i] == 0):
-            checked_d[i]       = 1
-            ind_date           = date_d[i] == date_d
-            ind_lon            = lon_d[i] == lon_d
-            ind_lat            = lat_d[i] == lat_d
-            ind_all            = ind_date & ind_lon & ind_lat
-            checked_d[ind_all] = 1
-            num_d[ind_all]     = num_d.max() + 1
-
-    
-    file_names_save = cnv_data['files']
-    # Save the valid files into the specified file or print it to console
-    if True:
-        num_wr = 0
-        for nf,fname in enumerate(file_names_save):
-            #FLAG_GOOD = save_file[ind]
-            #if(FLAG_GOOD):
-                #cnv = pycnv.pycnv(matches[ind],verbosity=logging.CRITICAL)
-            if True:
-                if(nf == 0):
-                    cnv        = pycnv(fname,verbosity=logging.CRITICAL)
-                    cnv_header = cnv.get_summary(header=True)                
-                    #summary    = cnv.get_summary()
-                    
-                summary = cnv_data['summary'][nf]
-                    
-                # Adding information about double files
-                sep = ','
-                summary = '{:5d}'.format(nf) + sep + '{:5d}'.format(num_d[nf]) + sep + summary
-                cnv_header = 'num file'+ sep + 'num double' + sep + cnv_header
-                if(print_summary):
-                    if(nf == 0):
-                        print(cnv_header)
-                        
-                    print(summary)
-                if(filename != None):
-                    if(nf == 0):
-                        fi.write(cnv_header)
-                        fi.write('\n')
-                    fi.write(summary)
-                    fi.write('\n')
-                    fi.flush()
-                    num_wr +=1
-
-    else:
-        print('No files found ... ')
+    cnv_data = get_all_valid_files(DATA_FOLDER, loglevel = loglevel, station = constraint_station)
+    table    = cnv_data['table']
+    # The summary is written in one call, files with the same origin (but
+    # probably different postprocessing of the seabird software) are numbered
+    # in the column num double
+    if(len(table) > 0):
+        csv = table.to_csv()
+        if(print_summary):
+            print(csv, end = '')
+        if(filename != None):
+            fi.write(csv)
 
     nunique = 0
-    if(len(num_d) > 0):
-        nunique = num_d.max()
-    logger.info('Read ' +str(len(file_names_save)) + ' files (' + str(nunique) + ' with unique datasets)')
+    if(len(table) > 0):
+        nunique = table.num_double().max()
+    logger.info('Read ' +str(len(table)) + ' files (' + str(nunique) + ' with unique datasets)')
     if(filename != None):
-        logger.info('Wrote ' +str(num_wr) + ' datasets into file:' + filename)
+        logger.info('Wrote ' +str(len(table)) + ' datasets into file:' + filename)
         fi.close()
 
+    if(args.timings):
+        print(format_timing_statistics(cnv_data['timings']), file = sys.stderr)
+
+    if(args.netcdf != None):
+        _write_netcdf(cnv_data, args.netcdf)
+    if(args.parquet != None):
+        _write_parquet(cnv_data, args.parquet)
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,267 @@
+#
+# Columnar summary of many casts
+#
+import sys
+import datetime
+import logging
+import numpy
+
+# Setup logging module
+logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+logger = logging.getLogger('pycnv_summary')
+
+# The columns of the summary table and their dtypes, string columns (None)
+# get the width of their longest entry
+summary_columns = [('file', None), ('profile', numpy.int32), ('date', 'datetime64[s]'), ('lon', numpy.float64), ('lat', numpy.float64), ('pmin', numpy.float64), ('pmax', numpy.float64), ('nsamples', numpy.int64), ('baltic', bool), ('station', None), ('station_nearest', None), ('station_dist', numpy.float64), ('sha1', None)]
+
+# The columns of cnv.get_summary()
+cnv_summary_columns = ['date', 'lat', 'lon', 'p min', 'p max', 'num p samples', 'baltic', 'file']
+
+
+def _to_datetime64(date):
+    """ Converts a datetime into a numpy datetime64 (UTC), NaT for None
+    """
+    if(date is None):
+        return numpy.datetime64('NaT', 's')
+    if(date.tzinfo is not None):
+        date = date.astimezone(datetime.timezone.utc).replace(tzinfo = None)
+
+    return numpy.datetime64(date, 's')
+
+
+def get_summary_record(cnv):
+    """
+    Returns the summary of a cast as a dictionary with the columns of the summary table (without station_nearest and station_dist)
+    Args:
+       cnv: pycnv or pycnv_view object
+    Returns:
+       Dictionary
+    """
+    pmin = numpy.nan
+    pmax = numpy.nan
+    num_samples = 0
+    if(cnv.data is not None):
+        try:
+            pmin = cnv.data['p'].min()
+            pmax = cnv.data['p'].max()
+            num_samples = len(cnv.data['p'])
+        except Exception:
+            pass
+
+    try:
+        station = cnv.iow['station']
+    except Exception:
+        station = ''
+
+    record = {}
+    record['file']     = cnv.filename
+    record['profile']  = getattr(cnv, 'profile', 0)
+    record['date']     = _to_datetime64(cnv.date)
+    record['lon']      = numpy.nan if cnv.lon is None else cnv.lon
+    record['lat']      = numpy.nan if cnv.lat is None else cnv.lat
+    record['pmin']     = pmin
+    record['pmax']     = pmax
+    record['nsamples'] = num_samples
+    record['baltic']   = bool(cnv.baltic)
+    record['station']  = '' if station is None else str(station)
+    record['sha1']     = '' if cnv.sha1 is None else str(cnv.sha1)
+    return record
+
+
+def create_summary_table(records):
+    """
+    Creates a summary table of records (see get_summary_record())
+    Args:
+       records: List of dictionaries, missing columns are empty (strings), NaN (floats) or 0
+    Returns:
+       summary_table
+    """
+    dtype   = []
+    columns = {}
+    for name, dt in summary_columns:
+        if(dt is None):
+            values = [str(r.get(name, '')) for r in records]
+            dt     = 'U' + str(max([len(v) for v in values] + [1]))
+        elif(dt == numpy.float64):
+            values = [r.get(name, numpy.nan) for r in records]
+        elif(dt == 'datetime64[s]'):
+            values = [r.get(name, numpy.datetime64('NaT', 's')) for r in records]
+        else:
+            values = [r.get(name, 0) for r in records]
+        dtype.append((name, dt))
+        columns[name] = values
+
+    data = numpy.zeros(len(records), dtype = dtype)
+    for name in columns:
+        data[name] = columns[name]
+
+    return summary_table(data)
+
+
+class summary_table(object):
+    """
+
+    A columnar summary of casts, data is a numpy structured array with
+    one row per cast and the columns file, profile, date (datetime64,
+    UTC), lon, lat, pmin, pmax, nsamples, baltic, station (of the
+    header), station_nearest, station_dist and sha1. A column is returned
+    by table['column'] and a row by table[i], a slice, boolean mask or
+    index array returns a new table.
+
+    Usage:
+       >>>cnv_data = get_all_valid_files('cruises/')
+       >>>table = cnv_data['table']
+       >>>deep = table[table['pmax'] > 100]
+       >>>deep.select(start_time = datetime.datetime(2019,1,1)).sort(['station_nearest','date']).to_csv('deep.csv')
+
+    Args:
+       data: Structured array with the columns of summary_columns
+
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        if(isinstance(key, (str, int, numpy.integer))):
+            return self.data[key]
+        return summary_table(self.data[key])
+
+    def __iter__(self):
+        return iter(self.data)
+
+    @property
+    def columns(self):
+        return list(self.data.dtype.names)
+
+    def __str__(self):
+        return 'summary_table with ' + str(len(self)) + ' casts'
+
+    def select(self, start_time = None, stop_time = None, station = None, baltic = None):
+        """
+        Returns the casts fulfilling all given constraints
+        Args:
+           start_time: Casts date need to be after start time [datetime]
+           stop_time: Casts date need to be before stop time [datetime]
+           station: Position constraint, list with longitude [decdeg], latitude [decdeg], radius [m] or a rectangle [lon0,lat0,lon1,lat1] (see pycnv_sum_folder.filter_position())
+           baltic: True/False for casts in/outside of the Baltic Sea
+        Returns:
+           summary_table
+        """
+        ind = numpy.ones(len(self), dtype = bool)
+        if(start_time is not None):
+            ind &= self.data['date'] > _to_datetime64(start_time)
+        if(stop_time is not None):
+            ind &= self.data['date'] < _to_datetime64(stop_time)
+        if(station is not None):
+            from .pycnv_sum_folder import filter_position
+            ind &= filter_position(self.data['lon'], self.data['lat'], station)
+        if(baltic is not None):
+            ind &= self.data['baltic'] == bool(baltic)
+
+        return self[ind]
+
+    def argsort(self, order = ('date','file','profile')):
+        """
+        Returns the indices sorting the table by the given columns, casts without date are sorted to the end
+        """
+        if(isinstance(order, str)):
+            order = [order]
+        return numpy.lexsort([self.data[name] for name in reversed(list(order))])
+
+    def sort(self, order = ('date','file','profile')):
+        """
+        Returns the table sorted by the given columns (see argsort())
+        """
+        return self[self.argsort(order)]
+
+    def num_double(self):
+        """
+        Numbers casts with the same date and position, i.e. files with the same origin but probably different postprocessing of the seabird software. The numbers are given in the order of the table, casts without a valid position get 0.
+        Returns:
+           Array of int
+        """
+        num   = numpy.zeros(len(self), dtype = int)
+        valid = numpy.flatnonzero(numpy.isfinite(self.data['lon']) & numpy.isfinite(self.data['lat']))
+        if(len(valid) == 0):
+            return num
+        keys = numpy.zeros(len(valid), dtype = [('date','datetime64[s]'),('lon',float),('lat',float)])
+        for name in keys.dtype.names:
+            keys[name] = self.data[name][valid]
+        uniq, first, inverse = numpy.unique(keys, return_index = True, return_inverse = True)
+        # Number the unique positions in the order of their first occurrence
+        rank = numpy.empty(len(first), dtype = int)
+        rank[numpy.argsort(first, kind = 'stable')] = numpy.arange(1, len(first) + 1)
+        num[valid] = rank[inverse.ravel()]
+        return num
+
+    def format_columns(self):
+        """
+        Formats the columns in the csv format of the summary (as cnv.get_summary() and pycnv_sum_folder)
+        Returns:
+           List of (header, array of strings)
+        """
+        data = self.data
+        date = numpy.datetime_as_string(data['date'], unit = 's')
+        date = numpy.char.replace(date, 'T', ' ')
+        date[numpy.isnat(data['date'])] = 'NaN'
+        columns = []
+        columns.append(('date',            date))
+        columns.append(('lat',             numpy.char.mod('%8.5f', data['lat'])))
+        columns.append(('lon',             numpy.char.mod('%9.5f', data['lon'])))
+        columns.append(('p min',           numpy.char.mod('% 8.2f', data['pmin'])))
+        columns.append(('p max',           numpy.char.mod('% 8.2f', data['pmax'])))
+        columns.append(('num p samples',   numpy.char.mod('% 6d', data['nsamples'])))
+        columns.append(('baltic',          numpy.char.mod('% 1d', data['baltic'].astype(int))))
+        columns.append(('file',            data['file']))
+        # Added columns are appended, to keep the positions of the existing ones
+        columns.append(('station nearest', numpy.char.mod('%8s', data['station_nearest'])))
+        columns.append(('station dist',    numpy.char.mod('% 9.0f', data['station_dist'])))
+        columns.append(('profile',         numpy.char.mod('%4d', data['profile'])))
+        return columns
+
+    def get_summary(self):
+        """
+        Returns the summary of each cast as string, the same as cnv.get_summary()
+        Returns:
+           Array of strings
+        """
+        columns = [c[1] for c in self.format_columns() if c[0] in cnv_summary_columns]
+        summary = columns[0]
+        for c in columns[1:]:
+            summary = numpy.char.add(numpy.char.add(summary, ','), c)
+
+        return summary
+
+    def to_csv(self, filename = None, header = True, numbered = True):
+        """
+        Writes the table in the csv format of pycnv_sum_folder in one call
+        Args:
+           filename: The file to write to, None to return the csv as string
+           header: Write the header line
+           numbered: Add the columns num file and num double (see num_double())
+        Returns:
+           The csv string if filename is None, otherwise the number of written casts
+        """
+        sep     = ','
+        columns = self.format_columns()
+        if(numbered):
+            columns.insert(0, ('num double', numpy.char.mod('%5d', self.num_double())))
+            columns.insert(0, ('num file', numpy.char.mod('%5d', numpy.arange(len(self)))))
+
+        lines = []
+        if(header):
+            lines.append(sep.join([c[0] for c in columns]))
+        if(len(self) > 0):
+            lines.extend([sep.join(row) for row in zip(*[c[1].tolist() for c in columns])])
+
+        csv = ''.join([line + '\n' for line in lines])
+        if(filename is None):
+            return csv
+
+        with open(filename, 'w') as fcsv:
+            fcsv.write(csv)
+
+        return len(self)
@@ -0,0 +1,336 @@
+#
+# T-S diagrams of many casts as 2-D histograms on a fixed SA-CT grid
+#
+import os
+import sys
+import logging
+import argparse
+import numpy
+from .pycnv import _import_gsw, version, expand_filenames
+from .pycnv_sum_folder import iter_casts
+
+# Setup logging module
+logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+logger = logging.getLogger('pycnv_ts')
+
+
+class ts_histogram(object):
+    """
+
+    A 2-D histogram of absolute salinity and conservative temperature
+    on a fixed grid. Casts are added one by one, the samples of a cast
+    are binned at once with numpy.bincount, the memory needed and the
+    time to plot do not depend on the number of samples. Histograms
+    with the same grid can be added (e.g. of worker processes, see
+    create_ts_histogram()) and saved with save()/load_ts_histogram().
+
+    Usage:
+       >>>hist = ts_histogram()
+       >>>for cnv in iter_valid_files('cruises/'):
+       >>>    hist.add_cast(cnv)
+       >>>fig, ax, mesh = hist.plot()
+       >>>fig.savefig('TS.png')
+
+    Args:
+       sa_range: Range of the absolute salinity [g/kg]
+       ct_range: Range of the conservative temperature [deg C]
+       resolution: Size of the bins [SA,CT] in [g/kg,deg C]
+
+    """
+    def __init__(self, sa_range = [0,42], ct_range = [-2,32], resolution = [0.05,0.05]):
+        self.sa_range   = [float(sa_range[0]), float(sa_range[1])]
+        self.ct_range   = [float(ct_range[0]), float(ct_range[1])]
+        self.resolution = [float(resolution[0]), float(resolution[1])]
+        self.nsa        = int(numpy.ceil((self.sa_range[1] - self.sa_range[0]) / self.resolution[0]))
+        self.nct        = int(numpy.ceil((self.ct_range[1] - self.ct_range[0]) / self.resolution[1]))
+        self.counts     = numpy.zeros((self.nct, self.nsa), dtype = numpy.int64)
+        self.ncasts     = 0
+        self.outside    = 0 # Valid samples outside of the grid
+
+    @property
+    def sa_edges(self):
+        return self.sa_range[0] + numpy.arange(self.nsa + 1) * self.resolution[0]
+
+    @property
+    def ct_edges(self):
+        return self.ct_range[0] + numpy.arange(self.nct + 1) * self.resolution[1]
+
+    @property
+    def nsamples(self):
+        """ Number of samples within the grid
+        """
+        return int(self.counts.sum())
+
+    def add(self, sa, ct):
+        """
+        Adds samples to the histogram, samples with NaN are ignored
+        Args:
+           sa: Absolute salinity [g/kg]
+           ct: Conservative temperature [deg C]
+        """
+        sa    = numpy.asarray(sa, dtype = float).ravel()
+        ct    = numpy.asarray(ct, dtype = float).ravel()
+        valid = numpy.isfinite(sa) & numpy.isfinite(ct)
+        with numpy.errstate(invalid = 'ignore'):
+            isa = numpy.floor((sa - self.sa_range[0]) / self.resolution[0])
+            ict = numpy.floor((ct - self.ct_range[0]) / self.resolution[1])
+            inside = valid & (isa >= 0) & (isa < self.nsa) & (ict >= 0) & (ict < self.nct)
+        self.outside += int(valid.sum() - inside.sum())
+        ind    = ict[inside].astype(numpy.int64) * self.nsa + isa[inside].astype(numpy.int64)
+        counts = self.counts.ravel()
+        if(len(ind) > counts.size // 16):
+            counts += numpy.bincount(ind, minlength = counts.size)
+        else: # Few samples, only the bins with samples are touched
+            bins, n = numpy.unique(ind, return_counts = True)
+            counts[bins] += n
+
+    def add_cast(self, cnv, sa = 'SA00', ct = 'CT00'):
+        """
+        Adds the samples of a cast
+        Args:
+           cnv: pycnv or pycnv_view object
+           sa: The absolute salinity in cdata
+           ct: The conservative temperature in cdata
+        Returns:
+           True if the cast had the variables, otherwise False
+        """
+        if(cnv.data is None or sa not in cnv.cdata or ct not in cnv.cdata):
+            logger.debug('No ' + sa + ' or ' + ct + ' in ' + str(cnv.filename))
+            return False
+        self.add(cnv.cdata[sa], cnv.cdata[ct])
+        self.ncasts += 1
+        return True
+
+    def add_casts(self, casts, sa = 'SA00', ct = 'CT00', **kwargs):
+        """
+        Adds casts one by one, only one cast is in memory at a time if files are given
+        Args:
+           casts: The dictionary returned by get_all_valid_files(), pycnv objects or cnv filenames (see iter_casts())
+           sa: The absolute salinity in cdata
+           ct: The conservative temperature in cdata
+           **kwargs: Passed to pycnv() if files are read
+        Returns:
+           Number of added casts
+        """
+        kwargs.setdefault('verbosity', logging.CRITICAL)
+        nadded = 0
+        for cnv in iter_casts(casts, **kwargs):
+            if(cnv.valid_cnv and self.add_cast(cnv, sa, ct)):
+                nadded += 1
+
+        return nadded
+
+    def _check_grid(self, other):
+        if(self.sa_range != other.sa_range or self.ct_range != other.ct_range or self.resolution != other.resolution):
+            raise ValueError('The histograms have different grids')
+
+    def __iadd__(self, other):
+        self._check_grid(other)
+        self.counts  += other.counts
+        self.ncasts  += other.ncasts
+        self.outside += other.outside
+        return self
+
+    @property
+    def sa_centers(self):
+        return self.sa_range[0] + (numpy.arange(self.nsa) + 0.5) * self.resolution[0]
+
+    @property
+    def ct_centers(self):
+        return self.ct_range[0] + (numpy.arange(self.nct) + 0.5) * self.resolution[1]
+
+    def get_density(self, p_ref = 0, sa = None, ct = None):
+        """
+        Returns the potential density anomaly (potential density - 1000 kg/m^3) on a SA-CT grid
+        Args:
+           p_ref: Reference pressure [dbar]
+           sa: Absolute salinity of the grid, None for the centers of the bins
+           ct: Conservative temperature of the grid, None for the centers of the bins
+        Returns:
+           sigma: Array (len(ct), len(sa)) [kg/m^3]
+        """
+        gsw = _import_gsw()
+        if(sa is None):
+            sa = self.sa_centers
+        if(ct is None):
+            ct = self.ct_centers
+        SA, CT = numpy.meshgrid(sa, ct)
+        return gsw.rho(SA, CT, p_ref) - 1000
+
+    def plot(self, ax = None, log = True, cmap = 'viridis', isopycnals = True, levels = None, p_ref = 0, crop = True, colorbar = True, figsize = [8.27,8.27]):
+        """
+        Plots the histogram with pcolormesh (empty bins are not drawn) and isopycnals of the potential density anomaly
+        Args:
+           ax: The matplotlib axes, None for a new figure on the Agg canvas
+           log: Logarithmic color scale of the counts
+           cmap: The colormap
+           isopycnals: Draw contours of the potential density anomaly
+           levels: The isopycnals [kg/m^3], None for matplotlib automatic levels
+           p_ref: Reference pressure of the potential density [dbar]
+           crop: Limit the axes to the bins with samples
+           colorbar: Add a colorbar
+           figsize: The size of a new figure
+        Returns:
+           [figure, axes, QuadMesh]
+        """
+        from matplotlib.colors import LogNorm
+        from .pycnv_plot import _get_axes
+        ax     = _get_axes(ax, figsize)
+        fig    = ax.figure
+        counts = numpy.ma.masked_equal(self.counts, 0)
+        norm   = None
+        if(log and self.nsamples > 0):
+            norm = LogNorm(vmin = 1, vmax = counts.max())
+        mesh = ax.pcolormesh(self.sa_edges, self.ct_edges, counts, cmap = cmap, norm = norm)
+        if(crop and self.nsamples > 0):
+            ict, isa = numpy.nonzero(self.counts)
+            ax.set_xlim(self.sa_edges[isa.min()], self.sa_edges[isa.max() + 1])
+            ax.set_ylim(self.ct_edges[ict.min()], self.ct_edges[ict.max() + 1])
+        if(isopycnals):
+            # Only the visible part of the grid is contoured
+            sa    = self.sa_centers
+            ct    = self.ct_centers
+            xlim  = ax.get_xlim()
+            ylim  = ax.get_ylim()
+            sa    = sa[(sa >= xlim[0] - self.resolution[0]) & (sa <= xlim[1] + self.resolution[0])]
+            ct    = ct[(ct >= ylim[0] - self.resolution[1]) & (ct <= ylim[1] + self.resolution[1])]
+            sigma = self.get_density(p_ref, sa, ct)
+            cont  = ax.contour(sa, ct, sigma, levels = levels, colors = 'k', linewidths = 0.5, alpha = 0.7)
+            ax.clabel(cont, fontsize = 8, fmt = '%g')
+        ax.set_xlabel('Absolute salinity [g/kg]')
+        ax.set_ylabel('Conservative Temperature [deg C]')
+        title = str(self.nsamples) + ' samples'
+        if(self.ncasts > 0):
+            title = str(self.ncasts) + ' casts, ' + title
+        ax.set_title(title)
+        if(colorbar):
+            cbar = fig.colorbar(mesh, ax = ax)
+            cbar.set_label('Number of samples')
+
+        return [fig, ax, mesh]
+
+    def save(self, filename):
+        """ Saves the histogram as npz file, see load_ts_histogram()
+        """
+        numpy.savez_compressed(filename, counts = self.counts, sa_range = self.sa_range, ct_range = self.ct_range, resolution = self.resolution, ncasts = self.ncasts, outside = self.outside)
+
+    def __str__(self):
+        return 'ts_histogram with ' + str(self.ncasts) + ' casts and ' + str(self.nsamples) + ' samples (' + str(self.nct) + ' x ' + str(self.nsa) + ' bins)'
+
+
+def load_ts_histogram(filename):
+    """
+    Loads a histogram saved with ts_histogram.save(), more casts can be added to it
+    Returns:
+       ts_histogram
+    """
+    with numpy.load(filename) as data:
+        hist = ts_histogram(data['sa_range'], data['ct_range'], data['resolution'])
+        hist.counts  = data['counts']
+        hist.ncasts  = int(data['ncasts'])
+        hist.outside = int(data['outside'])
+
+    return hist
+
+
+def _histogram_worker(args):
+    """ Adds a chunk of files to a histogram in a worker process
+    Returns:
+       [index, counts, ncasts, outside]: The flat index and counts of the bins with samples (only these are sent back)
+    """
+    filenames, settings, sa, ct, kwargs = args
+    hist = ts_histogram(**settings)
+    for f in filenames:
+        try:
+            hist.add_casts([f], sa, ct, **kwargs)
+        except Exception as e:
+            logger.warning('Could not read ' + str(f) + ' (' + str(e) + ')')
+
+    index = numpy.flatnonzero(hist.counts)
+    return [index, hist.counts.ravel()[index], hist.ncasts, hist.outside]
+
+
+def create_ts_histogram(filenames, processes = None, sa = 'SA00', ct = 'CT00', sa_range = [0,42], ct_range = [-2,32], resolution = [0.05,0.05], chunksize = 16, **kwargs):
+    """
+    Creates the T-S histogram of cnv files with a pool of processes, each worker adds a chunk of files to its own histogram and sends back the bins with samples
+    Args:
+       filenames: List of cnv files
+       processes: Number of worker processes, None for the number of CPUs, 1 reads the files in this process
+       sa: The absolute salinity in cdata
+       ct: The conservative temperature in cdata
+       sa_range, ct_range, resolution: The grid, see ts_histogram
+       chunksize: Number of files of one task
+       **kwargs: Passed to pycnv(), e.g. baltic
+    Returns:
+       ts_histogram
+
+    Usage:
+       >>>hist = create_ts_histogram(glob.glob('cruises/**/*.cnv', recursive = True), processes = 4)
+    """
+    kwargs.setdefault('verbosity', logging.CRITICAL)
+    if(processes is None):
+        processes = os.cpu_count() or 1
+
+    settings  = {'sa_range':sa_range, 'ct_range':ct_range, 'resolution':resolution}
+    hist      = ts_histogram(**settings)
+    filenames = list(filenames)
+    args      = [(filenames[i:i + chunksize], settings, sa, ct, kwargs) for i in range(0, len(filenames), chunksize)]
+    pool = None
+    if(processes <= 1 or len(args) <= 1):
+        results = map(_histogram_worker, args)
+    else:
+        from multiprocessing import Pool
+        pool    = Pool(min(processes, len(args)))
+        results = pool.imap_unordered(_histogram_worker, args)
+
+    try:
+        counts = hist.counts.ravel()
+        for index, part, ncasts, outside in results:
+            counts[index] += part
+            hist.ncasts   += ncasts
+            hist.outside  += outside
+    finally:
+        if(pool is not None):
+            pool.close()
+            pool.join()
+
+    logger.info(str(hist))
+    return hist
+
+
+def main():
+    desc      = 'Creates a T-S diagram of many cnv files as 2-D histogram of absolute salinity and conservative temperature with isopycnals'
+    file_help = 'The cnv file(s), glob patterns (e.g. "cruises/**/*.cnv") are expanded'
+    parser    = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--output', '-o', default='TS.png', help='The figure file')
+    parser.add_argument('--resolution', '-r', type=float, nargs=2, default=[0.05,0.05], metavar=('SA','CT'), help='The size of the bins [g/kg] [deg C]')
+    parser.add_argument('--histogram', help='Add the casts to this histogram file (npz, see ts_histogram.save()), it is created if it does not exist')
+    parser.add_argument('--jobs', '-j', type=int, help='Number of worker processes, standard is the number of CPUs')
+    parser.add_argument('--verbose', '-v', action='count')
+    parser.add_argument('--version', action='version', version='%(prog)s ' + version)
+    parser.add_argument('filename', nargs='*', help=file_help)
+    args = parser.parse_args()
+
+    if(args.verbose == None):
+        loglevel = logging.WARNING
+    elif(args.verbose == 1):
+        loglevel = logging.INFO
+    else:
+        loglevel = logging.DEBUG
+
+    logger.setLevel(loglevel)
+    hist = create_ts_histogram(expand_filenames(args.filename), args.jobs, resolution = args.resolution)
+    if(args.histogram is not None):
+        if(os.path.isfile(args.histogram)):
+            hist_file  = load_ts_histogram(args.histogram)
+            hist_file += hist
+            hist       = hist_file
+        hist.save(args.histogram)
+
+    print(hist)
+    fig, ax, mesh = hist.plot()
+    fig.savefig(args.output)
+
+
+if __name__ == '__main__':
+   main()
@@ -21,9 +21,10 @@ setup(name='pycnv',
       license='GPLv03',
       packages=['pycnv'],
       scripts = [],
-      entry_points={ 'console_scripts': ['pycnv=pycnv.pycnv:main', 'pycnv_sum_folder=pycnv.pycnv_sum_folder:main']},
+      entry_points={ 'console_scripts': ['pycnv=pycnv.pycnv:main', 'pycnv_sum_folder=pycnv.pycnv_sum_folder:main', 'pycnv_service=pycnv.pycnv_service:main', 'pycnv_plot=pycnv.pycnv_plot:main', 'pycnv_pyramid=pycnv.pycnv_pyramid:main', 'pycnv_ts=pycnv.pycnv_ts:main']},
       package_data = {'':['VERSION','stations/iow_stations.yaml','rules/standard_names.yaml']},
-      install_requires=[ 'gsw', 'pyproj','pytz','pyaml' ],
+      install_requires=[ 'gsw', 'pyproj','pyaml' ],
+      extras_require={'netcdf':['netCDF4'], 'parquet':['pyarrow'], 'pandas':['pandas'], 'xarray':['xarray']},
       classifiers=[
         'Development Status :: 4 - Beta',
         'Topic :: Scientific/Engineering',          
@@ -32,7 +33,7 @@ setup(name='pycnv',
         'Operating System :: OS Independent',
         'Programming Language :: Python :: 3 :: Only',
       ],
-      python_requires='>=3.5',
+      python_requires='>=3.8',
       zip_safe=False)
 
 
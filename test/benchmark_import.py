@@ -0,0 +1,41 @@
+#
+# Benchmark of the import time of pycnv. Each import is done in a fresh
+# interpreter, the heavy dependencies (matplotlib, gsw, yaml, ...) must
+# not be imported by "import pycnv", they are imported at their first use.
+#
+# Usage: python benchmark_import.py [budget in seconds] [number of runs]
+#
+import subprocess
+import sys
+import time
+import numpy
+
+budget = float(sys.argv[1]) if len(sys.argv) > 1 else 0.5
+nrun   = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+# Modules which must not be loaded by "import pycnv"
+heavy = ['matplotlib', 'pylab', 'gsw', 'yaml', 'pytz', 'pkg_resources', 'scipy', 'pyproj', 'netCDF4', 'pyarrow', 'pandas', 'xarray']
+
+def run(code):
+    t1 = time.time()
+    out = subprocess.run([sys.executable, '-c', code], check = True, stdout = subprocess.PIPE, universal_newlines = True).stdout
+    return time.time() - t1, out
+
+# The startup time of the interpreter with numpy is subtracted
+t_python = numpy.median([run('import numpy')[0] for i in range(nrun)])
+t_pycnv  = numpy.median([run('import pycnv')[0] for i in range(nrun)])
+t_import = t_pycnv - t_python
+print('python + numpy startup: {:.3f} s'.format(t_python))
+print('python + pycnv startup: {:.3f} s'.format(t_pycnv))
+print('import pycnv (without numpy): {:.3f} s (budget {:.3f} s)'.format(t_import, budget))
+
+code = 'import sys, pycnv; print(" ".join([m for m in ' + repr(heavy) + ' if m in sys.modules]))'
+loaded = run(code)[1].split()
+if(len(loaded) > 0):
+    print('Heavy modules loaded by import pycnv: ' + ', '.join(loaded))
+
+if(t_import > budget or len(loaded) > 0):
+    print('FAILED')
+    sys.exit(1)
+
+print('OK')
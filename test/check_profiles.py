@@ -0,0 +1,73 @@
+#
+# Checks the splitting of cnv files into profiles (pycnv.get_profiles())
+# with synthetic pressure records: a single cast with a surface soak must
+# not be split, a yo-yo is split into its down- and upcasts.
+#
+# Usage: python check_profiles.py
+#
+import os
+import sys
+import logging
+import tempfile
+import numpy
+import pycnv
+
+
+def write_cnv(filename, p):
+    """ Writes a cnv file with the pressure p and a temperature, conductivity and time channel
+    """
+    n    = len(p)
+    data = numpy.column_stack((p, 10 - 0.05 * p, 30 + 0.02 * p, numpy.arange(n) / 24.))
+    with open(filename, 'w') as fcnv:
+        fcnv.write('* Sea-Bird SBE 9 Data File:\n')
+        fcnv.write('* NMEA Latitude = 57 19.20 N\n')
+        fcnv.write('* NMEA Longitude = 020 03.00 E\n')
+        fcnv.write('* NMEA UTC (Time) = Feb 21 2019 10:18:21\n')
+        fcnv.write('# nquan = 4\n# nvalues = ' + str(n) + '\n')
+        fcnv.write('# name 0 = prDM: Pressure, Digiquartz [db]\n')
+        fcnv.write('# name 1 = t090C: Temperature [ITS-90, deg C]\n')
+        fcnv.write('# name 2 = c0mS/cm: Conductivity [mS/cm]\n')
+        fcnv.write('# name 3 = timeS: Time, Elapsed [seconds]\n')
+        fcnv.write('# interval = seconds: 0.0416667\n')
+        fcnv.write('# file_type = ascii\n*END*\n')
+        numpy.savetxt(fcnv, data, fmt = '%11.4f')
+
+
+def get_profiles(p):
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'cast.cnv')
+        write_cnv(filename, p)
+        cnv = pycnv.pycnv(filename, verbosity = logging.ERROR, compute_cdata = False)
+        return [cnv.get_profiles(multi_only = True), cnv.get_profiles(), cnv.get_cast_segments()]
+
+
+rng    = numpy.random.default_rng(0)
+failed = []
+# 30 dbar cast with the standard soak: down to 10 m, back up to 1 m, then the cast
+p = numpy.concatenate((numpy.full(100, 1.0), numpy.arange(1, 10, 0.02), numpy.full(300, 10.0),
+                       numpy.arange(10, 1, -0.02), numpy.full(100, 1.0), numpy.arange(1, 30, 0.02), numpy.arange(30, 1, -0.04)))
+p += rng.normal(0, 0.01, len(p))
+multi, profiles, segments = get_profiles(p)
+print('soak and cast: ' + str(len(multi)) + ' profiles (multi_only), ' + str([v.kind for v in profiles]) + ', downcast ' + str(segments['down']))
+if(len(multi) != 0 or [v.kind for v in profiles] != ['down','up']):
+    failed.append('soak and cast')
+
+# Yo-yo with four downcasts after a soak
+p = numpy.concatenate((numpy.full(200, 5.0), numpy.abs(numpy.sin(numpy.linspace(0, 4 * numpy.pi, 4000))) * 100 + 1))
+p += rng.normal(0, 0.01, len(p))
+multi, profiles, segments = get_profiles(p)
+print('yo-yo: ' + str(len(multi)) + ' profiles (multi_only)')
+if(len(multi) != 8):
+    failed.append('yo-yo')
+
+# Pressure without finite values
+multi, profiles, segments = get_profiles(numpy.full(300, numpy.NaN))
+print('no pressure: ' + str(len(profiles)) + ' profiles')
+if(len(profiles) != 0):
+    failed.append('no pressure')
+
+if(len(failed) > 0):
+    print('FAILED: ' + ', '.join(failed))
+    sys.exit(1)
+
+print('OK')
@@ -36,75 +36,21 @@ print('Found ' + str(len(cnv_files)) + ' files in ' + '{:1.0f}'.format(dt) + ' s
 # The pressure axes we want to interpolate the data
 p_int = arange(0,245,0.25)
 
-# Empty lists containing the result hopefully soon
-SA00_int    = []
-CT00_int    = []
-SA11_int    = []
-CT11_int    = []
-lon_all     = []
-lat_all     = []
-date_all    = []
-timenum_all = []
+# Interpolate all casts at once, casts without the variables are NaN
+gridded = pycnv.interp_casts(cnv_data, p_int, variables = ['SA00','CT00','SA11','CT11'])
 timenum_unit = 'seconds since 1970-01-01 00:00:00' # This is the unix-time ...
-for f in cnv_files:
-    good_data = [False,False]
-    cnv = pycnv.pycnv(f)
-
-    try: # Check if we have pressure data
-        p = cnv.data['p']
-    except:
-        continue
-    
-    try: # Check if we have data of sensor package 0
-        SA00 = cnv.cdata['SA00']
-        CT00 = cnv.cdata['CT00']    
-        good_data[0] = True
-        SA00_tmp = interp(p_int,p,SA00,left=NaN,right=NaN)
-        CT00_tmp = interp(p_int,p,CT00,left=NaN,right=NaN)
-        SA_unit = cnv.cunits['SA00']
-        CT_unit = cnv.cunits['CT00']                
-    except:
-        SA00_tmp = p_int * NaN
-        CT00_tmp = p_int * NaN
-
-    try: # Check if we have data of sensor package 1
-        SA11 = cnv.cdata['SA11']
-        CT11 = cnv.cdata['CT11']    
-        good_data[1] = True
-        SA11_tmp = interp(p_int,p,SA11,left=NaN,right=NaN)
-        CT11_tmp = interp(p_int,p,CT11,left=NaN,right=NaN)
-        SA_unit = cnv.cunits['SA11']
-        CT_unit = cnv.cunits['CT11']
-
-    except:
-        SA11_tmp = p_int * NaN
-        CT11_tmp = p_int * NaN
-
-    
-    if(good_data[0] or good_data[1]):
-        lon_all.append(cnv.lon)
-        lat_all.append(cnv.lat)
-        date_all.append(cnv.date)
-        tn = netCDF4.date2num(cnv.date,timenum_unit)
-        timenum_all.append(tn)
-        SA00_int.append(SA00_tmp)
-        CT00_int.append(CT00_tmp)
-        SA11_int.append(SA11_tmp)
-        CT11_int.append(CT11_tmp)
-
-
-lon_all = asarray(lon_all)
-lat_all = asarray(lat_all)
-date_all = asarray(date_all)
-timenum_all = asarray(timenum_all)
-SA00_int = asarray(SA00_int)
-CT00_int = asarray(CT00_int)
-SA11_int = asarray(SA11_int)
-CT11_int = asarray(CT11_int)
-SA00_int = ma.masked_invalid(SA00_int)
-CT00_int = ma.masked_invalid(CT00_int)
-SA00_int = ma.masked_invalid(SA00_int)
-CT11_int = ma.masked_invalid(CT11_int)
+# Keep only casts with data of sensor package 0 or 1
+good_data = isfinite(gridded['SA00']).any(axis=1) | isfinite(gridded['SA11']).any(axis=1)
+lon_all = gridded['lon'][good_data]
+lat_all = gridded['lat'][good_data]
+date_all = asarray(gridded['date'])[good_data]
+timenum_all = asarray([netCDF4.date2num(d,timenum_unit) for d in date_all])
+SA00_int = ma.masked_invalid(gridded['SA00'][good_data])
+CT00_int = ma.masked_invalid(gridded['CT00'][good_data])
+SA11_int = ma.masked_invalid(gridded['SA11'][good_data])
+CT11_int = ma.masked_invalid(gridded['CT11'][good_data])
+SA_unit = 'g/kg'
+CT_unit = 'deg C'
 
 print('Creating the netCDF file with the interpolated data')
 nc = netCDF4.Dataset('TF0271.nc','w')